@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""Time yarsync commands on a synthetic repository.
+
+A repository is generated with the given number of files,
+directory depth, file size distribution, number of commits
+and churn (the fraction of files changed) per commit.
+Then status, commit, log, diff, checkout, push and pull
+(to a remote at a local path) are run from this source tree
+and their wall clock times are written to a JSON file.
+
+    python benchmarks/benchmark.py --files 100000 -o before.json
+    python benchmarks/benchmark.py --files 100000 --compare before.json
+
+Startup ("import") is the cumulative import time of yarsync
+reported by *python -X importtime*. Its target is IMPORT_TARGET
+(commands like "log -n 1" should not wait for modules they don't use).
+
+rsync must be installed.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from yarsync.version import __version__
+from yarsync.yarsync import _native_snapshot, _RsyncFilter
+
+
+COMMANDS = ["import", "status", "commit", "log", "diff", "checkout", "push",
+            "pull"]
+# seconds
+IMPORT_TARGET = 0.035
+# files are filled with slices of this random block
+BLOCK_SIZE = 2**20
+
+
+def _check_fraction(value):
+    value = float(value)
+    if not 0 <= value <= 1:
+        raise argparse.ArgumentTypeError(
+            "{} is not between 0 and 1".format(value)
+        )
+    return value
+
+
+def _progress(*args):
+    print(*args, file=sys.stderr, flush=True)
+
+
+class RepoGenerator():
+    """Create and change files of a synthetic repository at *root*."""
+
+    def __init__(self, root, args, seed=None):
+        self.root = root
+        self.args = args
+        self.rng = random.Random(args.seed if seed is None else seed)
+        self.block = self.rng.getrandbits(8 * BLOCK_SIZE)\
+                         .to_bytes(BLOCK_SIZE, "little")
+        # a balanced tree of directories
+        self.dirs = [""]
+        level = [""]
+        for _ in range(args.depth):
+            level = [os.path.join(dir_, "d{}".format(ind))
+                     for dir_ in level for ind in range(args.fanout)]
+            self.dirs.extend(level)
+        # files are placed only in the deepest directories
+        self.leaf_dirs = level
+        self.files = []
+        self._counter = 0
+
+    def _size(self):
+        args = self.args
+        size = self.rng.lognormvariate(math.log(args.size_median),
+                                       args.size_sigma)
+        return min(int(size), args.size_max)
+
+    def _write(self, path):
+        # a unique header makes contents of all files different
+        self._counter += 1
+        header = "{} {}\n".format(path, self._counter).encode()
+        size = max(self._size(), len(header))
+        offset = self.rng.randrange(BLOCK_SIZE)
+        with open(os.path.join(self.root, path), "wb") as fil:
+            fil.write(header)
+            left = size - len(header)
+            while left > 0:
+                chunk = self.block[offset:offset + left]
+                fil.write(chunk)
+                left -= len(chunk)
+                offset = 0
+
+    def _new_file(self):
+        path = os.path.join(self.rng.choice(self.leaf_dirs),
+                            "f{}".format(self._counter))
+        self._write(path)
+        self.files.append(path)
+
+    def create(self):
+        """Create all directories and files."""
+        for dir_ in self.dirs[1:]:
+            os.mkdir(os.path.join(self.root, dir_))
+        for _ in range(self.args.files):
+            self._new_file()
+
+    def churn(self):
+        """Modify, add and remove a fraction of files.
+
+        Of the changed files, 60% are modified,
+        20% are new and 20% are removed.
+        """
+        nchanged = int(len(self.files) * self.args.churn)
+        changed = self.rng.sample(range(len(self.files)), nchanged)
+        nmodified = nchanged * 3 // 5
+        for ind in changed[:nmodified]:
+            # a new inode, as most programs save files
+            path = self.files[ind]
+            os.remove(os.path.join(self.root, path))
+            self._write(path)
+        removed = set(changed[nmodified:nmodified + nchanged // 5])
+        for ind in removed:
+            os.remove(os.path.join(self.root, self.files[ind]))
+        self.files = [path for ind, path in enumerate(self.files)
+                      if ind not in removed]
+        for _ in range(nchanged - nmodified - len(removed)):
+            self._new_file()
+
+    def make_history(self, ncommits):
+        """Create *ncommits* commits (with churn between them)
+        in the past. Return their names.
+        """
+        ys_dir = os.path.join(self.root, ".ys")
+        os.makedirs(os.path.join(ys_dir, "commits"), exist_ok=True)
+        os.makedirs(os.path.join(ys_dir, "logs"), exist_ok=True)
+        rsync_filter = _RsyncFilter(["--exclude=/.ys"])
+        # one commit a minute until now
+        first = int(time.time()) - 60 * ncommits
+        commits = []
+        for ind in range(ncommits):
+            if ind:
+                self.churn()
+            commit = first + 60 * ind
+            _native_snapshot(self.root,
+                             os.path.join(ys_dir, "commits", str(commit)),
+                             rsync_filter=rsync_filter)
+            with open(os.path.join(ys_dir, "logs", "{}.txt".format(commit)),
+                      "w") as fil:
+                fil.write("commit {}\n\nWhen: {}\nWhere: bench@local\n"
+                          .format(ind, time.ctime(commit)))
+            commits.append(commit)
+        return commits
+
+
+class Runner():
+    """Run yarsync from this source tree and record times."""
+
+    def __init__(self):
+        self.env = dict(os.environ)
+        self.env["PYTHONPATH"] = os.pathsep.join(
+            [ROOT] + [path for path in [os.environ.get("PYTHONPATH")] if path]
+        )
+        # command: [times]
+        self.times = {}
+
+    def run(self, args, cwd, name=None):
+        """Run yarsync with *args* in *cwd*.
+
+        If *name* is given, the time is recorded for that command.
+        """
+        command = [sys.executable, "-m", "yarsync.yarsync"] + args
+        start = time.perf_counter()
+        proc = subprocess.run(command, cwd=cwd, env=self.env,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE)
+        elapsed = time.perf_counter() - start
+        if proc.returncode:
+            raise RuntimeError("{} failed with {}:\n{}".format(
+                " ".join(args), proc.returncode,
+                proc.stderr.decode(errors="replace")
+            ))
+        if name is not None:
+            self.times.setdefault(name, []).append(elapsed)
+        return elapsed
+
+    def run_import(self):
+        """Record the import time of yarsync."""
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import yarsync"],
+            env=self.env, stderr=subprocess.PIPE, check=True
+        )
+        # import time: self [us] | cumulative | imported package
+        for line in proc.stderr.decode().splitlines():
+            fields = [field.strip() for field in line.split('|')]
+            if len(fields) == 3 and fields[2] == "yarsync":
+                elapsed = int(fields[1]) / 1e6
+                self.times.setdefault("import", []).append(elapsed)
+                return elapsed
+        raise RuntimeError("no import time for yarsync found")
+
+
+def _wait_next_second():
+    # commits are named by seconds
+    time.sleep(1 - time.time() % 1 + 0.01)
+
+
+def run_benchmarks(workdir, args):
+    """Generate a repository in *workdir* and time commands."""
+    local = os.path.join(workdir, "repo")
+    os.mkdir(local)
+    runner = Runner()
+    runner.run(["init", "local"], cwd=local)
+
+    _progress("generating {} files".format(args.files))
+    generator = RepoGenerator(local, args)
+    start = time.perf_counter()
+    generator.create()
+    _progress("making {} commits".format(args.commits))
+    commits = generator.make_history(args.commits)
+    _progress("generated in {:.1f} s".format(time.perf_counter() - start))
+
+    engine = ["--engine", args.engine]
+    commands = args.command or COMMANDS
+    for _ in range(args.repeat):
+        if "import" in commands:
+            runner.run_import()
+        if "status" in commands:
+            runner.run(["status"] + engine, cwd=local, name="status")
+        if "log" in commands:
+            runner.run(["log"], cwd=local, name="log")
+        if "diff" in commands and len(commits) > 1:
+            runner.run(["diff", str(commits[0]), str(commits[-1])],
+                       cwd=local, name="diff")
+
+    if "checkout" in commands and len(commits) > 1:
+        for _ in range(args.repeat):
+            runner.run(["checkout", str(commits[len(commits) // 2])],
+                       cwd=local, name="checkout")
+            runner.run(["checkout", str(commits[-1])],
+                       cwd=local, name="checkout")
+
+    if "commit" in commands:
+        for _ in range(args.repeat):
+            generator.churn()
+            _wait_next_second()
+            runner.run(["commit", "-m", "benchmark"] + engine, cwd=local,
+                       name="commit")
+
+    if "push" in commands or "pull" in commands:
+        _progress("cloning to a remote")
+        os.mkdir(os.path.join(workdir, "remote"))
+        runner.run(["clone", "remote", os.path.join(workdir, "remote")],
+                   cwd=local)
+        remote = os.path.join(workdir, "remote", "repo")
+        remote_generator = RepoGenerator(remote, args, seed=args.seed + 1)
+        for _ in range(args.repeat):
+            if "push" in commands:
+                generator.churn()
+                _wait_next_second()
+                runner.run(["commit", "-m", "push"] + engine, cwd=local)
+                runner.run(["push", "remote"] + engine, cwd=local,
+                           name="push")
+            if "pull" in commands:
+                # the remote has the same files after push
+                remote_generator.files = list(generator.files)
+                # new file names must be unique
+                remote_generator._counter = generator._counter
+                remote_generator.churn()
+                _wait_next_second()
+                runner.run(["commit", "-m", "pull"] + engine, cwd=remote)
+                runner.run(["pull", "remote"] + engine, cwd=local,
+                           name="pull")
+                generator.files = list(remote_generator.files)
+                generator._counter = remote_generator._counter
+    return runner.times
+
+
+def _rsync_version():
+    try:
+        proc = subprocess.run(["rsync", "--version"],
+                              stdout=subprocess.PIPE)
+    except OSError:
+        return None
+    return proc.stdout.decode().splitlines()[0]
+
+
+def _git_revision():
+    try:
+        proc = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+    return proc.stdout.decode().strip() or None
+
+
+def make_results(times, args):
+    params = {
+        key: getattr(args, key)
+        for key in ["files", "depth", "fanout", "size_median",
+                    "size_sigma", "size_max", "commits", "churn", "seed",
+                    "repeat", "engine"]
+    }
+    return {
+        "yarsync": __version__,
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "rsync": _rsync_version(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "params": params,
+        "results": {
+            command: {
+                "times": command_times,
+                "min": min(command_times),
+                "median": statistics.median(command_times),
+                "max": max(command_times),
+            }
+            for command, command_times in times.items()
+        },
+    }
+
+
+def compare(results, old_results):
+    """Print median times of *results* against *old_results*."""
+    if results["params"] != old_results["params"]:
+        _progress("warning: benchmark parameters differ")
+    print("{:<10} {:>10} {:>10} {:>7}".format("command", "old, s", "new, s",
+                                              "ratio"))
+    for command, result in results["results"].items():
+        new = result["median"]
+        old = old_results["results"].get(command, {}).get("median")
+        if old is None:
+            print("{:<10} {:>10} {:>10.3f}".format(command, "-", new))
+        else:
+            print("{:<10} {:>10.3f} {:>10.3f} {:>7.2f}"
+                  .format(command, old, new, new / old))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=10000,
+                        help="number of files (default: 10000)")
+    parser.add_argument("--depth", type=int, default=3,
+                        help="directory depth (default: 3)")
+    parser.add_argument("--fanout", type=int, default=8,
+                        help="subdirectories per directory (default: 8)")
+    parser.add_argument("--size-median", type=int, default=4096,
+                        help="median file size in bytes (default: 4096)")
+    parser.add_argument("--size-sigma", type=float, default=1.5,
+                        help="sigma of the log-normal size distribution "
+                             "(default: 1.5)")
+    parser.add_argument("--size-max", type=int, default=2**24,
+                        help="maximum file size in bytes (default: 16 MiB)")
+    parser.add_argument("--commits", type=int, default=10,
+                        help="number of commits in the history (default: 10)")
+    parser.add_argument("--churn", type=_check_fraction, default=0.01,
+                        help="fraction of files changed per commit "
+                             "(default: 0.01)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed (default: 0)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of runs of each command (default: 3)")
+    parser.add_argument("--engine", choices=["rsync", "native"],
+                        default="rsync",
+                        help="engine for status and commit (default: rsync)")
+    parser.add_argument("--command", action="append", choices=COMMANDS,
+                        help="command to time (can be repeated; "
+                             "default: all)")
+    parser.add_argument("--workdir",
+                        help="directory for repositories (default: temporary)")
+    parser.add_argument("--keep", action="store_true",
+                        help="don't remove generated repositories")
+    parser.add_argument("-o", "--output", help="write results to a JSON file")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare with results from a JSON file")
+    args = parser.parse_args()
+
+    if args.workdir:
+        os.makedirs(args.workdir)
+        workdir = args.workdir
+    else:
+        workdir = tempfile.mkdtemp(prefix="yarsync-bench-")
+    try:
+        times = run_benchmarks(workdir, args)
+    finally:
+        if args.keep:
+            _progress("repositories are kept in {}".format(workdir))
+        else:
+            shutil.rmtree(workdir)
+
+    results = make_results(times, args)
+    import_time = results["results"].get("import", {}).get("median")
+    if import_time is not None and import_time > IMPORT_TARGET:
+        _progress("warning: import takes {:.3f} s (target: {} s)"
+                  .format(import_time, IMPORT_TARGET))
+    if args.output:
+        with open(args.output, "w") as fil:
+            json.dump(results, fil, indent=2)
+            fil.write("\n")
+    if args.compare:
+        with open(args.compare) as fil:
+            compare(results, json.load(fil))
+    elif not args.output:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -23,6 +23,34 @@ def clone_repo(from_path, to_path):
                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 
+def make_repo(root, files, commit="1", reponame="myhost"):
+    """Create a repository at *root* with *files* and a commit.
+
+    *files* is a dictionary of relative paths and their contents.
+    The commit is hard linked without rsync,
+    directory attributes are copied.
+    """
+    commit_dir = os.path.join(root, ".ys", "commits", commit)
+    os.makedirs(commit_dir)
+    open(os.path.join(root, ".ys", "repo_{}.txt".format(reponame)), "x").close()
+    for path, content in files.items():
+        for dir_ in (root, commit_dir):
+            os.makedirs(os.path.join(dir_, os.path.dirname(path)),
+                        exist_ok=True)
+        with open(os.path.join(root, path), "w") as fil:
+            fil.write(content)
+        os.link(os.path.join(root, path), os.path.join(commit_dir, path))
+    for dirpath, dirnames, _ in os.walk(root):
+        dirnames[:] = [dir_ for dir_ in dirnames if dir_ != ".ys"]
+        relpath = os.path.relpath(dirpath, root)
+        dir_stat = os.stat(dirpath)
+        commit_subdir = os.path.normpath(os.path.join(commit_dir, relpath))
+        os.chmod(commit_subdir, dir_stat.st_mode)
+        os.utime(commit_subdir,
+                 ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+    return commit_dir
+
+
 def mock_compare(l1, l2, ignore_list=None):
     """Compare two lists l1 and l2 ignoring objects in *ignore*."""
     # function copied from lena/tests/output/test_write.py
@@ -1,12 +1,14 @@
 import os
+import shutil
 import pytest
 import time
 
 from sys import version_info
 
 from yarsync import YARsync
+from yarsync.yarsync import COMMAND_ERROR, _HashCache, _commit_stats
 
-from .helpers import mock_compare
+from .helpers import make_repo, mock_compare
 from .settings import TEST_DIR_EMPTY, YSDIR
 
 
@@ -141,6 +143,114 @@ def loctime(sec=None):
         assert os.listdir(ys.COMMITDIR) == ["2"]
 
 
+def test_commit_native(tmp_path):
+    root = str(tmp_path)
+    make_repo(root, {"a": "a", "d/b": "b", "d/e/c": "c", "excluded": ""})
+    os.symlink("a", os.path.join(root, "link"))
+    # special files are kept, as with rsync -a
+    os.mkfifo(os.path.join(root, "fifo"))
+    with open(os.path.join(root, ".ys", "rsync-filter"), "w") as fil:
+        fil.write("- /excluded\n")
+    os.chdir(root)
+
+    ys = YARsync(["yarsync", "commit", "--engine", "native", "-m", "native"])
+    assert ys() == 0
+    commits = sorted(os.listdir(ys.COMMITDIR), key=int)
+    assert len(commits) == 2
+    commit_dir = os.path.join(ys.COMMITDIR, commits[-1])
+    assert os.path.exists(os.path.join(ys.LOGDIR, commits[-1] + ".txt"))
+
+    assert set(os.listdir(commit_dir)) == set(("a", "d", "fifo", "link"))
+    assert os.path.samefile(os.path.join(root, "fifo"),
+                            os.path.join(commit_dir, "fifo"))
+    assert os.path.samefile(os.path.join(root, "d", "e", "c"),
+                            os.path.join(commit_dir, "d", "e", "c"))
+    assert os.readlink(os.path.join(commit_dir, "link")) == "a"
+    for dir_ in ("", "d", os.path.join("d", "e")):
+        src_st = os.stat(os.path.join(root, dir_))
+        dest_st = os.stat(os.path.join(commit_dir, dir_))
+        assert src_st.st_mtime_ns == dest_st.st_mtime_ns
+        assert src_st.st_mode == dest_st.st_mode
+
+
+def test_commit_stats(tmp_path, capfd, mocker):
+    root = str(tmp_path)
+    make_repo(root, {"a": "aa\n", "d/b": "b\n"})
+    (tmp_path / "c").write_text("cc\n")
+    os.chdir(root)
+    commit = ["yarsync", "commit", "--engine", "native"]
+
+    mocker.patch("time.time", lambda: 10)
+    assert YARsync(commit)() == 0
+    ys = YARsync(["yarsync", "log", "--stat", "--engine", "native"])
+    # the first commit has no statistics, all files are read
+    assert ys._read_commit_stats(1) is None
+    assert ys._read_commit_stats(10) == {
+        "files": 3, "bytes": 8, "new_files": 1, "new_bytes": 3
+    }
+
+    # a modified file is a new one
+    (tmp_path / "a").unlink()
+    (tmp_path / "a").write_text("aaaa\n")
+    (tmp_path / "d" / "b").unlink()
+    mocker.patch("time.time", lambda: 20)
+    assert YARsync(commit)() == 0
+    stats = {"files": 2, "bytes": 8, "new_files": 1, "new_bytes": 5}
+    # only the difference with the previous commit was read
+    assert ys._read_commit_stats(20) == stats
+    assert _commit_stats(os.path.join(ys.COMMITDIR, "20"),
+                         os.path.join(ys.COMMITDIR, "10")) == stats
+    capfd.readouterr()
+
+    assert ys() == 0
+    assert "\n2 files, 8 bytes (1 new files, 5 bytes)\n" \
+        in capfd.readouterr().out
+
+
+@pytest.mark.parametrize("gc", ["now", "later"])
+def test_commit_gc(tmp_path, gc):
+    root = str(tmp_path)
+    make_repo(root, {"a": "a", "d/b": "b"})
+    os.chdir(root)
+
+    ys = YARsync(["yarsync", "commit", "--engine", "native",
+                  "--limit", "1", "--gc", gc])
+    assert ys() == 0
+    assert len(os.listdir(ys.COMMITDIR)) == 1
+    if gc == "now":
+        assert os.listdir(ys.TRASHDIR) == []
+        return
+    # the old commit is in the trash
+    trash = os.listdir(ys.TRASHDIR)
+    assert len(trash) == 1
+    assert os.listdir(os.path.join(ys.TRASHDIR, trash[0])) == ["1"]
+
+    assert YARsync(["yarsync", "gc", "-j", "2"])() == 0
+    assert os.listdir(ys.TRASHDIR) == []
+    # files in the working directory are intact
+    assert open(os.path.join(root, "d", "b")).read() == "b"
+
+
+def test_gc_background(tmp_path, monkeypatch):
+    root = tmp_path / "repo"
+    make_repo(str(root), {"a": "a"})
+    # the package is not importable from the working directory
+    monkeypatch.delenv("PYTHONPATH", raising=False)
+    os.chdir(str(tmp_path))
+
+    ys = YARsync(["yarsync", "--root-dir", str(root),
+                  "--config-dir", str(root / ".ys"), "commit",
+                  "--engine", "native", "--limit", "1"])
+    assert ys() == 0
+    assert os.path.exists(ys.GCLOG)
+    for _ in range(100):
+        if not ys._get_trash():
+            break
+        time.sleep(0.05)
+    assert ys._get_trash() == []
+    assert open(ys.GCLOG).read() == ""
+
+
 def test_commit_rsync_error(mocker):
     os.chdir(TEST_DIR_EMPTY)
 
@@ -184,25 +294,130 @@ def _os_path_exists(filepath):
     ))
 
 
-def test_existing_tmp_commit_exception(mocker):
-    os.chdir(TEST_DIR_EMPTY)
-    mocker.patch("time.time", lambda: 2)
-
-    def _os_path_exists(filepath):
-        if YSDIR in filepath:
-            # print("path = ", filepath)
-            return "_tmp" in filepath
-        return False
-
-    # initialization is fine, because the config file is present
-    args = "yarsync commit".split()
-    ys = YARsync(args)
-
-    mocker.patch("os.path.exists", _os_path_exists)
-    mocker.patch("os.mkdir")
-
-    with pytest.raises(RuntimeError) as err:
-        res = ys()
-    assert repr(err.value) == repr(RuntimeError(
-        "temporary commit {} exists".format(os.path.join(ys.COMMITDIR, "2_tmp"))
-    ))
+@pytest.mark.parametrize("discard", [False, True])
+def test_partial_commit(tmp_path, capsys, discard):
+    root = str(tmp_path)
+    make_repo(root, {"a": "a", "d/b": "b"})
+    commit_dir = os.path.join(root, ".ys", "commits")
+    # an old interrupted commit is always removed
+    os.mkdir(os.path.join(commit_dir, "2_tmp"))
+    # an interrupted commit has a linked file, a stale file
+    # and a file that was replaced in the working directory
+    partial = os.path.join(commit_dir, "3_tmp")
+    os.makedirs(os.path.join(partial, "d"))
+    os.link(os.path.join(root, "a"), os.path.join(partial, "a"))
+    open(os.path.join(partial, "removed"), "w").close()
+    open(os.path.join(partial, "d", "b"), "w").close()
+    os.chdir(root)
+
+    args = ["yarsync", "commit", "--engine", "native"]
+    if discard:
+        args.append("--discard-partial")
+    assert YARsync(args)() == 0
+
+    commits = os.listdir(commit_dir)
+    assert len(commits) == 2
+    assert not [commit for commit in commits if commit.endswith("_tmp")]
+    new_commit = os.path.join(commit_dir, max(commits, key=int))
+    assert set(os.listdir(new_commit)) == set(("a", "d"))
+    assert os.path.samefile(os.path.join(root, "d", "b"),
+                            os.path.join(new_commit, "d", "b"))
+    out = capsys.readouterr().out
+    assert "removing partial commit 2\n" in out
+    if discard:
+        assert "removing partial commit 3\n" in out
+    else:
+        assert "resuming partial commit 3\n" in out
+
+
+def test_concurrent_commit(tmp_path, capsys):
+    root = str(tmp_path)
+    make_repo(root, {"a": "a"})
+    partial = os.path.join(root, ".ys", "commits", "2_tmp")
+    os.mkdir(partial)
+    os.chdir(root)
+
+    ys = YARsync(["yarsync", "commit", "--engine", "native"])
+    # another commit is running
+    with ys._lock(ys.COMMITLOCK) as locked:
+        assert locked
+        assert ys() == COMMAND_ERROR
+    assert "another commit is in progress" in capsys.readouterr().err
+    # its partial commit is intact
+    assert os.path.isdir(partial)
+
+    assert ys() == 0
+    assert not os.path.exists(partial)
+
+
+@pytest.mark.parametrize("dry_run", [True, False])
+def test_gc_dedup(tmp_path, capsys, dry_run):
+    root = str(tmp_path)
+    commit_dir = make_repo(root, {"a": "data", "b": "other"})
+    # a renamed file was copied to the working directory
+    os.rename(os.path.join(root, "a"), os.path.join(root, "c"))
+    shutil.copy2(os.path.join(commit_dir, "a"), os.path.join(root, "a2"))
+    os.remove(os.path.join(root, "c"))
+    root_mtime = os.stat(root).st_mtime_ns
+    os.chdir(root)
+
+    args = ["yarsync", "gc", "--dedup"]
+    if dry_run:
+        args.append("-n")
+    assert YARsync(args)() == 0
+    out = capsys.readouterr().out
+    linked = os.path.samefile(os.path.join(root, "a2"),
+                              os.path.join(commit_dir, "a"))
+    if dry_run:
+        assert not linked
+        assert "1 files can be linked, 4 bytes would be freed" in out
+    else:
+        assert linked
+        assert "1 files linked, 4 bytes freed" in out
+        # the working directory looks unchanged
+        assert os.stat(root).st_mtime_ns == root_mtime
+        assert open(os.path.join(root, "a2")).read() == "data"
+
+
+def test_gc_dedup_working_files(tmp_path, capsys):
+    root = str(tmp_path)
+    commit_dir = make_repo(root, {"a": "data"})
+    # distinct files in the working directory are not linked,
+    # only copies in commits
+    shutil.copy2(os.path.join(root, "a"), os.path.join(root, "b"))
+    commit_dir2 = os.path.join(root, ".ys", "commits", "2")
+    os.mkdir(commit_dir2)
+    shutil.copy2(os.path.join(root, "b"), os.path.join(commit_dir2, "b"))
+    os.chdir(root)
+
+    assert YARsync(["yarsync", "gc", "--dedup"])() == 0
+    assert "1 files linked, 4 bytes freed" in capsys.readouterr().out
+    assert not os.path.samefile("a", "b")
+    assert os.path.samefile(os.path.join(commit_dir2, "b"), "a")
+    assert os.path.samefile(os.path.join(commit_dir, "a"), "a")
+
+
+def test_gc_dedup_changed(tmp_path, capsys, mocker):
+    root = str(tmp_path)
+    commit_dir = make_repo(root, {"a": "data"})
+    os.rename(os.path.join(root, "a"), os.path.join(root, "c"))
+    shutil.copy2(os.path.join(commit_dir, "a"), os.path.join(root, "a2"))
+    os.remove(os.path.join(root, "c"))
+    os.chdir(root)
+
+    # the file is rewritten in place after it was hashed
+    save = _HashCache.save
+    def rewrite(self):
+        a2_stat = os.stat("a2")
+        with open("a2", "w") as a2:
+            a2.write("DATA")
+        os.utime("a2", ns=(a2_stat.st_atime_ns, a2_stat.st_mtime_ns))
+        save(self)
+    mocker.patch.object(_HashCache, "save", rewrite)
+
+    assert YARsync(["yarsync", "gc", "--dedup"])() == 0
+    out = capsys.readouterr().out
+    assert "changed file skipped: " in out
+    assert "0 files linked, 0 bytes freed" in out
+    assert not os.path.samefile("a2", os.path.join(commit_dir, "a"))
+    assert open("a2").read() == "DATA"
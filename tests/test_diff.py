@@ -0,0 +1,98 @@
+import json
+import os
+
+from yarsync import YARsync
+from yarsync.yarsync import COMMAND_ERROR
+from .helpers import make_repo
+
+
+def test_diff_native(tmp_path, capfd):
+    root = str(tmp_path)
+    make_repo(root, {"a": "a\n", "d/b": "b\n", "d/c": "c\n"})
+    os.chdir(root)
+    (tmp_path / "d" / "c").unlink()
+    (tmp_path / "d" / "e").write_text("e\n")
+    os.symlink("a", str(tmp_path / "l"))
+    commit = ["yarsync", "-qq", "commit", "--engine", "native"]
+    assert YARsync(commit + ["-m", "two"])() == 0
+    commit2 = max(map(int, os.listdir(str(tmp_path / ".ys" / "commits"))))
+    capfd.readouterr()
+
+    diff = ["yarsync", "diff", "--engine", "native", "1"]
+    assert YARsync(diff)() == 0
+    lines = capfd.readouterr().out.splitlines()
+    # unchanged hard links are skipped
+    assert "d/b" not in "".join(lines)
+    assert "*deleting   d/c" in lines
+    assert ">f+++++++++ d/e" in lines
+    assert "cL+++++++++ l -> a" in lines
+
+    # the order of commits is unimportant
+    assert YARsync(diff + [str(commit2), "--format", "json"])() == 0
+    changes = [json.loads(line)
+               for line in capfd.readouterr().out.splitlines()]
+    link = [change for change in changes if change["path"] == "l"]
+    assert len(link) == 1 and link[0]["link"] == "a" and link[0]["new"]
+
+    show = ["yarsync", "show", "--engine", "native", str(commit2), "1"]
+    assert YARsync(show)() == 0
+    out = capfd.readouterr().out
+    assert "\n>f+++++++++ d/e\n" in out
+    assert "commit 1 is initial commit\n" in out
+
+
+def test_show_range(tmp_path, capfd):
+    root = str(tmp_path)
+    make_repo(root, {"a": "a\n"})
+    os.chdir(root)
+    commits_dir = tmp_path / ".ys" / "commits"
+    for commit in ["3", "5"]:
+        (commits_dir / commit).mkdir()
+        (commits_dir / commit / commit).write_text(commit + "\n")
+
+    show = ["yarsync", "show", "--engine", "native"]
+    # results are printed in order with a small window
+    assert YARsync(show + ["-j", "1", "2..", "..1"])() == 0
+    out = capfd.readouterr().out
+    assert out.index("commit 1 is initial commit") < out.index("commit 3") \
+        < out.index("\n>f+++++++++ 3\n") < out.index("commit 5") \
+        < out.index("\n*deleting   3\n")
+    assert "\n>f+++++++++ 5\n" in out
+
+    assert YARsync(show + ["3..4"])() == 0
+    assert "commit 5" not in capfd.readouterr().out
+    assert YARsync(show + ["6.."])() == COMMAND_ERROR
+    assert "no commits in the given range" in capfd.readouterr().err
+
+
+def test_diff_stat(tmp_path, capfd):
+    root = str(tmp_path)
+    make_repo(root, {"a": "a\n", "d/b": "b\n", "d/e/c": "c\n"})
+    os.chdir(root)
+    commit2 = tmp_path / ".ys" / "commits" / "2"
+    commit2.mkdir()
+    (commit2 / "a").write_text("aaa\n")
+    (commit2 / "d" / "e").mkdir(parents=True)
+    (commit2 / "d" / "e" / "f").write_text("ff\n")
+    (commit2 / "d" / "e" / "g").write_text("g\n")
+
+    diff = ["yarsync", "diff", "--engine", "native", "--stat", "1", "2"]
+    assert YARsync(diff)() == 0
+    assert capfd.readouterr().out == (
+        "./     0 added, 0 removed, 1 modified, +2 bytes\n"
+        "d/     2 added, 2 removed, 0 modified, +1 bytes\n"
+        "total: 2 added, 2 removed, 1 modified, +3 bytes\n"
+    )
+
+    assert YARsync(diff + ["--stat-depth", "2", "--format", "json"])() == 0
+    stats = [json.loads(line) for line in capfd.readouterr().out.splitlines()]
+    assert {"type": "stat", "directory": "d/e/", "added": 2, "removed": 1,
+            "modified": 0, "bytes": 3} in stats
+    assert stats[-1]["type"] == "stat_total"
+
+    log = ["yarsync", "log", "--engine", "native", "--stat"]
+    assert YARsync(log)() == 0
+    out = capfd.readouterr().out
+    assert out.count("total:") == 1
+    assert out.index("commit 2") < out.index("total:") \
+        < out.index("commit 1")
@@ -1,9 +1,10 @@
+import json
 import os
 import pytest
 import time
 
 from yarsync import YARsync
-from .helpers import mock_compare
+from .helpers import make_repo, mock_compare
 from .settings import TEST_DIR, TEST_DIR_EMPTY
 
 
@@ -115,3 +116,46 @@ def test_make_commit_log_list():
     logs = [2]
     ys = YARsync(["yarsync", "log"])  # the function is not called
     assert ys._make_commit_list(commits, logs) == [(1, None), (None, 2), (3, None)]
+
+
+def test_log_index(tmp_path, capsys):
+    """The configuration directory is read from the index until it changes."""
+    make_repo(str(tmp_path), {"a": "a"})
+    commit_dir = str(tmp_path / ".ys" / "commits")
+    os.makedirs(str(tmp_path / ".ys" / "commits" / "2"))
+    # too recent changes are not indexed
+    os.utime(commit_dir, (1, 1))
+    os.chdir(str(tmp_path))
+
+    ys = YARsync(["yarsync", "log"])
+    assert ys() == 0
+    assert "commit 2" in capsys.readouterr().out
+    assert os.path.exists(ys.INDEXFILE)
+
+    # the listing comes from the index
+    os.rmdir(os.path.join(commit_dir, "2"))
+    os.utime(commit_dir, (1, 1))
+    assert YARsync(["yarsync", "log"])() == 0
+    assert "commit 2" in capsys.readouterr().out
+
+    # a changed modification time invalidates the entry
+    os.utime(commit_dir, (2, 2))
+    assert YARsync(["yarsync", "log"])() == 0
+    assert "commit 2" not in capsys.readouterr().out
+
+
+def test_log_json(tmp_path, capfd):
+    make_repo(str(tmp_path), {"a": "a"})
+    os.makedirs(str(tmp_path / ".ys" / "logs"))
+    (tmp_path / ".ys" / "logs" / "2.txt").write_text("lost commit\n")
+    os.chdir(str(tmp_path))
+
+    assert YARsync(["yarsync", "log", "--format=json"])() == 0
+    entries = [json.loads(line)
+               for line in capfd.readouterr().out.splitlines()]
+    assert entries == [
+        {"type": "commit", "commit": 2, "message": "lost commit\n",
+         "exists": False, "head": False, "synced": [], "stats": None},
+        {"type": "commit", "commit": 1, "message": None,
+         "exists": True, "head": False, "synced": [], "stats": None},
+    ]
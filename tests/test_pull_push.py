@@ -1,8 +1,9 @@
+import io
 import os
 import pytest
 
-from yarsync.yarsync import YARsync, COMMAND_ERROR
-from .helpers import clone_repo
+from yarsync.yarsync import YARsync, COMMAND_ERROR, YSArgumentError, _Config
+from .helpers import clone_repo, make_repo
 from .settings import (
     TEST_DIR, TEST_DIR_YS_BAD_PERMISSIONS,
 )
@@ -31,7 +32,8 @@ def test_pull_push_uncommitted(
     assert returncode == COMMAND_ERROR
     captured = capfd.readouterr()
     assert "local repository has uncommitted changes" in captured.err
-    assert "Changed since head commit:\n" in captured.out
+    # the check stops at the first change and prints nothing
+    assert "Changed since head commit:\n" not in captured.out
 
 
 @pytest.mark.parametrize("backup_dir", [True, False])
@@ -105,3 +107,188 @@ def test_backup(tmp_path_factory, backup_dir):
     # we can't pull or push in an updated state
     # *** fix
     # assert ys_pull_backup._status(check_changed=True)[1] is True
+
+
+@pytest.mark.parametrize("group", ["backup", "--all"])
+def test_push_many(tmp_path, mocker, capsys, group):
+    root = str(tmp_path / "repo")
+    make_repo(root, {"a": "a"})
+    with open(os.path.join(root, ".ys", "config.ini"), "w") as fil:
+        fil.write("[drive]\npath = /drive\ngroups = backup\n"
+                  "[server]\nhost = server\npath = /repo\n"
+                  "groups = backup, offsite\n"
+                  "[laptop]\npath = /laptop\n")
+    os.chdir(root)
+
+    ys = YARsync(["yarsync", "push", group])
+    mocker.patch.object(ys, "_check_changed", return_value=(0, False))
+    # remote configurations are read once for each remote
+    remote_config = mocker.patch.object(
+        ys, "_get_remote_config", side_effect=lambda path, **kwargs: \
+        _Config({"commits": ["1"], "sync": ["1_other.txt"],
+                 "repo_{}.txt".format(path.split("/")[1]): None})
+    )
+    def rsync(command, **kwargs):
+        return mocker.Mock(stdout=io.BytesIO(b"a\n"), returncode=0)
+    popen = mocker.patch("subprocess.Popen", side_effect=rsync)
+
+    assert ys() == 0
+
+    if group == "--all":
+        remotes = ["drive", "laptop", "server"]
+    else:
+        remotes = ["drive", "server"]
+    assert remote_config.call_count == len(remotes)
+    destpaths = sorted(call.args[0][-1] for call in popen.call_args_list)
+    assert destpaths == sorted(
+        ys._configdict[remote]["destpath"] + "/" for remote in remotes
+    )
+    # output is prefixed with remote names
+    out = capsys.readouterr().out
+    for remote in remotes:
+        assert "{}: a\n".format(remote) in out
+    # synchronization of all remotes is written once
+    assert set(os.listdir(ys.SYNCDIR)) == set(
+        ["1_myhost.txt", "1_other.txt"]
+        + ["1_{}.txt".format(remote) for remote in remotes]
+    )
+
+
+def test_push_destination_or_all():
+    os.chdir(TEST_DIR)
+    with pytest.raises(YSArgumentError):
+        YARsync(["yarsync", "push"])
+    with pytest.raises(YSArgumentError):
+        YARsync(["yarsync", "push", "--all", "origin"])
+
+
+@pytest.mark.parametrize("batch_error", [False, True])
+def test_push_batch(tmp_path, mocker, batch_error):
+    root = str(tmp_path / "repo")
+    make_repo(root, {"a": "a"})
+    with open(os.path.join(root, ".ys", "config.ini"), "w") as fil:
+        fil.write("[drive]\npath = /drive\n[laptop]\npath = /laptop\n"
+                  "[server]\npath = /server\n")
+    # the laptop was never synchronized
+    os.mkdir(os.path.join(root, ".ys", "sync"))
+    for sync_file in ["1_drive.txt", "1_server.txt"]:
+        open(os.path.join(root, ".ys", "sync", sync_file), "x").close()
+    os.chdir(root)
+
+    ys = YARsync(["yarsync", "push", "--all", "--batch", "-j", "1"])
+    mocker.patch.object(ys, "_check_changed", return_value=(0, False))
+    mocker.patch.object(
+        ys, "_get_remote_config", side_effect=lambda path, **kwargs: \
+        _Config({"commits": ["1"], "repo_{}.txt".format(path[1:-5]): None})
+    )
+    commands = []
+    def rsync(command, **kwargs):
+        commands.append(command)
+        returncode = int(batch_error and "--read-batch" in command[-2])
+        return mocker.Mock(stdout=io.BytesIO(b""), returncode=returncode)
+    mocker.patch("subprocess.Popen", side_effect=rsync)
+
+    assert ys() == 0
+
+    assert [command[-1] for command in commands[:2]] == ["/drive/", "/laptop/"]
+    assert commands[0][-3].startswith("--write-batch=")
+    batch_file = commands[0][-3][len("--write-batch="):]
+    assert not any("-batch" in arg for arg in commands[1])
+    # the batch is applied to the server in the same state as the drive
+    assert commands[2][-2:] == ["--read-batch=" + batch_file, "/server/"]
+    if batch_error:
+        assert commands[3][-2:] == [root + "/", "/server/"]
+    else:
+        assert len(commands) == 3
+    # the batch is removed
+    assert not os.path.exists(batch_file)
+
+
+def test_ssh_multiplex(tmp_path, mocker):
+    root = str(tmp_path)
+    make_repo(root, {"a": "a"})
+    with open(os.path.join(root, ".ys", "config.ini"), "w") as fil:
+        fil.write("[server]\nhost = server\npath = /repo\nssh_multiplex = yes\n"
+                  "[other]\npath = other:/repo\n")
+    os.chdir(root)
+    ys = YARsync(["yarsync", "push", "server"])
+
+    command = ["rsync", "-a", "other:/repo/"]
+    ys._add_ssh_options(command)
+    assert command == ["rsync", "-a", "other:/repo/"]
+
+    for _ in range(2):
+        command = ["rsync", "-a", "server:/repo/"]
+        ys._add_ssh_options(command)
+        assert command[1] == "-e"
+        assert "-o ControlMaster=auto" in command[2]
+    control_dir = ys._ssh_control_dir
+    assert os.path.isdir(control_dir)
+
+    run = mocker.patch("subprocess.run")
+    ys._close_ssh_connections()
+    # the connection is closed once
+    run.assert_called_once()
+    assert run.call_args[0][0][-3:] == ["-O", "exit", "server"]
+    assert not os.path.exists(control_dir)
+
+
+def test_ssh_multiplex_rsh(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    make_repo(root, {"a": "a"})
+    with open(os.path.join(root, ".ys", "config.ini"), "w") as fil:
+        fil.write("[server]\nhost = server\npath = /repo\n"
+                  "ssh_multiplex = yes\n")
+    os.chdir(root)
+    ys = YARsync(["yarsync", "push", "server"])
+
+    # options of the user are kept
+    monkeypatch.setenv("RSYNC_RSH", "ssh -p 2222 -i '/my key'")
+    command = ["rsync", "-a", "server:/repo/"]
+    ys._add_ssh_options(command)
+    assert command[2].startswith("ssh -p 2222 -i '/my key' -o ControlMaster")
+
+    # an explicit remote shell is not changed
+    command = ["rsync", "-e", "ssh -p 22", "-a", "server:/repo/"]
+    ys._add_ssh_options(command)
+    assert command == ["rsync", "-e", "ssh -p 22", "-a", "server:/repo/"]
+
+    # other remote shells are not multiplexed
+    monkeypatch.setenv("RSYNC_RSH", "my-wrapper --port 2222")
+    command = ["rsync", "-a", "server:/repo/"]
+    ys._add_ssh_options(command)
+    assert command == ["rsync", "-a", "server:/repo/"]
+    assert ys._get_ssh_command("server") == ["my-wrapper", "--port", "2222"]
+    ys._close_ssh_connections()
+
+
+def test_remote_cache(tmp_path, mocker):
+    root = str(tmp_path)
+    make_repo(root, {"a": "a"})
+    with open(os.path.join(root, ".ys", "config.ini"), "w") as fil:
+        fil.write("[server]\nhost = server\npath = /repo\ncache_ttl = 60\n")
+    os.chdir(root)
+    remote_files = {"commits": ["1"], "repo_server.txt": None}
+    list_files = mocker.patch.object(YARsync, "_get_remote_files",
+                                     return_value=remote_files)
+    mocker.patch.object(YARsync, "_check_changed", return_value=(0, False))
+    mocker.patch("subprocess.Popen",
+                 return_value=mocker.Mock(stdout=io.BytesIO(b""),
+                                          returncode=0))
+
+    # the configuration is cached by the dry run
+    assert YARsync(["yarsync", "-q", "push", "-n", "server"])() == 0
+    assert YARsync(["yarsync", "-q", "push", "-n", "server"])() == 0
+    assert list_files.call_count == 1
+    # unless refreshed
+    assert YARsync(["yarsync", "-q", "push", "-n", "--refresh", "server"])() == 0
+    assert list_files.call_count == 2
+
+    # a real push doesn't use the cache (it deletes on the remote)
+    # and invalidates it
+    assert YARsync(["yarsync", "-q", "push", "server"])() == 0
+    assert list_files.call_count == 3
+    assert not [fil for fil in os.listdir(os.path.join(root, ".ys", "cache"))
+                if fil.startswith("remote_")]
+    assert YARsync(["yarsync", "-q", "push", "-n", "server"])() == 0
+    assert list_files.call_count == 4
@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+from yarsync import Repository, YARsync
+from yarsync.yarsync import Change, YSCommandError
+from .helpers import make_repo
+
+
+def test_repository(tmp_path, capfd):
+    root = str(tmp_path)
+    make_repo(root, {"a": "a\n", "d/b": "b\n"})
+    os.chdir(os.path.join(root, "d"))
+    # found in a parent directory
+    repo = Repository()
+    assert repo.root_dir == root
+
+    assert repo.status() == []
+    (tmp_path / "c").write_text("c\n")
+    # the root directory time has changed
+    changes = [Change(".d..t......", "./", None),
+               Change(">f+++++++++", "c", None)]
+    assert repo.status() == changes
+
+    commit = ["yarsync", "-qq", "commit", "--engine", "native", "-m", "two"]
+    assert YARsync(commit)() == 0
+    commits = repo.commits()
+    assert len(commits) == 2 and commits[0] == 1
+
+    log = repo.log()
+    assert [entry.commit for entry in log] == commits[::-1]
+    assert log[0].message.startswith("two\n")
+    assert log[1].message is None and log[1].exists
+    assert not log[0].head and log[0].synced == []
+
+    assert repo.diff(commits[1], 1) == changes
+    with pytest.raises(ValueError):
+        repo.diff(1, 2)
+
+    # nothing is printed
+    assert capfd.readouterr().out == ""
+
+    with pytest.raises(FileNotFoundError):
+        Repository(str(tmp_path / "d"))
+
+
+def test_repository_transfer(tmp_path, mocker):
+    make_repo(str(tmp_path), {"a": "a\n"})
+    with open(str(tmp_path / ".ys" / "config.ini"), "w") as fil:
+        fil.write("[drive]\npath = /mnt/drive\n")
+    repo = Repository(str(tmp_path))
+
+    def pull_push(ys, command_name, remote, **kwargs):
+        assert (command_name, remote) == ("push", "drive")
+        assert kwargs["dry_run"]
+        ys._transfers.extend([
+            b"sending incremental file list\n",
+            b">f.st...... a\n",
+            b"cd+++++++++ .ys/commits/2/\n",
+            b">f+++++++++ .ys/commits/2/a\n",
+            b"*deleting   b\n",
+            b"cL+++++++++ l -> a\n",
+            b"\n",
+            b"sent 128 bytes  received 25 bytes  306.00 bytes/sec\n",
+        ])
+        return 0
+
+    mocker.patch.object(YARsync, "_pull_push", autospec=True,
+                        side_effect=pull_push)
+    transfer = repo.push("drive", dry_run=True)
+    assert transfer.commits == [2]
+    assert transfer.changes == [
+        Change(">f.st......", "a", None),
+        Change("*deleting", "b", None),
+        Change("cL+++++++++", "l", "a"),
+    ]
+
+    YARsync._pull_push.side_effect = None
+    YARsync._pull_push.return_value = 23
+    with pytest.raises(YSCommandError) as err:
+        repo.push("drive")
+    assert err.value.code == 23
@@ -0,0 +1,127 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from yarsync.yarsync import SYNTAX_ERROR, _forward
+from .helpers import make_repo
+
+
+def start_service(tmp_path, socket_path):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(__file__))
+    env["YARSYNC_SOCKET"] = socket_path
+    service = subprocess.Popen(
+        [sys.executable, "-m", "yarsync.yarsync", "serve"], env=env,
+        cwd=str(tmp_path), stdout=subprocess.DEVNULL
+    )
+    for _ in range(200):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.05)
+    return service
+
+
+def test_serve(tmp_path, capfd, monkeypatch):
+    socket_path = str(tmp_path / "ys.sock")
+    monkeypatch.setenv("YARSYNC_SOCKET", socket_path)
+    # the service is not running
+    assert _forward(["yarsync", "log"]) is None
+
+    root = str(tmp_path / "repo")
+    make_repo(root, {"a": "a\n"})
+    service = start_service(tmp_path, socket_path)
+    try:
+        assert oct(os.stat(socket_path).st_mode & 0o777) == "0o600"
+        capfd.readouterr()
+        os.chdir(root)
+
+        # the output is written to our streams
+        assert _forward(["yarsync", "log"]) == 0
+        assert "commit 1" in capfd.readouterr().out
+
+        with open("b", "w") as fil:
+            fil.write("b\n")
+        assert _forward(["yarsync", "status", "--engine", "native"]) == 0
+        assert "b" in capfd.readouterr().out.split()
+
+        # cached listings are updated
+        commit = ["yarsync", "commit", "--engine", "native", "-m", "two"]
+        assert _forward(commit) == 0
+        capfd.readouterr()
+        assert _forward(["yarsync", "log"]) == 0
+        out = capfd.readouterr().out
+        assert out.count("\ncommit ") == 2 and "two" in out
+
+        assert _forward(["yarsync", "unknown"]) == SYNTAX_ERROR
+        assert "invalid choice" in capfd.readouterr().err
+
+        # commands are run in our environment
+        with open(os.path.join(".ys", "config.ini"), "w") as fil:
+            fil.write("[drive]\npath = $YS_DRIVE\n")
+        for drive in ["/mnt/one", "/mnt/two"]:
+            monkeypatch.setenv("YS_DRIVE", drive)
+            assert _forward(["yarsync", "remote", "-v"]) == 0
+            assert drive in capfd.readouterr().out
+
+        # long-running commands are not forwarded
+        assert _forward(["yarsync", "watch"]) is None
+        assert _forward(["yarsync", "serve"]) is None
+    finally:
+        service.terminate()
+        service.wait()
+
+
+def test_serve_interrupt(tmp_path):
+    socket_path = str(tmp_path / "ys.sock")
+    root = tmp_path / "repo"
+    make_repo(str(root), {"a": "a\n"})
+    with open(str(root / ".ys" / "config.ini"), "w") as fil:
+        fil.write("[server]\nhost = server\npath = /repo\n")
+    # a slow connection, the service doesn't know it
+    rsh = tmp_path / "rsh"
+    rsh.write_text(
+        "#!/bin/sh\n"
+        "trap 'touch interrupted; exit 1' INT\n"
+        "touch started\n"
+        "sleep 10 & wait\n"
+    )
+    rsh.chmod(0o755)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(__file__))
+    env["YARSYNC_SOCKET"] = socket_path
+    env["RSYNC_RSH"] = str(rsh)
+
+    service = start_service(tmp_path, socket_path)
+    try:
+        client = subprocess.Popen(
+            [sys.executable, "-m", "yarsync.yarsync", "verify", "server"],
+            env=env, cwd=str(root),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        for _ in range(200):
+            if (root / "started").exists():
+                break
+            time.sleep(0.05)
+        assert (root / "started").exists()
+        # Ctrl-C
+        client.send_signal(signal.SIGINT)
+        client.wait()
+        for _ in range(200):
+            if (root / "interrupted").exists():
+                break
+            time.sleep(0.05)
+        assert (root / "interrupted").exists()
+
+        # the service continues
+        env["RSYNC_RSH"] = ""
+        log = subprocess.run(
+            [sys.executable, "-m", "yarsync.yarsync", "log"],
+            env=env, cwd=str(root), stdout=subprocess.PIPE, timeout=10
+        )
+        assert log.returncode == 0 and b"commit 1" in log.stdout
+        assert service.poll() is None
+    finally:
+        service.terminate()
+        service.wait()
@@ -1,9 +1,10 @@
+import json
 import os
 import pytest
 
 from yarsync import YARsync
-from yarsync.yarsync import _Sync
-from .helpers import mock_compare
+from yarsync.yarsync import _Sync, COMMAND_ERROR
+from .helpers import make_repo, mock_compare
 from .settings import (
     TEST_DIR, TEST_DIR_EMPTY, TEST_DIR_CONFIG_DIR, TEST_DIR_WORK_DIR, TEST_DIR_FILTER,
     TEST_DIR_YS_BAD_PERMISSIONS,
@@ -148,3 +149,119 @@ def test_status_existing_sync(mocker, capfd, local_sync):
     else:
         sync_str = "Commits are up to date with {}.\n".format(other_repo)
         assert sync_str in captured.out
+
+
+def test_status_native_engine(tmp_path, capfd):
+    """The native engine finds same changes as rsync itemize."""
+    os.chdir(str(tmp_path))
+    make_repo(str(tmp_path), {"a": "a\n", "d/b": "b\n", "gone": "c\n"})
+
+    ys = YARsync(["yarsync", "status", "--engine", "native"])
+    assert ys() == 0
+    captured = capfd.readouterr()
+    assert not captured.err
+    assert "Nothing to commit, working directory clean.\n" in captured.out
+
+    # permissions are shared by hard links, they are not a change
+    os.chmod("a", 0o600)
+    os.remove("gone")
+    (tmp_path / "new").write_text("new\n")
+    # a file with a new inode
+    os.remove("d/b")
+    (tmp_path / "d" / "b").write_text("bb\n")
+
+    ys = YARsync(["yarsync", "status", "--engine", "native"])
+    assert ys() == 0
+    captured = capfd.readouterr()
+    lines = captured.out.splitlines()
+    assert lines[lines.index("Changed since head commit:") + 2:][:5] == [
+        ".d..t...... ./",
+        "*deleting   gone",
+        ".d..t...... d/",
+        ">f+++++++++ new",
+        ">f.st...... d/b",
+    ]
+
+
+def test_status_json(tmp_path, capfd):
+    os.chdir(str(tmp_path))
+    make_repo(str(tmp_path), {"a": "a\n", "gone": "c\n"})
+    os.remove("gone")
+    # a file with a new inode
+    os.remove("a")
+    (tmp_path / "a").write_text("aa\n")
+
+    ys = YARsync(["yarsync", "status", "--engine", "native",
+                  "--format", "json"])
+    assert ys() == 0
+    captured = capfd.readouterr()
+    changes = [json.loads(line) for line in captured.out.splitlines()]
+    assert changes[1:] == [
+        {"type": "change", "path": "gone", "flags": "*deleting",
+         "update": "deleting", "file_type": None, "new": False,
+         "attributes": [], "link": None},
+        {"type": "change", "path": "a", "flags": ">f.st......",
+         "update": "received", "file_type": "file", "new": False,
+         "attributes": ["size", "time"], "link": None},
+    ]
+    # other messages are not mixed with data
+    assert "In repository myhost" in captured.err
+
+
+@pytest.mark.parametrize("engine", ["rsync", "native"])
+def test_status_check(tmp_path, capfd, mocker, engine):
+    """status --check prints nothing and stops at the first change."""
+    os.chdir(str(tmp_path))
+    make_repo(str(tmp_path), {"a": "a\n", "b": "b\n"})
+    command = ["yarsync", "status", "--check", "--engine", engine]
+
+    popen = mocker.patch("subprocess.Popen")
+    # rsync output is ordered, but we don't need to read all of it
+    popen.return_value.stdout.readline.side_effect = [
+        b".d..t...... ./\n", b">f+++++++++ c\n", b">f+++++++++ d\n", b""
+    ]
+    popen.return_value.poll.return_value = None
+    popen.return_value.returncode = 0
+    (tmp_path / "c").write_text("c\n")
+
+    assert YARsync(command)() == COMMAND_ERROR
+    captured = capfd.readouterr()
+    assert not captured.out and not captured.err
+    if engine == "rsync":
+        popen.return_value.terminate.assert_called_once_with()
+        # the last line was not read
+        assert popen.return_value.stdout.readline.call_count == 2
+    else:
+        popen.assert_not_called()
+        os.remove("c")
+        assert YARsync(command)() == 0
+
+
+def test_status_checksum(tmp_path, capfd):
+    """status --checksum compares files of the same size by contents."""
+    os.chdir(str(tmp_path))
+    make_repo(str(tmp_path), {"a": "a\n", "b": "b\n"})
+    commit_b = os.stat(".ys/commits/1/b")
+    # same size and time, but a new inode and contents
+    os.remove("b")
+    (tmp_path / "b").write_text("c\n")
+    os.utime("b", ns=(commit_b.st_atime_ns, commit_b.st_mtime_ns))
+
+    ys = YARsync(["yarsync", "status", "--engine", "native"])
+    assert ys() == 0
+    assert "Nothing to commit" in capfd.readouterr().out
+
+    ys = YARsync(["yarsync", "status", "--engine", "native", "--checksum"])
+    assert ys() == 0
+    lines = capfd.readouterr().out.splitlines()
+    assert ">fc........ b" in lines
+    # hashes are cached
+    assert os.path.exists(".ys/cache/hashes.json")
+
+    # rewritten in place with the modification time restored
+    with open("b", "w") as fil:
+        fil.write("b\n")
+    os.utime("b", ns=(commit_b.st_atime_ns, commit_b.st_mtime_ns))
+    ys = YARsync(["yarsync", "status", "--engine", "native", "--checksum"])
+    assert ys() == 0
+    assert "Nothing to commit" in capfd.readouterr().out
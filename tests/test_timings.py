@@ -0,0 +1,64 @@
+import json
+import os
+import pstats
+import subprocess
+import sys
+
+from yarsync import YARsync
+from yarsync.yarsync import _Timings, _TimedPopen
+from .helpers import make_repo
+
+
+def test_timings_and_profile(tmp_path, capfd):
+    os.chdir(str(tmp_path))
+    make_repo(str(tmp_path), {"a": "a\n"})
+    profile = str(tmp_path / "log.prof")
+
+    ys = YARsync(["yarsync", "--timings-json", "--profile", profile, "log"])
+    assert ys() == 0
+    timings = json.loads(capfd.readouterr().err)
+    names = [span["name"] for span in timings["spans"]]
+    assert names == ["parse arguments", "command log"]
+    assert timings["total"] >= sum(span["time"]
+                                   for span in timings["spans"])
+    # the profile can be read
+    assert pstats.Stats(profile).total_calls
+
+    assert YARsync(["yarsync", "--timings", "log"])() == 0
+    table = capfd.readouterr().err.splitlines()
+    assert table[0].split() == ["start,", "s", "time,", "s", "kind", "name"]
+    assert table[-1].endswith("total")
+
+
+def test_timed_popen():
+    timings = _Timings()
+    command = [sys.executable, "-c", "pass"]
+    sp = _TimedPopen(timings, command)
+    assert sp.wait() == 0
+    # the time is added once
+    sp.poll()
+    assert [span[2:] for span in timings.spans] == [
+        ("process", " ".join(command))
+    ]
+
+
+def test_lazy_startup():
+    """Short commands don't build other parsers or import
+    modules they don't use.
+    """
+    code = (
+        "import sys\n"
+        "from yarsync import YARsync\n"
+        "ys = YARsync(['yarsync', 'log', '-n', '1'])\n"
+        "lazy = ['concurrent.futures', 'configparser', 'getpass', "
+        "'hashlib', 'shutil', 'socket', 'tempfile']\n"
+        "print(' '.join(mod for mod in lazy if mod in sys.modules))\n"
+    )
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(__file__))
+    # a repository is not needed to parse arguments,
+    # and a missing one raises after that
+    proc = subprocess.run([sys.executable, "-c", code], env=env,
+                          cwd="/", stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+    assert proc.stdout.decode().strip() == ""
@@ -0,0 +1,108 @@
+import io
+import os
+import shutil
+
+from yarsync import YARsync
+from yarsync.yarsync import (
+    COMMAND_ERROR, _file_hash_result, _manifest_line, _parse_manifest_line
+)
+from .helpers import make_repo
+
+
+def test_manifest(tmp_path, capfd):
+    os.chdir(str(tmp_path))
+    make_repo(str(tmp_path), {"a": "a\n", "d/b b": "b\n"})
+    (tmp_path / "new").write_text("new\n")
+
+    assert YARsync(["yarsync", "manifest"])() == 0
+    lines = capfd.readouterr().out.splitlines()
+    paths = [_parse_manifest_line(line)[0] for line in lines]
+    assert paths == [".ys/commits/1/a", ".ys/commits/1/d/b b",
+                     "a", "d/b b", "new"]
+    # hard links have the same hash
+    assert lines[0].split()[0] == lines[2].split()[0]
+
+    assert YARsync(["yarsync", "manifest", "2"])() == COMMAND_ERROR
+    assert "commit 2 not found" in capfd.readouterr().err
+
+    # escaped names are restored
+    line = _manifest_line("a\\#b\nc", 3, "00")
+    assert '\n' not in line
+    assert _parse_manifest_line(line) == ("a\\#b\nc", 3, "00")
+
+
+def test_manifest_cache(tmp_path, mocker):
+    os.chdir(str(tmp_path))
+    make_repo(str(tmp_path), {"a": "a\n", "d/b": "b\n"})
+    manifest = ["yarsync", "-qq", "manifest"]
+    assert YARsync(manifest)() == 0
+
+    # files linked by a commit are not hashed again
+    (tmp_path / "c").write_text("c\n")
+    commit = ["yarsync", "-qq", "commit", "--engine", "native"]
+    assert YARsync(commit + ["-m", "two"])() == 0
+    file_hash = mocker.patch("yarsync.yarsync._file_hash_result",
+                             wraps=_file_hash_result)
+    assert YARsync(manifest)() == 0
+    assert file_hash.call_count == 1
+    assert os.path.basename(file_hash.call_args.args[0]) == "c"
+
+
+def test_verify(tmp_path, capfd, monkeypatch):
+    # the remote manifest is made by a separate process
+    monkeypatch.setenv(
+        "PYTHONPATH", os.path.dirname(os.path.dirname(__file__))
+    )
+    local = tmp_path / "local"
+    drive = tmp_path / "drive"
+    make_repo(str(local), {"a": "a\n", "b": "b\n"})
+    shutil.copytree(str(local), str(drive))
+    with open(str(local / ".ys" / "config.ini"), "w") as fil:
+        fil.write("[drive]\npath = {}\n".format(drive))
+    os.chdir(str(local))
+
+    assert YARsync(["yarsync", "verify", "drive"])() == 0
+    assert "4 files verified on drive" in capfd.readouterr().out
+
+    # bit rot on the drive, with the same size
+    (drive / ".ys" / "commits" / "1" / "b").write_text("c\n")
+    (drive / "c").write_text("c\n")
+    os.makedirs(str(drive / ".ys" / "commits" / "2"))
+    (drive / ".ys" / "commits" / "2" / "c").write_text("c\n")
+
+    assert YARsync(["yarsync", "verify", "drive"])() == COMMAND_ERROR
+    out = capfd.readouterr().out
+    assert "commits missing on local: 2\n" in out
+    assert "differs     .ys/commits/1/b\n" in out
+    assert "remote only c\n" in out
+    assert ".ys/commits/2/c" not in out
+
+
+def test_verify_ssh(tmp_path, mocker):
+    root = str(tmp_path / "repo")
+    make_repo(root, {"a": "a\n"})
+    with open(os.path.join(root, ".ys", "config.ini"), "w") as fil:
+        fil.write("[server]\nhost = server\npath = ~/my repo\n"
+                  "ssh_multiplex = yes\n")
+    os.chdir(root)
+
+    manifest = "".join(
+        _manifest_line(path, 2, "a8c4e4fc") + "\n"
+        for path in [".ys/commits/1/a", "a"]
+    )
+    popen = mocker.patch("subprocess.Popen", return_value=mocker.Mock(
+        stdout=io.BytesIO(manifest.encode()), returncode=0
+    ))
+    # closing the connection
+    mocker.patch("subprocess.run")
+
+    ys = YARsync(["yarsync", "verify", "server", "1"])
+    assert ys() == COMMAND_ERROR
+    command = popen.call_args.args[0]
+    assert command[0] == "ssh"
+    assert "ControlMaster=auto" in command
+    assert command[-2:] == [
+        "server",
+        "yarsync -qq --config-dir ~/'my repo/.ys' --root-dir ~/'my repo/' "
+        "manifest 1"
+    ]
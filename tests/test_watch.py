@@ -0,0 +1,74 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from yarsync import YARsync
+from .helpers import make_repo
+
+
+def status(capfd):
+    ys = YARsync(["yarsync", "-v", "status", "--engine", "native"])
+    assert ys() == 0
+    out = capfd.readouterr().out
+    lines = out.splitlines()
+    start = lines.index("Changed since head commit:") + 2
+    end = lines.index("", start)
+    return (lines[start:end], "use watch journal" in out)
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"),
+                    reason="inotify is available only on Linux")
+def test_watch(tmp_path, capfd):
+    make_repo(str(tmp_path), {"a": "a\n", "d/b": "b\n", "d/e/c": "c\n"})
+    os.chdir(str(tmp_path))
+    # a change before the watch is found by its first scan
+    with open("before", "w") as fil:
+        fil.write("before\n")
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(__file__))
+    watch = subprocess.Popen(
+        [sys.executable, "-m", "yarsync.yarsync", "watch"], env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    state_file = str(tmp_path / ".ys" / "cache" / "watch.json")
+    try:
+        for _ in range(200):
+            if os.path.exists(state_file):
+                break
+            time.sleep(0.05)
+        os.makedirs("x/y")
+        with open("x/y/z", "w") as fil:
+            fil.write("z\n")
+        with open("d/new", "w") as fil:
+            fil.write("new\n")
+        os.remove("d/e/c")
+        os.rename("d/b", "d/e/b")
+
+        changes, journal_used = status(capfd)
+        assert journal_used
+        assert ">f+++++++++ before" in changes
+        assert ">f+++++++++ d/new" in changes
+        assert "*deleting   d/e/c" in changes
+
+        # a commit while watching keeps the journal valid
+        commit = ["yarsync", "-qq", "commit", "--engine", "native"]
+        assert YARsync(commit)() == 0
+        with open("a", "a") as fil:
+            fil.write("a\n")
+        # new commit names differ in seconds
+        time.sleep(1)
+        assert YARsync(commit)() == 0
+        with open("x/w", "w") as fil:
+            fil.write("w\n")
+        changes, journal_used = status(capfd)
+        assert journal_used
+    finally:
+        watch.terminate()
+        watch.wait()
+    assert not os.path.exists(state_file)
+
+    # a complete scan finds the same changes
+    assert status(capfd) == (changes, False)
@@ -4,7 +4,9 @@
 import pytest
 
 from yarsync import YARsync
-from yarsync.yarsync import _is_commit, _substitute_env
+from yarsync.yarsync import (
+    _is_commit, _parse_list_line, _substitute_env, _RsyncFilter
+)
 from yarsync.yarsync import (
     CONFIG_EXAMPLE, YSConfigurationError
 )
@@ -119,6 +121,44 @@ def test_is_commit():
     assert _is_commit("abc") is False
 
 
+def test_parse_list_line():
+    assert _parse_list_line(
+        b"drwxrwxr-x          4,096 2022/01/13 11:19:46 commits/1\n"
+    ) == (True, "commits/1")
+    # names can contain spaces and escaped characters
+    assert _parse_list_line(
+        b"-rw-rw-r--              0 2022/01/13 11:19:46  my repo\\#012.txt\n"
+    ) == (False, " my repo\n.txt")
+    assert _parse_list_line(
+        b"lrwxrwxrwx              1 2022/01/13 11:19:46 link -> a b\n"
+    ) == (False, "link")
+    assert _parse_list_line(b"receiving incremental file list\n") is None
+
+
+def test_rsync_filter(tmp_path):
+    filter_file = tmp_path / "rsync-filter"
+    filter_file.write_text("# comment\n- /tex\n+ /repos/keep\n- repos/\n")
+    rsync_filter = _RsyncFilter([
+        "--exclude=/.ys", "--filter=merge {}".format(filter_file),
+        "--include=.ys/commits", "--exclude=/.ys/*", "--exclude=*.o",
+    ])
+    excluded = rsync_filter.excluded
+    assert excluded(".ys", is_dir=True)
+    assert excluded("tex", is_dir=True)
+    # anchored patterns match only at the root
+    assert not excluded("a/tex", is_dir=True)
+    assert not excluded("repos/keep", is_dir=True)
+    assert excluded("a/repos", is_dir=True)
+    # trailing slash matches only directories
+    assert not excluded("a/repos")
+    assert excluded("a/b.o")
+    assert not excluded("a/b.oo")
+
+    # not supported rules raise
+    with pytest.raises(ValueError):
+        _RsyncFilter(["--filter=: .rsync-filter"])
+
+
 def test_print(mocker):
     # ys must be initialised with some settings.
     os.chdir(TEST_DIR)
@@ -4,9 +4,12 @@
 
     $ yarsync --help
 
+To use a repository from Python, see Repository.
+
 Read YARsync manual for complete documentation.
 https://github.com/ynikitenko/yarsync
 """
 
 # otherwise one would have to write 'from yarsync.yarsync import YARsync'
 from .yarsync import YARsync
+from .yarsync import Repository
@@ -1,19 +1,23 @@
 # Yet Another Rsync is a file synchronization tool
 
+# Modules needed only by some commands (concurrent.futures,
+# configparser, ctypes, fcntl, getpass, hashlib, mmap, shlex, shutil,
+# signal, socket, struct and tempfile) are imported where they are used,
+# so that frequent short commands start faster.
 import argparse
-import configparser
+import bisect
+import collections
+import contextlib
+import errno
 import functools
-# for user name
-import getpass
 import io
+import json
 import os
 import re
-# rmtree
-import shutil
-# for host name
-import socket
+import stat
 import subprocess
 import sys
+import threading
 import time
 
 
@@ -127,6 +131,32 @@ def _check_positive(value):
     return natural_num
 
 
+def _check_commit_range(value):
+    """Convert a string *value* to a commit
+    or a range *"first..last"* to a tuple *(first, last)*.
+
+    Either end of a range can be omitted (it is ``None`` then).
+    """
+    if ".." not in value:
+        return _check_positive(value)
+    first, last = value.split("..", 1)
+    try:
+        return (_check_positive(first) if first else None,
+                _check_positive(last) if last else None)
+    except argparse.ArgumentTypeError:
+        raise argparse.ArgumentTypeError(
+            "must be a commit or a range <first>..<last>"
+        )
+
+
+def _previous_commit(commits, commit):
+    """Return the commit before *commit* in the sorted list *commits*
+    or ``None`` for the first one.
+    """
+    ind = bisect.bisect_left(commits, commit)
+    return commits[ind - 1] if ind else None
+
+
 def _get_repo_name_if_exists(file_list=None, config_dir=""):
     # separate function, because used by several classes
     """*file_list* is a list of configuration files in
@@ -165,6 +195,39 @@ def _get_repo_name_if_exists(file_list=None, config_dir=""):
     return reponame
 
 
+def _get_command_name(args, value_options):
+    """Return the first positional argument in *args*
+    (the command name) or ``None``.
+
+    *value_options* are global options that take a value.
+    """
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+            continue
+        if arg.startswith('-'):
+            # argparse allows abbreviations
+            skip = ('=' not in arg and arg.startswith("--")
+                    and any(opt.startswith(arg) for opt in value_options))
+            continue
+        return arg
+    return None
+
+
+def _get_socket_path():
+    """Return the path to the socket of *yarsync serve*.
+
+    It is set by the environment variable YARSYNC_SOCKET
+    (an empty value disables the service).
+    """
+    path = os.environ.get("YARSYNC_SOCKET")
+    if path is not None:
+        return path
+    run_dir = os.environ.get("XDG_RUNTIME_DIR") or "/tmp"
+    return os.path.join(run_dir, "yarsync-{}.sock".format(os.getuid()))
+
+
 def _get_root_directory(config_dir_name):
     """Search for a directory containing *config_dir_name*
     higher in the file system hierarchy.
@@ -218,6 +281,19 @@ def _is_remote(path):
         return True
 
 
+def _quote_remote(arg):
+    """Quote *arg* for a remote shell.
+
+    A leading "~/" is left unquoted, so that it is expanded
+    to the remote home directory (as in rsync remote paths).
+    """
+    import shlex
+    if arg == "~" or arg.startswith("~/"):
+        rest = arg[2:]
+        return "~/" + shlex.quote(rest) if rest else "~/"
+    return shlex.quote(arg)
+
+
 def _print_error(msg):
     # todo: allow arbitrary number of arguments.
     # not a class method, because it can be run
@@ -272,6 +348,729 @@ def _mkhostpath(host, path):
     return path
 
 
+def _rsync_pattern_to_regex(pattern):
+    """Convert an rsync include/exclude *pattern* to a pair
+    *(regex, dir_only)*.
+
+    The regular expression is matched against a path
+    relative to the transfer root (without a leading slash).
+    """
+    dir_only = pattern.endswith('/')
+    if dir_only:
+        pattern = pattern.rstrip('/')
+    anchored = pattern.startswith('/')
+    if anchored:
+        pattern = pattern.lstrip('/')
+    # "dir/***" matches both the directory and its contents
+    with_contents = pattern.endswith("/***")
+    if with_contents:
+        pattern = pattern[:-4]
+
+    body = []
+    ind = 0
+    plen = len(pattern)
+    while ind < plen:
+        char = pattern[ind]
+        if char == '*':
+            if pattern.startswith("**", ind):
+                body.append(".*")
+                ind += 2
+                continue
+            body.append("[^/]*")
+        elif char == '?':
+            body.append("[^/]")
+        elif char == '[':
+            end = pattern.find(']', ind + 1)
+            if end == -1:
+                body.append(re.escape(char))
+            else:
+                # character classes are the same as in Python,
+                # except for the negation
+                cls = pattern[ind+1:end]
+                if cls.startswith('!'):
+                    cls = '^' + cls[1:]
+                body.append('[' + cls + ']')
+                ind = end
+        elif char == '\\' and ind + 1 < plen:
+            ind += 1
+            body.append(re.escape(pattern[ind]))
+        else:
+            body.append(re.escape(char))
+        ind += 1
+
+    regex = "".join(body)
+    if with_contents:
+        regex += "(/.*)?"
+    # unanchored patterns match at any directory level
+    prefix = '^' if anchored else "(^|/)"
+    return (re.compile(prefix + regex + '$', re.DOTALL), dir_only)
+
+
+# rsync --list-only line: permissions, size, date, time and name.
+# Size can contain separators (4,096) and be padded with spaces.
+_LIST_LINE_RE = re.compile(
+    rb"^(?P<perms>\S{10}) +[\d,.]+ \S+ \S+ (?P<name>.*?)\r?\n?$"
+)
+# non-printable characters in names are escaped by rsync as \#ooo
+_LIST_ESCAPE_RE = re.compile(rb"\\#([0-7]{3})")
+
+
+def _parse_list_line(line):
+    """Parse a line (bytes) of *rsync --list-only* output.
+
+    Return a pair *(is_dir, name)* or ``None``
+    if the line has an unknown format.
+    Names can contain spaces and escaped characters.
+    """
+    match = _LIST_LINE_RE.match(line)
+    if match is None:
+        return None
+    perms = match.group("perms")
+    name = match.group("name")
+    if perms.startswith(b'l'):
+        # a symbolic link is printed as "name -> target"
+        name = name.split(b" -> ", 1)[0]
+    name = _LIST_ESCAPE_RE.sub(lambda m: bytes([int(m.group(1), 8)]), name)
+    # make them strings for easier use and coherent with os.listdir
+    return (perms.startswith(b'd'), os.fsdecode(name))
+
+
+# backslashes and newlines in manifest paths are escaped as by rsync
+_MANIFEST_ESCAPE_RE = re.compile(r"\\#([0-7]{3})")
+
+
+def _manifest_line(path, size, digest):
+    """Return a manifest line *"hash size path"* (without a newline)."""
+    path = path.replace('\\', "\\#134").replace('\n', "\\#012")
+    return "{} {} {}".format(digest, size, path)
+
+
+def _parse_manifest_line(line):
+    """Parse a manifest line into a tuple *(path, size, hash)*.
+
+    Return ``None`` if the line has an unknown format.
+    """
+    parts = line.rstrip('\n').split(' ', 2)
+    if len(parts) != 3 or not parts[1].isdigit():
+        return None
+    path = _MANIFEST_ESCAPE_RE.sub(lambda m: chr(int(m.group(1), 8)),
+                                   parts[2])
+    return (path, int(parts[1]), parts[0])
+
+
+def _file_type_char(mode):
+    """Return the rsync itemize file type for a file *mode*."""
+    if stat.S_ISREG(mode):
+        return 'f'
+    if stat.S_ISDIR(mode):
+        return 'd'
+    if stat.S_ISLNK(mode):
+        return 'L'
+    if stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+        return 'D'
+    # sockets and fifos
+    return 'S'
+
+
+def _attr_changes(src_st, dest_st, transfer=False, checksum=False):
+    """Return 9 attribute letters "cstpoguax" of rsync itemized output
+    for the changes from *dest_st* to *src_st*.
+
+    If there are no changes, an empty string is returned.
+    *transfer* means that the file contents will be updated,
+    *checksum* that the contents differ for the same size.
+    """
+    # owner and group are not synchronized (--no-owner --no-group),
+    # access times, ACLs and extended attributes are not preserved.
+    size = '.'
+    if transfer and src_st.st_size != dest_st.st_size:
+        size = 's'
+    mtime = 't' if src_st.st_mtime_ns != dest_st.st_mtime_ns else '.'
+    perms = '.'
+    if stat.S_IMODE(src_st.st_mode) != stat.S_IMODE(dest_st.st_mode):
+        perms = 'p'
+    if not transfer and mtime == '.' and perms == '.':
+        return ""
+    return ('c' if checksum else '.') + size + mtime + perms + "....."
+
+
+def _dirty_tree(paths):
+    """Return a tree of *paths* (relative, separated by slashes)
+    as nested dictionaries of names.
+    """
+    tree = {}
+    for path in paths:
+        node = tree
+        for name in path.strip('/').split('/'):
+            if name:
+                node = node.setdefault(name, {})
+    return tree
+
+
+def _native_changes(src, dest, rsync_filter=None, update=True, errors=None,
+                    hash_cache=None, dirty=None):
+    """Compare directory trees *src* and *dest*
+    and yield a :class:`_Change` for each path that differs.
+
+    This is what *rsync -aun --delete -i src/ dest* would print,
+    but files that are hard links to the same inode
+    are skipped without even calling *stat* for them.
+    If *update* is ``True``, files newer at *dest* are skipped.
+    *rsync_filter* is an :class:`_RsyncFilter`
+    (excluded files are neither compared nor deleted).
+    If a :class:`_HashCache` *hash_cache* is given,
+    regular files of the same size are compared by contents,
+    as with *rsync --checksum*.
+    If a tree of *dirty* paths is given (see :func:`_dirty_tree`),
+    only they are compared (and new directories).
+
+    Directories that could not be read are printed to stderr
+    and appended to the list *errors* (if that is provided).
+    """
+    if errors is None:
+        errors = []
+    src_st = os.lstat(src)
+    dest_st = os.lstat(dest)
+    attrs = _attr_changes(src_st, dest_st)
+    if attrs:
+        yield _Change(".d" + attrs, "./", src_st, dest_st, None)
+    yield from _native_changes_dir(
+        src, dest, "", src_st.st_dev == dest_st.st_dev,
+        rsync_filter, update, errors, hash_cache, dirty
+    )
+
+
+def _native_scandir(path, relpath, rsync_filter, errors):
+    """Return a dictionary of not excluded directory entries
+    or ``None`` if *path* could not be read.
+    """
+    entries = {}
+    try:
+        with os.scandir(path) as dir_entries:
+            for entry in dir_entries:
+                if rsync_filter is not None:
+                    # is_dir doesn't call stat on most file systems
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if rsync_filter.excluded(relpath + entry.name, is_dir):
+                        continue
+                entries[entry.name] = entry
+    except OSError as err:
+        # the same message as from rsync
+        _print_error('opendir "{}" failed: {} ({})'
+                     .format(path, err.strerror, err.errno))
+        errors.append(err)
+        return None
+    return entries
+
+
+def _native_deleted(dest, relpath, dest_entry, rsync_filter, errors):
+    """Yield deletions for *dest_entry* and its contents."""
+    if dest_entry.is_dir(follow_symlinks=False):
+        path = relpath + dest_entry.name + '/'
+        entries = _native_scandir(dest_entry.path, path, rsync_filter, errors)
+        for name in sorted(entries or ()):
+            yield from _native_deleted(dest, path, entries[name],
+                                       rsync_filter, errors)
+    else:
+        path = relpath + dest_entry.name
+    yield _Change("*deleting", path, None, None, None)
+
+
+def _native_changes_dir(src, dest, relpath, same_dev,
+                        rsync_filter, update, errors, hash_cache=None,
+                        dirty=None):
+    # relpath is empty or ends with a slash.
+    # dirty is None or a tree of names to compare
+    src_entries = _native_scandir(src, relpath, rsync_filter, errors)
+    if src_entries is None:
+        # rsync skips deletion after an I/O error
+        return
+    if dest is None:
+        dest_entries = {}
+    else:
+        dest_entries = _native_scandir(dest, relpath, rsync_filter, errors)
+        if dest_entries is None:
+            dest_entries = {}
+
+    # deletions go first, as with rsync --delete-during
+    for name in sorted(dest_entries):
+        if name not in src_entries and (dirty is None or name in dirty):
+            yield from _native_deleted(dest, relpath, dest_entries[name],
+                                       rsync_filter, errors)
+
+    # (src subdirectory, dest subdirectory, same device, relative path,
+    #  dirty subtree)
+    subdirs = []
+    for name in sorted(src_entries):
+        if dirty is not None and name not in dirty:
+            continue
+        src_entry = src_entries[name]
+        dest_entry = dest_entries.get(name)
+        path = relpath + name
+        if (dest_entry is not None and same_dev
+                and src_entry.inode() == dest_entry.inode()):
+            # a hard link to the same file (or the same directory).
+            # inode() is read from the directory, no stat is needed.
+            continue
+
+        try:
+            src_st = src_entry.stat(follow_symlinks=False)
+            dest_st = None
+            if dest_entry is not None:
+                dest_st = dest_entry.stat(follow_symlinks=False)
+        except OSError as err:
+            # the file vanished during the scan
+            _print_error('stat "{}" failed: {}'.format(path, err.strerror))
+            errors.append(err)
+            continue
+
+        src_type = _file_type_char(src_st.st_mode)
+        if dest_st is not None:
+            dest_type = _file_type_char(dest_st.st_mode)
+            if dest_type != src_type:
+                yield from _native_deleted(dest, relpath, dest_entry,
+                                           rsync_filter, errors)
+                dest_st = None
+
+        if src_type == 'd':
+            if dest_st is None:
+                yield _Change("cd+++++++++", path + '/', src_st, None, None)
+                subdirs.append((src_entry.path, None, False, path + '/',
+                                None))
+                continue
+            attrs = _attr_changes(src_st, dest_st)
+            if attrs:
+                yield _Change(".d" + attrs, path + '/', src_st, dest_st, None)
+            sub_dirty = None if dirty is None else dirty[name]
+            if sub_dirty == {}:
+                # nothing has changed inside
+                continue
+            subdirs.append((src_entry.path, dest_entry.path,
+                            src_st.st_dev == dest_st.st_dev, path + '/',
+                            sub_dirty))
+            continue
+
+        if src_type == 'L':
+            link = os.readlink(src_entry.path)
+            if dest_st is None:
+                yield _Change("cL+++++++++", path, src_st, None, link)
+            elif os.readlink(dest_entry.path) != link:
+                yield _Change("cLc........", path, src_st, dest_st, link)
+            continue
+
+        if dest_st is None:
+            prefix = ">f" if src_type == 'f' else 'c' + src_type
+            yield _Change(prefix + "+++++++++", path, src_st, None, None)
+            continue
+
+        if (update and src_type == 'f'
+                and dest_st.st_mtime_ns > src_st.st_mtime_ns):
+            # --update skips files that are newer on the receiver
+            continue
+        checksum = False
+        if hash_cache is None or src_type != 'f':
+            transfer = (src_st.st_size != dest_st.st_size
+                        or src_st.st_mtime_ns != dest_st.st_mtime_ns)
+        elif src_st.st_size != dest_st.st_size:
+            transfer = True
+        else:
+            # modification times are ignored, as with rsync --checksum
+            try:
+                checksum = (hash_cache.get(src_entry.path, src_st)
+                            != hash_cache.get(dest_entry.path, dest_st))
+            except OSError as err:
+                _native_error("read", path, err, errors)
+                continue
+            transfer = checksum
+        attrs = _attr_changes(src_st, dest_st, transfer=transfer,
+                              checksum=checksum)
+        if transfer:
+            yield _Change('>' + src_type + attrs, path, src_st, dest_st, None)
+        elif attrs:
+            yield _Change('.' + src_type + attrs, path, src_st, dest_st, None)
+
+    for src_dir, dest_dir, sub_same_dev, path, sub_dirty in subdirs:
+        yield from _native_changes_dir(src_dir, dest_dir, path, sub_same_dev,
+                                       rsync_filter, update, errors,
+                                       hash_cache, sub_dirty)
+
+
+def _native_snapshot(src, dest, rsync_filter=None, jobs=None, errors=None,
+                     resume=False):
+    """Create a copy of the directory *src* at *dest*
+    with all files hard linked.
+
+    This is what *rsync -a --link-dest src/ dest* does for a new *dest*.
+    Directories are read in parallel by *jobs* threads
+    (the default is that of :class:`concurrent.futures.ThreadPoolExecutor`).
+    Directory permissions and modification times are copied
+    after all their contents were created.
+    Files that can't be hard linked (on a different file system)
+    are copied. Special files (sockets, FIFOs and devices)
+    are hard linked as well, since *rsync -a* keeps them;
+    those on a different file system are errors.
+
+    If *resume* is ``True``, *dest* is a partially created copy.
+    Its hard links to the same files are kept,
+    other files are replaced, and files missing in *src* are removed
+    (as with *rsync --delete*).
+
+    Errors are printed to stderr and appended to the list *errors*
+    (if that is provided).
+    """
+    if errors is None:
+        errors = []
+
+    def link_dir(src_dir, dest_dir, relpath, existing):
+        # return the list of subdirectories to process
+        entries = _native_scandir(src_dir, relpath, rsync_filter, errors)
+        if entries is None:
+            return []
+        dest_entries = {}
+        if existing:
+            dest_entries = _native_scandir(dest_dir, relpath, None, errors)
+            if dest_entries is None:
+                return []
+            for name in sorted(set(dest_entries) - set(entries)):
+                try:
+                    _native_remove(dest_entries[name])
+                except OSError as err:
+                    _native_error("remove", relpath + name, err, errors)
+
+        subdirs = []
+        for name in sorted(entries):
+            entry = entries[name]
+            dest_path = os.path.join(dest_dir, name)
+            dest_entry = dest_entries.get(name)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if dest_entry is not None:
+                        if dest_entry.is_dir(follow_symlinks=False):
+                            subdirs.append((entry.path, dest_path,
+                                            relpath + name + '/', True))
+                            continue
+                        _native_remove(dest_entry)
+                    os.mkdir(dest_path)
+                    subdirs.append((entry.path, dest_path,
+                                    relpath + name + '/', False))
+                else:
+                    # regular, special files and symbolic links
+                    if dest_entry is not None:
+                        # inode is cached in the directory entry
+                        if (dest_entry.inode() == entry.inode()
+                                and not dest_entry.is_dir(
+                                    follow_symlinks=False
+                                )):
+                            continue
+                        _native_remove(dest_entry)
+                    _native_link(entry.path, dest_path)
+            except OSError as err:
+                _native_error("link", relpath + name, err, errors)
+        return subdirs
+
+    if resume:
+        if not os.path.isdir(dest):
+            raise NotADirectoryError(dest)
+    else:
+        os.mkdir(dest)
+    # directories are created before their contents are read,
+    # so that workers don't wait for each other
+    dirs = [(src, dest)]
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        pending = {executor.submit(link_dir, src, dest, "", resume)}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                for src_dir, dest_dir, relpath, existing in future.result():
+                    dirs.append((src_dir, dest_dir))
+                    pending.add(executor.submit(link_dir, src_dir, dest_dir,
+                                                relpath, existing))
+
+    # creating files changes modification times of directories
+    import shutil
+    for src_dir, dest_dir in dirs:
+        try:
+            shutil.copystat(src_dir, dest_dir)
+            if os.geteuid() == 0:
+                # rsync -a preserves owners only for the super-user
+                src_st = os.stat(src_dir)
+                os.chown(dest_dir, src_st.st_uid, src_st.st_gid)
+        except OSError as err:
+            _native_error("set attributes of", dest_dir, err, errors)
+
+
+def _file_hash(path):
+    """Return the BLAKE2 hash (a hex string) of the file contents."""
+    import hashlib
+    import mmap
+    hash_ = hashlib.blake2b()
+    with open(path, "rb") as fil:
+        # an empty file can't be mapped
+        if os.fstat(fil.fileno()).st_size:
+            # no copies into Python buffers
+            with mmap.mmap(fil.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                hash_.update(data)
+    return hash_.hexdigest()
+
+
+def _file_hash_result(path):
+    # exceptions in a process pool would stop the iteration
+    try:
+        return (_file_hash(path), None)
+    except OSError as err:
+        return (None, err)
+
+
+def _scan_files(root, rsync_filter=None, errors=None):
+    """Yield pairs *(path, stat)* for regular files under *root*.
+
+    Files and directories excluded by *rsync_filter*
+    (an :class:`_RsyncFilter`) are skipped.
+    """
+    if errors is None:
+        errors = []
+    # (path, relative path)
+    dirs = [(root, "")]
+    while dirs:
+        dir_path, relpath = dirs.pop()
+        entries = _native_scandir(dir_path, relpath, rsync_filter, errors)
+        for name in sorted(entries or ()):
+            entry = entries[name]
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append((entry.path, relpath + name + '/'))
+            elif entry.is_file(follow_symlinks=False):
+                try:
+                    yield (entry.path, entry.stat(follow_symlinks=False))
+                except FileNotFoundError:
+                    pass
+
+
+def _checksum_candidates(src, dest, rsync_filter=None, errors=None):
+    """Yield pairs *(path, stat)* for regular files under *src*
+    and *dest* that have the same relative path and size,
+    but are not hard links.
+
+    These are files that *rsync --checksum* would compare by contents.
+    """
+    for src_path, src_st in _scan_files(src, rsync_filter, errors):
+        dest_path = os.path.join(dest, os.path.relpath(src_path, src))
+        try:
+            dest_st = os.lstat(dest_path)
+        except OSError:
+            # a new file or a missing directory
+            continue
+        if (stat.S_ISREG(dest_st.st_mode)
+                and dest_st.st_size == src_st.st_size
+                and (dest_st.st_dev, dest_st.st_ino)
+                    != (src_st.st_dev, src_st.st_ino)):
+            yield (src_path, src_st)
+            yield (dest_path, dest_st)
+
+
+def _commit_stats(commit_dir, previous_dir=None, previous_stats=None,
+                  errors=None):
+    """Return statistics of regular files in *commit_dir*.
+
+    The result is a dictionary with the numbers of "files" and "bytes"
+    and of "new_files" and "new_bytes" (not hard linked
+    from the commit *previous_dir*, if that is given).
+    If *previous_stats* of *previous_dir* are given,
+    only the difference between the commits is read.
+    """
+    if errors is None:
+        errors = []
+    stats = {"files": 0, "bytes": 0, "new_files": 0, "new_bytes": 0}
+    if previous_stats is None:
+        for _, file_st in _scan_files(commit_dir, errors=errors):
+            stats["files"] += 1
+            stats["bytes"] += file_st.st_size
+        if previous_dir is None:
+            stats["new_files"] = stats["files"]
+            stats["new_bytes"] = stats["bytes"]
+            return stats
+    else:
+        stats["files"] = previous_stats["files"]
+        stats["bytes"] = previous_stats["bytes"]
+
+    # unchanged files are hard links, they are skipped
+    for change in _native_changes(commit_dir, previous_dir, update=False,
+                                  errors=errors):
+        if change.flags.startswith('*'):
+            if previous_stats is None or change.path.endswith('/'):
+                continue
+            try:
+                old_st = os.lstat(os.path.join(previous_dir, change.path))
+            except OSError as err:
+                _native_error("stat", change.path, err, errors)
+                continue
+            if stat.S_ISREG(old_st.st_mode):
+                stats["files"] -= 1
+                stats["bytes"] -= old_st.st_size
+            continue
+        if not change.flags.startswith(">f"):
+            # attributes and other file types
+            continue
+        stats["new_files"] += 1
+        stats["new_bytes"] += change.src_stat.st_size
+        if previous_stats is not None:
+            if change.dest_stat is None:
+                stats["files"] += 1
+                stats["bytes"] += change.src_stat.st_size
+            else:
+                stats["bytes"] += (change.src_stat.st_size
+                                   - change.dest_stat.st_size)
+    return stats
+
+
+def _format_commit_stats(stats):
+    """Return a line with commit statistics (see *_commit_stats*)."""
+    return "{:,} files, {:,} bytes ({:,} new files, {:,} bytes)".format(
+        stats.get("files", 0), stats.get("bytes", 0),
+        stats.get("new_files", 0), stats.get("new_bytes", 0)
+    )
+
+
+def _remove_trees(paths, jobs=None, errors=None, progress=None):
+    """Remove files or directory trees at *paths*.
+
+    Directories are read and their files removed
+    by *jobs* parallel threads, empty directories are removed
+    at the end (the deepest first).
+    Files that were already removed are ignored.
+    Other errors are printed to stderr and appended to the list *errors*.
+
+    *progress(nfiles)* is called in the calling thread
+    after each directory was processed.
+    Return the number of removed files.
+    """
+    if errors is None:
+        errors = []
+
+    def remove_dir(path):
+        # return (subdirectories, number of removed files)
+        subdirs = []
+        nfiles = 0
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        else:
+                            os.unlink(entry.path)
+                            nfiles += 1
+                    except FileNotFoundError:
+                        pass
+                    except OSError as err:
+                        _native_error("remove", entry.path, err, errors)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            _native_error("opendir", path, err, errors)
+        return (subdirs, nfiles)
+
+    nfiles = 0
+    # (depth, path)
+    dirs = []
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        pending = {}
+        for path in paths:
+            if os.path.isdir(path) and not os.path.islink(path):
+                pending[executor.submit(remove_dir, path)] = (0, path)
+            else:
+                try:
+                    os.unlink(path)
+                    nfiles += 1
+                except FileNotFoundError:
+                    pass
+                except OSError as err:
+                    _native_error("remove", path, err, errors)
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                depth, path = pending.pop(future)
+                dirs.append((depth, path))
+                subdirs, dir_nfiles = future.result()
+                nfiles += dir_nfiles
+                for subdir in subdirs:
+                    pending[executor.submit(remove_dir, subdir)] = \
+                        (depth + 1, subdir)
+                if progress is not None:
+                    progress(nfiles)
+
+    for _, path in sorted(dirs, reverse=True):
+        try:
+            os.rmdir(path)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            _native_error("remove", path, err, errors)
+    return nfiles
+
+
+def _ordered_map(func, items, jobs=None):
+    """Yield *func(item)* for *items* in their order.
+
+    Results are computed by *jobs* threads
+    at most *2 * jobs* items ahead of the yielded one,
+    so that only a few of them are kept in memory.
+    """
+    import concurrent.futures
+    if jobs is None:
+        # the default of ThreadPoolExecutor
+        jobs = min(32, (os.cpu_count() or 1) + 4)
+    items = iter(items)
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) == 2 * jobs:
+                break
+        while pending:
+            result = pending.popleft().result()
+            for item in items:
+                pending.append(executor.submit(func, item))
+                break
+            yield result
+
+
+def _native_error(action, path, err, errors):
+    _print_error('{} "{}" failed: {} ({})'
+                 .format(action, path, err.strerror, err.errno))
+    errors.append(err)
+
+
+def _native_link(src, dest):
+    """Hard link *src* to *dest* or copy it to another file system."""
+    try:
+        # a symbolic link itself is linked
+        os.link(src, dest, follow_symlinks=False)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        mode = os.lstat(src).st_mode
+        if not (stat.S_ISREG(mode) or stat.S_ISLNK(mode)):
+            # special files can't be copied
+            raise
+        import shutil
+        shutil.copy2(src, dest, follow_symlinks=False)
+
+
+def _native_remove(entry):
+    """Remove a directory entry (recursively for a directory)."""
+    if entry.is_dir(follow_symlinks=False):
+        import shutil
+        shutil.rmtree(entry.path)
+    else:
+        os.remove(entry.path)
+
+
 ####################
 ## Helper classes ##
 ####################
@@ -411,296 +1210,579 @@ def update(self, other):
                 new.add(sync_str)
 
 
-class YARsync():
-    """Synchronize data. Provide configuration and wrap rsync calls."""
+class _Change(collections.namedtuple(
+        "_Change", ["flags", "path", "src_stat", "dest_stat", "link"])):
+    """A changed path found by the native engine.
 
-    def __init__(self, argv):
-        """*argv* is the list of command line arguments."""
+    *flags* are the same as in rsync itemized output
+    (for example, ">f.st......"). *path* is relative to the root
+    and has a trailing slash for directories.
+    *src_stat* and *dest_stat* can be ``None``
+    for created or deleted files.
+    *link* is a symbolic link target or ``None``.
+    """
 
-        parser = argparse.ArgumentParser(
-            description="yarsync is a file synchronization and backup tool",
-            # exit_on_error appeared only in Python 3.9
-            # and doesn't seem to work. Skip and be more cross-platform.
-            # exit_on_error=False
-        )
-        # failed to implement that with ArgumentError
-        # parser = _ErrorCatchingArgumentParser(...)
-        subparsers = parser.add_subparsers(
-            title="Available commands",
-            dest="command_name",
-            # description="valid commands",
-            help="type 'yarsync <command> --help' for additional help",
-            # or it will print a list of commands in curly braces.
-            metavar="command",
-        )
+    __slots__ = ()
 
-        ###################################
-        ## Initialize optional arguments ##
-        ###################################
-        # .ys directory
-        parser.add_argument("--config-dir", default="",
-                            help="path to the configuration directory")
-        parser.add_argument("--root-dir", default="",
-                            help="path to the root of the working directory")
+    def itemize(self):
+        """Return a line of *rsync --itemize-changes* (as bytes)."""
+        line = "{:<11} {}".format(self.flags, self.path)
+        if self.link is not None:
+            line += " -> " + self.link
+        return os.fsencode(line) + b'\n'
 
-        # this option is applied not to all commands.
-        # Moreover, we can't write "yarsync -n 2 log" =>
-        # don't create an illusion
-        # that we can put an option at any place.
-        # However, the upside of leaving it here might be
-        # its better visibility during the general help
-        # (not for a subcommand).
-        # parser.add_argument(
-        #     "-n", "--dry-run", action="store_true",
-        #     default=False,
-        #     help="print what would be transferred during a real run, "
-        #          "but do not make any changes"
-        # )
 
-        verbose_group = parser.add_mutually_exclusive_group()
-        verbose_group.add_argument("-q", "--quiet",
-                                   action="count",
-                                   # otherwise default will be None
-                                   default=0,
-                                   help="decrease verbosity")
-        verbose_group.add_argument("-v", "--verbose",
-                                   action="count",
-                                   default=0,
-                                   help="increase verbosity")
+class _DiffStat():
+    """Numbers of added, removed and modified files
+    and the change of their sizes for each directory
+    in the difference from *old_dir* to *new_dir*.
 
-        # this is not an option, but more like a separate command
-        parser.add_argument("--version", "-V", action="store_true",
-                            help="print version")
+    Files are counted in their parent directories
+    up to *depth* levels from the root ("./").
+    """
 
-        ############################
-        ## Initialize subcommands ##
-        ############################
-        # or sub-commands
+    def __init__(self, old_dir, new_dir, depth=1):
+        self.old_dir = old_dir
+        self.new_dir = new_dir
+        self.depth = depth
+        # {directory: [added, removed, modified, bytes]}
+        self.dirs = {}
 
-        # checkout #
-        parser_checkout = subparsers.add_parser(
-            "checkout",
-            # help="check out a commit"
-            help="restore the working directory to a commit"
-        )
-        parser_checkout.add_argument(
-            "-n", "--dry-run", action="store_true",
-            default=False,
-            help="print what will be transferred during a real checkout, "
-                 "but don't make any changes"
-        )
-        # we write metavars <var> as in git,
-        # to distinguish them from rsync VAR.
-        parser_checkout.add_argument(
-            "commit", metavar="<commit>", help="commit name"
-        )
-        parser_checkout.set_defaults(func=self._checkout)
+    def add(self, change):
+        """Count a Change (directories and attributes are skipped)."""
+        flags, path = change.flags, change.path
+        if path.endswith('/'):
+            # directories are counted by their files
+            return
+        if flags.startswith('*'):
+            ind = 1
+            delta = -self._size(self.old_dir, path)
+        elif set(flags[2:]) == {'+'}:
+            ind = 0
+            delta = self._size(self.new_dir, path)
+        elif flags[0] in ">c":
+            ind = 2
+            delta = (self._size(self.new_dir, path)
+                     - self._size(self.old_dir, path))
+        else:
+            return
+        parts = path.split('/')[:-1][:self.depth]
+        directory = '/'.join(parts) + '/' if parts else "./"
+        totals = self.dirs.setdefault(directory, [0, 0, 0, 0])
+        totals[ind] += 1
+        totals[3] += delta
+
+    def total(self):
+        """Return the list *[added, removed, modified, bytes]*
+        for all directories.
+        """
+        return [sum(column) for column in zip([0, 0, 0, 0],
+                                              *self.dirs.values())]
 
-        # clone #
-        parser_clone = subparsers.add_parser(
-            "clone",
-            help="clone a local repository to remote or otherwise"
-        )
-        parser_clone.add_argument(
-            "name", metavar="<name>",
-            help="name of the clone",
-        )
-        parser_clone.add_argument(
-            "path", metavar="<path|parent path>",
-            help="path to the origin (from) "
-                 "or to the parent directory of the clone (to)"
-        )
-        parser_clone.add_argument(
-            "-f", "--force", action="store_true",
-            help="ignore remote rsync-filter (only for pull)"
-        )
+    @staticmethod
+    def _size(root, path):
+        try:
+            return os.lstat(os.path.join(root, path)).st_size
+        except OSError:
+            # the commit was removed during the comparison
+            return 0
 
-        # commit #
-        parser_commit = subparsers.add_parser(
-            "commit", help="commit the working directory"
-        )
-        parser_commit.add_argument(
-            "-m", "--message", metavar="<message>", default="",
-            help="a string with the commit message"
-        )
-        parser_commit.add_argument(
-            "--limit", metavar="<number>", type=_check_positive,
-            help="maximum number of commits"
-        )
 
-        # diff #
-        parser_diff = subparsers.add_parser(
-            "diff", help="print the difference between two commits"
-        )
-        parser_diff.add_argument(
-            "commit", metavar="<commit>", help="commit name"
-        )
-        parser_diff.add_argument(
-            "other_commit", metavar="<commit>", nargs="?", default=None,
-            help="other commit name"
-        )
-        parser_diff.set_defaults(func=self._diff)
+class _HashCache():
+    """Persistent cache of file content hashes.
 
-        # init #
-        parser_init = subparsers.add_parser("init",
-                                            help="initialize a repository")
-        # add this option into the new release after improved testing.
-        # parser_init.add_argument(
-        #     "--merge", action="store_true", help="merge existing repositories"
-        # )
-        # reponame is used during commits
-        parser_init.add_argument(
-            "reponame", nargs="?", metavar="<reponame>",
-            help="name of the repository (for commits and logs)"
-        )
+    Hashes are stored for file identities
+    *(device, inode, size, modification time)*,
+    so that hard links are hashed once,
+    and changed files are hashed again.
+    A changed status change time also means a rewrite
+    (with the modification time restored),
+    unless the number of links changed as well
+    (new commits link files).
+    """
 
-        # log #
-        parser_log = subparsers.add_parser(
-            "log", help="print commit logs"
-        )
-        parser_log.add_argument(
-            "-n", "--max-count", metavar="<number>",
-            type=int, default=-1,
-            help="maximum number of logs shown"
-        )
-        parser_log.add_argument("-r", "--reverse", action="store_true",
-                                help="reverse the order of the output")
-        parser_log.set_defaults(func=self._log)
-        # todo: log <commit_number>
+    VERSION = 3
+    # fewer files are hashed without a process pool
+    POOL_MIN_FILES = 16
 
-        # pull #
-        parser_pull = subparsers.add_parser(
-            "pull", help="fetch data from source"
-        )
+    def __init__(self, cache_file, rehash=False):
+        """If *rehash* is ``True``, cached hashes are not trusted
+        and all files are hashed again.
+        """
+        self.cache_file = cache_file
+        # "dev:ino": [size, mtime_ns, ctime_ns, nlink, hash]
+        self._hashes = {}
+        self._changed = False
+        # keys of hashes computed by this process
+        self._fresh = set() if rehash else None
+        # hashes can be computed in several threads
+        self._lock = threading.Lock()
+        try:
+            with open(cache_file) as fil:
+                data = json.load(fil)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == self.VERSION:
+            self._hashes = data["hashes"]
+
+    def _set(self, st, digest):
+        key = "{}:{}".format(st.st_dev, st.st_ino)
+        with self._lock:
+            self._hashes[key] = [st.st_size, st.st_mtime_ns,
+                                 st.st_ctime_ns, st.st_nlink, digest]
+            if self._fresh is not None:
+                self._fresh.add(key)
+            self._changed = True
+
+    def get(self, path, st):
+        """Return the hash of the file at *path* with stat *st*."""
+        digest = self.lookup(st)
+        if digest is None:
+            digest = _file_hash(path)
+            self._set(st, digest)
+        return digest
+
+    def lookup(self, st):
+        """Return the cached hash for a file with stat *st* or ``None``."""
+        key = "{}:{}".format(st.st_dev, st.st_ino)
+        if self._fresh is not None and key not in self._fresh:
+            return None
+        value = self._hashes.get(key)
+        if value is None or value[:2] != [st.st_size, st.st_mtime_ns]:
+            return None
+        ctime_ns, nlink, digest = value[2:]
+        if st.st_ctime_ns != ctime_ns:
+            if st.st_nlink == nlink:
+                return None
+            # linked or unlinked
+            self._set(st, digest)
+        return digest
+
+    def update(self, files, jobs=None):
+        """Hash *files* (pairs *(path, stat)*) missing in the cache.
+
+        Files are hashed in a pool of *jobs* processes.
+        Return a list of pairs *(path, error)* for files
+        that could not be read.
+        """
+        missing = {}
+        for path, st in files:
+            if self.lookup(st) is None:
+                missing.setdefault((st.st_dev, st.st_ino), (path, st))
+        missing = list(missing.values())
+        paths = [path for path, _ in missing]
+
+        import concurrent.futures
+        executor = None
+        if len(missing) >= self.POOL_MIN_FILES:
+            try:
+                executor = concurrent.futures.ProcessPoolExecutor(jobs)
+            except (OSError, NotImplementedError):
+                # no multiprocessing on this system
+                executor = concurrent.futures.ThreadPoolExecutor(jobs)
+        errors = []
+        try:
+            if executor is None:
+                results = map(_file_hash_result, paths)
+            else:
+                results = executor.map(_file_hash_result, paths, chunksize=8)
+            # results are stored as they come,
+            # so that they are kept if interrupted
+            for (path, st), (digest, err) in zip(missing, results):
+                if err is None:
+                    self._set(st, digest)
+                else:
+                    errors.append((path, err))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return errors
 
-        # mutually exclusive arguments
-        pull_group = parser_pull.add_mutually_exclusive_group()
-        force_help = "remove commits and logs missing on source"
-        pull_group.add_argument(
-            "-f", "--force", action="store_true",
-            help=force_help
-        )
-        pull_group.add_argument(
-            "--new", action="store_true",
-            help="do not remove local data that is missing on source"
-        )
-        pull_group.add_argument(
-            "-b", "--backup", action="store_true",
-            help="changed local files are renamed (not overwritten or ignored)"
-        )
-        pull_group.add_argument(
-            "--backup-dir", default="", metavar="DIR",
-            help="changed local files are put into DIR preserving their paths"
-        )
+    def save(self):
+        """Write the cache if it was changed. Errors are ignored."""
+        if not self._changed:
+            return
+        cache_tmp = self.cache_file + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(cache_tmp, "w") as fil:
+                json.dump({"version": self.VERSION, "hashes": self._hashes},
+                          fil)
+            os.replace(cache_tmp, self.cache_file)
+        except OSError:
+            return
+        self._changed = False
 
-        parser_pull.add_argument("source", metavar="<source>",
-                                 help="source name")
 
-        # push #
-        parser_push = subparsers.add_parser(
-            "push", help="send data to a destination"
-        )
-        parser_push.add_argument(
-            "-f", "--force", action="store_true",
-            help=force_help
-        )
-        # we don't allow pushing new files to remote,
-        # because that could cause its inconsistent state
-        # (while locally we merge new files manually)
-        parser_push.add_argument(
-            "destination", metavar="<destination>",
-            help="destination name"
-        )
+class _Index():
+    """Persistent cache of the configuration directory contents.
 
-        # common pull and push options
-        for pparser in (parser_pull, parser_push):
-            pparser.add_argument(
-                "-n", "--dry-run", action="store_true",
-                default=False,
-                help="print what would be transferred during a real run, "
-                     "but do not make any change"
-            )
-            # pparser.add_argument(
-            #     # not sure whether -o would be a good shortening
-            #     # (-o might go for options)
-            #     "--overwrite", action="store_true",
-            #     default=False,
-            #     help="propagate file changes"
-            # )
+    Directory listings (of the configuration directory, commits,
+    logs and synchronization) and small files (HEAD, merge state
+    and commit limit) are stored together with their inodes
+    and modification times. When they change, only stale entries
+    are read again.
+    """
 
-        # remote #
-        parser_remote = subparsers.add_parser(
-            "remote", help="manage remote repositories"
-        )
-        # this is a different option from "yarsync -v" here.
-        parser_remote.add_argument(
-            "-v", "--verbose",
-            action="store_true",
-            # action="count",
-            help="print repository paths"
-        )
-        subparsers_remote = parser_remote.add_subparsers(
-            title="remote commands",
-            dest="remote_command",
-            help="type 'yarsync remote <command> --help' for additional help",
-            metavar="<command>",
-        )
+    # Changes closer than that to the time of reading could be missed
+    # on file systems with a coarse time resolution,
+    # therefore such entries are not stored.
+    RACY_NS = 2 * 10**9
+    VERSION = 1
+
+    def __init__(self, index_file, config_dir):
+        self.index_file = index_file
+        self._config_dir = config_dir
+        # relative path: {"key": [inode, mtime_ns, size], "value": ...}
+        self._entries = {}
+        self._changed = False
+        try:
+            with open(index_file) as fil:
+                data = json.load(fil)
+        except (OSError, ValueError):
+            # missing or corrupt index is rebuilt
+            return
+        if data.get("version") == self.VERSION:
+            self._entries = data["entries"]
+
+    def _get(self, path, read):
+        # raises FileNotFoundError (as os.listdir and open would)
+        st = os.stat(path)
+        key = [st.st_ino, st.st_mtime_ns, st.st_size]
+        name = os.path.relpath(path, self._config_dir)
+        entry = self._entries.get(name)
+        if entry is not None and entry["key"] == key:
+            return entry["value"]
+
+        value = read(path)
+        now = int(time.time() * 10**9)
+        if now - st.st_mtime_ns > self.RACY_NS:
+            self._entries[name] = {"key": key, "value": value}
+            self._changed = True
+        elif entry is not None:
+            del self._entries[name]
+            self._changed = True
+        return value
+
+    def listdir(self, path):
+        """Return the list of files in the directory *path*."""
+        return self._get(path, os.listdir)
+
+    def read(self, path):
+        """Return the contents of a small text file at *path*."""
+        def read_file(path):
+            with open(path) as fil:
+                return fil.read()
+        return self._get(path, read_file)
+
+    def save(self):
+        """Write the index if it was changed.
+
+        Errors are ignored: the index is only a cache.
+        """
+        if not self._changed:
+            return
+        index_tmp = self.index_file + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+            with open(index_tmp, "w") as fil:
+                json.dump({"version": self.VERSION, "entries": self._entries},
+                          fil)
+            # atomic on POSIX
+            os.replace(index_tmp, self.index_file)
+        except OSError:
+            return
+        self._changed = False
+
+
+class _Inotify():
+    """Linux inotify, called through ctypes."""
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_EXCL_UNLINK = 0x04000000
+    IN_ISDIR = 0x40000000
+
+    def __init__(self):
+        import ctypes
+        self._ctypes = ctypes
+        # symbols of the C library are available in the interpreter
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._call(self._libc.inotify_init1, os.O_CLOEXEC)
+
+    def _call(self, func, *args, path=None):
+        result = func(*args)
+        if result < 0:
+            err = self._ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return result
+
+    def add_watch(self, path, mask):
+        """Watch *path* for events in *mask*
+        and return the watch descriptor.
+        """
+        return self._call(self._libc.inotify_add_watch, self.fd,
+                          os.fsencode(path), mask, path=path)
 
-        # parse_intermixed_args is missing in Python 2,
-        # that's why we allow -v flag only after 'remote'.
-        #
-        # remote_parent_parser = argparse.ArgumentParser(add_help=False)
-        # remote_parent_parser.add_argument(
-        #     "-v", "--verbose", action="count",
-        #     help="show remote paths. Insert after a remote command"
-        # )
-        ## remote add
-        parser_remote_add = subparsers_remote.add_parser(
-            "add", help="add a remote"
-        )
-        parser_remote_add.add_argument(
-            "repository", metavar="<repository>",
-            help="repository name",
-        )
-        parser_remote_add.add_argument(
-            "path", metavar="<path>", help="repository path",
-        )
-        # not used yet.
-        # parser_remote_add.add_argument(
-        #     "options", nargs='*', help="repository options",
-        # )
-        ## remote rm
-        parser_remote_rm = subparsers_remote.add_parser(
-            "rm", help="remove a remote"
-        )
-        parser_remote_rm.add_argument(
-            "repository", metavar="<repository>",
-            help="repository name",
-        )
+    def rm_watch(self, wd):
+        # the watch may be already removed with its directory
+        self._libc.inotify_rm_watch(self.fd, wd)
 
-        for remote_subparser in [parser_remote_add, parser_remote_rm]:
-            remote_subparser.set_defaults(func=self._remote)
+    def read(self):
+        """Wait for events and return a list of them
+        as tuples *(wd, mask, cookie, name)*.
+        """
+        import struct
+        data = os.read(self.fd, 2**16)
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, pos)
+            pos += 16
+            name = data[pos:pos+length].rstrip(b'\0')
+            pos += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Warm():
+    """State kept between commands by *yarsync serve*.
+
+    Indices of configuration directories stay in memory,
+    configurations are parsed again only when their text
+    or the environment (used in substitutions) change,
+    and other files are loaded again when their inode,
+    modification time or size change.
+    """
 
-        ## remote show, default
-        parser_remote_show = subparsers_remote.add_parser(
-            "show", help="print remotes"
-        )
-        parser_remote_show.set_defaults(func=self._remote_show)
+    def __init__(self):
+        self._configs = {}
+        self._files = {}
+        self._indices = {}
 
-        # show #
-        parser_show = subparsers.add_parser(
-            "show", help="print log messages and actual changes for commit(s)"
-        )
-        parser_show.add_argument(
-            "commit", nargs="+", metavar="<commit>", help="commit name"
-        )
-        parser_show.set_defaults(func=self._show)
+    def config(self, config_file, config_text, read_config):
+        """Return *read_config(config_text)*,
+        reusing the result for the same *config_file*
+        while its text and the environment are unchanged.
+        """
+        key = (config_text, dict(os.environ))
+        cached = self._configs.get(config_file)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        result = read_config(config_text)
+        self._configs[config_file] = (key, result)
+        return result
+
+    def index(self, index_file, config_dir):
+        """Return the index of *config_dir*."""
+        index = self._indices.get(index_file)
+        if index is None:
+            index = _Index(index_file, config_dir)
+            self._indices[index_file] = index
+        return index
+
+    def load(self, path, load):
+        """Return *load(path)*, reusing the result
+        while the file at *path* is unchanged.
+        """
+        # raises FileNotFoundError, as open would
+        st = os.stat(path)
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        cached = self._files.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        value = load(path)
+        self._files[path] = (key, value)
+        return value
+
+
+class _RsyncFilter():
+    """Match paths against rsync filter rules.
+
+    Only simple rules are supported: include and exclude patterns,
+    merge files and clear. If any other rule is encountered,
+    ``ValueError`` is raised, and one should use rsync instead.
+    """
 
-        # status #
-        parser_status = subparsers.add_parser(
-            "status", help="print updates since last commit"
+    def __init__(self, filter_args):
+        """*filter_args* are rsync command line arguments
+        *--filter*, *--include* and *--exclude*,
+        as they are made by *YARsync._get_filter*.
+        """
+        # list of (include, regex, dir_only)
+        self._rules = []
+        for arg in filter_args:
+            if arg.startswith("--include="):
+                self._add(True, arg[len("--include="):])
+            elif arg.startswith("--exclude="):
+                self._add(False, arg[len("--exclude="):])
+            elif arg.startswith("--filter="):
+                self._add_rule(arg[len("--filter="):])
+            else:
+                raise ValueError("unsupported rsync filter {}".format(arg))
+
+    def _add(self, include, pattern):
+        regex, dir_only = _rsync_pattern_to_regex(pattern)
+        self._rules.append((include, regex, dir_only))
+
+    def _add_rule(self, rule):
+        rule = rule.strip()
+        if not rule or rule[0] in "#;":
+            return
+        # long names are separated from the pattern by a space,
+        # short ones by a space or an underscore.
+        name, sep, pattern = rule.partition(' ')
+        if name == "!" or name == "clear":
+            self._rules = []
+            return
+        short_names = {"+": "include", "-": "exclude", ".": "merge"}
+        if name not in short_names.values():
+            if rule[0] in short_names and rule[1:2] in ('', ' ', '_'):
+                name = short_names[rule[0]]
+                pattern = rule[2:]
+            else:
+                raise ValueError("unsupported rsync filter rule '{}'"
+                                 .format(rule))
+        if name == "merge":
+            with open(pattern) as fil:
+                for line in fil:
+                    self._add_rule(line.rstrip('\n'))
+        else:
+            self._add(name == "include", pattern)
+
+    def excluded(self, path, is_dir=False):
+        """Return ``True`` if *path* (relative to the root)
+        is excluded from the transfer.
+        """
+        for include, regex, dir_only in self._rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.search(path):
+                return not include
+        return False
+
+
+class _NullParser():
+    """A stub for parsers of commands that were not called.
+
+    All its methods do nothing and return the stub itself.
+    """
+
+    def __getattr__(self, name):
+        return self._ignore
+
+    def _ignore(self, *args, **kwargs):
+        return self
+
+
+class _Timings():
+    """Wall clock times of command phases and subprocesses."""
+
+    def __init__(self, start=None):
+        # times are relative to the start
+        self.start = time.perf_counter() if start is None else start
+        # (start, duration, kind, name)
+        self.spans = []
+        # push to several remotes runs in threads
+        self._lock = threading.Lock()
+
+    def add(self, name, start, kind="phase"):
+        """Add a span *name* from *start* until now."""
+        now = time.perf_counter()
+        with self._lock:
+            self.spans.append((start - self.start, now - start, kind, name))
+
+    @contextlib.contextmanager
+    def span(self, name, kind="phase"):
+        """Context manager to time a block of code."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, kind)
+
+    def to_dict(self):
+        return {
+            "total": time.perf_counter() - self.start,
+            "spans": [
+                {"start": start, "time": duration, "kind": kind, "name": name}
+                for start, duration, kind, name in sorted(self.spans)
+            ],
+        }
+
+    def format_table(self, width=60):
+        """Return a table of spans sorted by their start."""
+        lines = ["{:>8} {:>8}  {:<7}  {}".format("start, s", "time, s",
+                                                 "kind", "name")]
+        for start, duration, kind, name in sorted(self.spans):
+            if len(name) > width:
+                name = name[:width-3] + "..."
+            lines.append("{:8.3f} {:8.3f}  {:<7}  {}"
+                         .format(start, duration, kind, name))
+        lines.append("{:8} {:8.3f}  total".format(
+            "", time.perf_counter() - self.start
+        ))
+        return "\n".join(lines)
+
+
+class _TimedPopen(subprocess.Popen):
+    """A :class:`subprocess.Popen` that adds its run time
+    to :class:`_Timings` when it is waited for.
+    """
+
+    def __init__(self, timings, args, **kwargs):
+        self._timings = timings
+        self._start = time.perf_counter()
+        self._timed = False
+        super().__init__(args, **kwargs)
+
+    def _add_time(self):
+        if self.returncode is not None and not self._timed:
+            self._timed = True
+            self._timings.add(" ".join(self.args), self._start,
+                              kind="process")
+
+    def poll(self):
+        returncode = super().poll()
+        self._add_time()
+        return returncode
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        self._add_time()
+        return returncode
+
+
+class YARsync():
+    """Synchronize data. Provide configuration and wrap rsync calls."""
+
+    # state kept between commands in yarsync serve
+    _warm = None
+
+    def __init__(self, argv):
+        """*argv* is the list of command line arguments."""
+        init_start = time.perf_counter()
+
+        # only the parser of the called command is built
+        command_name = _get_command_name(
+            argv[1:], ["--config-dir", "--root-dir", "--profile"]
         )
-        parser_status.set_defaults(func=self._status)
+        parser = self._make_parser(command_name)
+        if parser is None:
+            # not a command. Let argparse print an error
+            parser = self._make_parser()
 
         #####################
         ## Parse arguments ##
@@ -732,6 +1814,17 @@ def __init__(self, argv):
             # Will raise SystemExit(0).
             args = parser.parse_args(["--help"])
 
+        self._timings = None
+        if args.timings:
+            self._timings = _Timings(init_start)
+            self._timings.add("parse arguments", init_start)
+        self._profile = None
+        if args.profile:
+            # needed only for debugging
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
         ########################
         ## Init configuration ##
         ########################
@@ -741,7 +1834,7 @@ def __init__(self, argv):
         root_dir = os.path.expanduser(args.root_dir)
         config_dir = os.path.expanduser(args.config_dir)
         if not root_dir and not config_dir:
-            if args.command_name == "init":
+            if args.command_name in ["init", "serve"]:
                 root_dir = "."
                 config_dir = _ysdir
             else:
@@ -788,100 +1881,43 @@ def __init__(self, argv):
             # could not initialize ArgumentError here,
             # so created a new one
             raise YSArgumentError("root-dir", err_msg)
-        self.root_dir = root_dir
-        self.config_dir = config_dir
-
-        # set technical attributes
-        self._remote_config = None
+        self._init_repo(
+            root_dir, config_dir, args.command_name,
+            allow_missing_config=(args.command_name == "remote"
+                                  and args.remote_command == "add")
+        )
+        self._format = getattr(args, "format", "text")
+        if getattr(args, "stat", False):
+            self._stat_depth = args.stat_depth
 
-        # directory creation mode could be set from:
-        # - command line argument
-        # - global configuration
-        # - mode of the sync-ed directory (may be best)
-        # - hardcoded
-        # - just skipped (and will be set correctly by the OS).
-        # self.DIRMODE = 0o755
+        ####################################
+        ## Initialize optional parameters ##
+        ####################################
 
-        self.CLONETOFILE = os.path.join(self.config_dir, "CLONE_TO_{}.txt")
-        self.COMMITDIRNAME = "commits"
-        self.COMMITDIR = os.path.join(self.config_dir, self.COMMITDIRNAME)
-        self.CONFIGFILE = os.path.join(self.config_dir, "config.ini")
-        self.DATEFMT = "%a, %d %b %Y %H:%M:%S %Z"
-        self.HEADFILE = os.path.join(self.config_dir, "HEAD.txt")
-        self.COMMITLIMITNAME = "COMMIT_LIMIT.txt"
-        self.COMMITLIMITFILE = os.path.join(self.config_dir,
-                                            self.COMMITLIMITNAME)
-        self.LOGDIRNAME = "logs"
-        self.LOGDIR = os.path.join(self.config_dir, self.LOGDIRNAME)
-        self.MERGEFILE = os.path.join(self.config_dir, "MERGE.txt")
-        # template for the repository name
-        self.REPOFILE = os.path.join(self.config_dir, "repo_{}.txt")
-        self.RSYNCFILTERNAME = "rsync-filter"
-        self.RSYNCFILTER = os.path.join(self.config_dir, self.RSYNCFILTERNAME)
-        # yarsync repositories are owned by one user.
-        # However, different machines can have different user
-        # and group ids, so we don't push extraneous ids there.
-        # Used in pull and push (and indirectly in clone).
-        self.RSYNCOPTIONS = ["-avH", "--no-owner", "--no-group"]
-        self.SYNCDIRNAME = "sync"
-        self.SYNCDIR = os.path.join(self.config_dir, self.SYNCDIRNAME)
-        # SYNCSTR is defined in _Sync
-        # self.SYNCFILE = os.path.join(self.config_dir, "sync.txt")
-
-        ## Check for CONFIGFILE
-        # "checkout", "diff", "init", "log", "show", "status"
-        # work fine without config.
-        if args.command_name in ["pull", "push", "remote"]:
-            try:
-                with open(self.CONFIGFILE, "r") as conf_file:
-                    config_text = conf_file.read()
-            except OSError as err:
-                if (args.command_name == "remote"
-                    and args.remote_command == "add"
-                    and not os.path.exists(self.CONFIGFILE)):
-                    config_text = ""
-                else:
-                    # we are in an existing repository,
-                    # because .ys exists.
-                    _print_error(
-                        "fatal: could not read {} configuration at {}.".
-                        format(self.NAME, self.CONFIGFILE) +
-                        "\n  Check your permissions or restore missing files "
-                        "with '{} init'".
-                        format(self.NAME)
-                    )
-                    raise err
-            try:
-                config, configdict = self._read_config(config_text)
-            except configparser.Error as err:
-                err_descr = type(err).__name__ + ":\n    " + str(err)
-                _print_error(
-                    "{} configuration error in {}:\n  ".
-                    format(self.NAME, self.CONFIGFILE) +
-                    err_descr
-                )
-                raise YSConfigurationError(err, err_descr)
-            self._configdict = configdict
-            # Don't economize on memory here, but enhance our object
-            # (better to store than to re-read).
-            # if args.command_name == "remote":
-            #     # config is not needed for any other command
-            self._config = config
-
-        ####################################
-        ## Initialize optional parameters ##
-        ####################################
-
-        #########################
-        ## Initialize commands ##
-        #########################
+        #########################
+        ## Initialize commands ##
+        #########################
 
         # there is no easy way to set a default command
         # for a subparser, https://stackoverflow.com/a/46964652/952234
         if args.command_name == "commit":
             self._func = functools.partial(
                 self._commit,
-                limit=args.limit, message=args.message
+                limit=args.limit, message=args.message, engine=args.engine,
+                discard_partial=args.discard_partial, gc=args.gc
+            )
+        elif args.command_name == "gc":
+            self._func = functools.partial(
+                self._gc, jobs=args.jobs, dedup=args.dedup,
+                dry_run=args.dry_run
+            )
+        elif args.command_name in ["manifest", "verify"]:
+            func = self._manifest
+            if args.command_name == "verify":
+                func = functools.partial(self._verify, args.remote)
+            self._func = functools.partial(
+                func, commits=args.commit or None, jobs=args.jobs,
+                rehash=args.rehash
             )
         elif args.command_name == "clone":
             if root_dir:
@@ -923,15 +1959,28 @@ def __init__(self, argv):
                 backup = False
                 backup_dir = ""
                 remote = args.destination
+                if args.all == (remote is not None):
+                    err_msg = "yarsync: error: either a destination "\
+                              "or --all must be provided"
+                    print(err_msg)
+                    raise YSArgumentError("destination", err_msg)
 
-            self._func = functools.partial(
-                # common options
-                self._pull_push, args.command_name, remote,
-                dry_run=args.dry_run,
-                force=args.force,  # overwrite=args.overwrite,
-                # pull options
-                new=new, backup=backup, backup_dir=backup_dir
-            )
+            if args.command_name == "push" \
+                    and (args.all or self._is_remote_group(remote)):
+                self._func = functools.partial(
+                    self._push_many, remote,
+                    dry_run=args.dry_run, force=args.force, jobs=args.jobs,
+                    batch=args.batch
+                )
+            else:
+                self._func = functools.partial(
+                    # common options
+                    self._pull_push, args.command_name, remote,
+                    dry_run=args.dry_run,
+                    force=args.force,  # overwrite=args.overwrite,
+                    # pull options
+                    new=new, backup=backup, backup_dir=backup_dir
+                )
 
         elif args.command_name == "remote" and args.remote_command is None:
             self._func = self._remote_show
@@ -1180,9 +2229,9 @@ def _checkout(self, commit=None):
 
         if verbose:
             self._print_command(command)
-            sp = subprocess.run(command)
+            sp = self._run(command)
         else:
-            sp = subprocess.run(command, stdout=subprocess.PIPE)
+            sp = self._run(command, stdout=subprocess.PIPE)
 
         # we don't check for error code here,
         # because if checkout was wrong, we can't be sure
@@ -1197,20 +2246,211 @@ def _checkout(self, commit=None):
 
         return sp.returncode
 
-    def _commit(self, limit=None, message=""):
+    def _add_ssh_options(self, command):
+        """Make rsync *command* use a multiplexed SSH connection.
+
+        This is done only if *ssh_multiplex* is set
+        for the remote host in the configuration.
+        The connection is opened by the first rsync
+        and closed when the command finishes.
+        SSH options are added to those of *$RSYNC_RSH*,
+        and an explicit *-e* in the *command* is kept.
+        """
+        for arg in command[1:]:
+            if arg == "-e" or arg.startswith("--rsh"):
+                return
+        for arg in command[1:]:
+            # host::module is an rsync daemon, not SSH
+            if (not arg.startswith('-') and _is_remote(arg)
+                    and "::" not in arg):
+                host = arg[:arg.find(':')]
+                break
+        else:
+            return
+        ssh_command = self._get_ssh_command(host)
+        if ssh_command != self._get_rsh():
+            import shlex
+            # rsync splits the remote shell command like a shell
+            command[1:1] = ["-e", " ".join(map(shlex.quote, ssh_command))]
+
+    def _check_changed(self, engine=None):
+        """Check whether the working directory has changes
+        since the last commit.
+
+        Return a tuple *(returncode, changed)*.
+        Nothing is printed (except errors). The comparison stops
+        at the first change other than that of attributes,
+        and rsync is terminated in that case.
+        """
+        if engine is None:
+            engine = getattr(self._args, "engine", "rsync")
+        # the error is printed and should be handled by the caller
+        self._get_repo_name_local()
+
+        ref_commit_dir = self._get_ref_commit_dir()
+        if ref_commit_dir is None:
+            configpath = os.path.normpath(self.config_dir)
+            for subdir in os.scandir(self.root_dir):
+                subdir_path = os.path.normpath(subdir.path)
+                if subdir_path != configpath or subdir.is_file():
+                    return (0, True)
+            # if there is only '.ys' in the working directory,
+            # then the repository is unchanged.
+            return (0, False)
+
+        lines, finish = self._status_lines(
+            ref_commit_dir, engine=engine, verbose=False
+        )
+        changed = False
+        for line in lines:
+            # skip permission and directory time changes
+            if not line.startswith(b'.'):
+                changed = True
+                break
+        # return code is unimportant if we stopped early
+        return (finish(terminate=changed), changed)
+
+    def _check_local_repo(self, new=False, force=False):
+        """Check that the local repository can be pulled or pushed.
+
+        Return a pair *(returncode, local_repo)*.
+        A detached HEAD or an unfinished merge raise ``OSError``.
+        Uncommitted changes are not checked with *new* or *force*.
+        """
+        if self._get_head_commit() is not None:
+            # it could be safe to push a repo with a detached HEAD,
+            # but that would be messy.
+            # OSError is for exceptions
+            # that can occur outside the Python system
+            raise OSError("local repository has detached HEAD.\n"
+                          "*checkout* the most recent commit first.")
+        if os.path.exists(self.MERGEFILE):
+            raise OSError(
+                "local repository has unmerged changes.\n"
+                "Manually update the working directory and *commit*."
+            )
+
+        # otherwise will be called in _status below
+        try:
+            local_repo = self._get_repo_name_local()
+        except YSConfigurationError:
+            # the error is printed
+            return (CONFIG_ERROR, None)
+
+        if not (new or force):
+            with self._span("check uncommitted changes"):
+                returncode, changed = self._check_changed()
+            if changed:
+                _print_error(
+                    "local repository has uncommitted changes. Exit.\n  "
+                    "Run '{} status' for more details.".format(self.NAME)
+                )
+                return (COMMAND_ERROR, local_repo)
+            if returncode:
+                _print_error(
+                    "could not check for uncommitted changes, "
+                    "rsync returned {}. Exit\n  ".format(returncode) +
+                    "Run '{} status' for more details.".format(self.NAME)
+                )
+                return (returncode, local_repo)  # COMMAND_ERROR
+        return (0, local_repo)
+
+    def _check_missing_commits(self, source_commits, dest_commits,
+                               force=False, new=False):
+        """Raise ``OSError`` if the destination has commits
+        missing on source.
+
+        Nothing is checked with *force*, *new*
+        or for a repository with a commit limit.
+        """
+        # use a set to economize testing membership in a list,
+        # https://stackoverflow.com/a/3462202/952234
+        _source_commits = set(source_commits)
+        missing_commits = [comm for comm in dest_commits
+                           if comm not in _source_commits]
+
+        commit_limit = self._get_commit_limit()
+        if not (force or new or commit_limit is not None) and missing_commits:
+            missing_commits_str = ", ".join(map(str, missing_commits))
+            raise OSError(
+                "\ndestination has commits missing on source: {}, "\
+                .format(missing_commits_str) +
+                "synchronize these commits first:\n"
+                "1) pull missing commits with 'pull --new',\n"
+                "2) push if these commits were successfully merged, or\n"
+                "2') optionally checkout,\n"
+                "3') manually update the working directory "
+                "to the desired state, commit and push, or\n"
+                "1') pull/push --force the desired state "
+                "(removing all commits and logs missing on the destination)."
+            )
+
+    def _close_ssh_connections(self):
+        """Close multiplexed SSH connections opened during the command."""
+        if self._ssh_control_dir is None:
+            return
+        control_path = os.path.join(self._ssh_control_dir, "%C")
+        for host in sorted(self._ssh_hosts):
+            # the same options (like the port) give the same %C
+            command = self._get_rsh() + [
+                "-o", "ControlPath={}".format(control_path), "-O", "exit", host
+            ]
+            self._print_command(command, level=3)
+            try:
+                self._run(command, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL)
+            except OSError:
+                # ssh is missing, nothing was opened
+                pass
+        import shutil
+        shutil.rmtree(self._ssh_control_dir, ignore_errors=True)
+        self._ssh_control_dir = None
+        self._ssh_hosts = set()
+
+    def _commit(self, limit=None, message="", engine="rsync",
+                discard_partial=False, gc="background"):
         """Commit the working directory and create a log.
 
         Commit name is based on UNIX time.
+        The "rsync" *engine* hard links files with *rsync --link-dest*,
+        the "native" one uses parallel threads in Python
+        (if filters are supported by it).
+
+        A partial commit left after an interruption is completed
+        incrementally, unless *discard_partial* is ``True``
+        (then it is removed).
+
+        Removed commits are moved to the trash, which is emptied
+        according to *gc*: "now", in a "background" process
+        or "later" (by the command *gc*).
 
         If there are more commits than *limit*,
         older commits and logs will be removed.
+
+        Commits are serialized by a lock, so that concurrent ones
+        don't take over the partial commit of each other.
         """
+        with self._lock(self.COMMITLOCK) as locked:
+            if not locked:
+                _print_error("another commit is in progress in {}"
+                             .format(self.root_dir))
+                return COMMAND_ERROR
+            return self._commit_locked(
+                limit=limit, message=message, engine=engine,
+                discard_partial=discard_partial, gc=gc
+            )
 
+    def _commit_locked(self, limit=None, message="", engine="rsync",
+                       discard_partial=False, gc="background"):
+        """Commit the working directory while holding the commit lock
+        (see *_commit*).
+        """
         try:
             reponame = self._get_repo_name_local()
         except YSConfigurationError:
             return CONFIG_ERROR
 
+        import getpass
         username = getpass.getuser()
         time_str = time.strftime(self.DATEFMT, time.localtime())
 
@@ -1248,15 +2488,66 @@ def _commit(self, limit=None, message=""):
         # todo: improve concurrency.
         if os.path.exists(commit_dir):
             raise RuntimeError("commit {} exists".format(commit_dir))
-        if os.path.exists(commit_dir_tmp):
-            raise RuntimeError(
-                "temporary commit {} exists".format(commit_dir_tmp)
+
+        # an interrupted commit leaves its temporary directory.
+        # The most recent one is completed, older ones are removed.
+        partial_commits = self._get_partial_commits()
+        if discard_partial:
+            discarded = partial_commits
+            partial_commits = []
+        else:
+            discarded = partial_commits[:-1]
+            partial_commits = partial_commits[-1:]
+        for partial in discarded:
+            self._print("removing partial commit {}".format(partial))
+            self._move_to_trash(os.path.join(self.COMMITDIR,
+                                             "{}_tmp".format(partial)))
+        resume = bool(partial_commits)
+        if resume:
+            partial_dir = os.path.join(
+                self.COMMITDIR, "{}_tmp".format(partial_commits[0])
+            )
+            self._print("resuming partial commit {}"
+                        .format(partial_commits[0]))
+            if partial_dir != commit_dir_tmp:
+                self._print_command(
+                    "mv {} {}".format(partial_dir, commit_dir_tmp), level=3
+                )
+                os.rename(partial_dir, commit_dir_tmp)
+
+        filter_list = self._get_filter(include_commits=False)
+        # the journal of yarsync watch becomes valid for the new commit,
+        # since later changes are recorded there
+        watch_state = self._get_watch_state()
+
+        if engine == "native":
+            rsync_filter = self._make_native_filter(
+                ["--exclude=/.ys"] + filter_list
             )
+        else:
+            rsync_filter = None
+        if rsync_filter is not None:
+            self._print_command("cp -al {}/. {}".format(self.root_dir,
+                                                        commit_dir_tmp))
+            errors = []
+            with self._span("hard link working directory"):
+                _native_snapshot(self.root_dir, commit_dir_tmp,
+                                 rsync_filter=rsync_filter, errors=errors,
+                                 resume=resume)
+            if errors:
+                _print_error("an error occurred during hard linking, "
+                             "{} files or directories failed"
+                             .format(len(errors)))
+                # partial transfer due to error, as in rsync
+                return 23
+            return self._commit_finish(commit_name, message, limit, gc,
+                                       watch_state)
 
         # exclude .ys, otherwise an empty .ys/ will appear in the commit
         command = ["rsync", "-a", "--link-dest=../../..", "--exclude=/.ys"]
-
-        filter_list = self._get_filter(include_commits=False)
+        if resume:
+            # existing links are kept, removed files are deleted
+            command.append("--delete")
         command.extend(filter_list)
 
         # the trailing slash is very important for rsync
@@ -1270,9 +2561,9 @@ def _commit(self, limit=None, message=""):
         self._print_command(command)
         if self.print_level >= 3:
             # with run there will be problems during testing
-            completed_process = subprocess.Popen(command)
+            completed_process = self._popen(command)
         else:
-            completed_process = subprocess.Popen(
+            completed_process = self._popen(
                 command, stdout=subprocess.DEVNULL
             )
         completed_process.communicate()
@@ -1284,10 +2575,29 @@ def _commit(self, limit=None, message=""):
                          "rsync returned {}".format(returncode))
             return returncode
 
+        return self._commit_finish(commit_name, message, limit, gc,
+                                   watch_state)
+
+    def _commit_finish(self, commit_name, message, limit, gc="background",
+                       watch_state=None):
+        """Rename the temporary commit and write its log.
+
+        Older commits are removed according to the *limit*
+        and deleted according to *gc*.
+        The commit is added to the journal of *watch_state*.
+        """
+        commit_dir = os.path.join(self.COMMITDIR, commit_name)
+        commit_dir_tmp = commit_dir + "_tmp"
+
         # commit is done
         self._print_command("mv {} {}".format(commit_dir_tmp, commit_dir),
                             level=3)
         os.rename(commit_dir_tmp, commit_dir)
+        if watch_state is not None:
+            self._write_watch_journal(
+                watch_state["journal"],
+                {"commit": int(commit_name), "paths": []}
+            )
 
         ## log ##
         if not os.path.exists(self.LOGDIR):
@@ -1299,6 +2609,8 @@ def _commit(self, limit=None, message=""):
         # write log file
         with open(commit_log_name, "w") as commit_file:
             print(message, file=commit_file)
+        with self._span("commit statistics"):
+            self._write_commit_stats(int(commit_name))
 
         # print to stdout
         self._print(
@@ -1316,44 +2628,232 @@ def _commit(self, limit=None, message=""):
         self._update_head()
 
         if limit is None:
-            repo_commit_limit = self._get_commit_limit()
-            if repo_commit_limit is None:
-                return 0
-            limit = repo_commit_limit
+            limit = self._get_commit_limit()
             cl_from_file = True
         else:
             cl_from_file = False
 
-        ## limit commits
-        commits = sorted(self._get_local_commits())
-        ncommits = len(commits)
+        if limit is not None:
+            ## limit commits
+            commits = sorted(self._get_local_commits())
+            ncommits = len(commits)
+
+            if ncommits > limit:
+                delete_commits = commits[:ncommits - limit]
+                for comm in delete_commits:
+                    comm_path = os.path.join(self.COMMITDIR, str(comm))
+                    log_path = os.path.join(self.LOGDIR, str(comm) + ".txt")
+                    stats_path = self.COMMITSTATSFILE.format(comm)
+
+                    self._print("removing commit {}".format(comm))
+                    # renaming is fast, deletion of many links is not
+                    self._move_to_trash(comm_path)
+                    for path in [log_path, stats_path]:
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                self._print("removed older commits with logs")
+
+            # make commit limit persistent
+            if not cl_from_file:
+                with open(self.COMMITLIMITFILE, "w") as fil:
+                    fil.write(str(limit))
+
+        if not self._get_trash():
+            return 0
+        if gc == "now":
+            return self._gc()
+        if gc == "background":
+            self._gc_background()
+        return 0
 
-        if ncommits > limit:
-            delete_commits = commits[:ncommits - limit]
-            for comm in delete_commits:
-                comm_path = os.path.join(self.COMMITDIR, str(comm))
-                log_path = os.path.join(self.LOGDIR, str(comm) + ".txt")
+    def _dedup(self, jobs=None, dry_run=False):
+        """Replace identical files in commits and the working directory
+        with hard links.
+
+        Files are compared if they have the same size,
+        modification time, permissions and owner
+        (otherwise linking them would change their attributes),
+        and their contents are compared by hashes.
+        Hashes are computed by *jobs* processes and cached,
+        so that an interrupted run continues quickly.
+        Files in the working directory excluded by filters are skipped.
+        Distinct files in the working directory are never linked
+        to each other, only to copies in commits.
+        Files changed after they were hashed are skipped.
+        With *dry_run* nothing is changed.
+        """
+        errors = []
+        sources = []
+        rsync_filter = self._make_native_filter(
+            ["--exclude=/.ys"] + self._get_filter(include_commits=False)
+        )
+        if rsync_filter is None:
+            self._print("working directory is skipped")
+        else:
+            sources.append((self.root_dir, rsync_filter))
+        for commit in sorted(self._get_local_commits()):
+            sources.append((os.path.join(self.COMMITDIR, str(commit)), None))
+
+        # files that could be linked have equal attributes
+        candidates = collections.defaultdict(list)
+        for root, root_filter in sources:
+            for path, st in _scan_files(root, root_filter, errors):
+                if not st.st_size:
+                    continue
+                attrs = (st.st_dev, st.st_size, st.st_mtime_ns,
+                         st.st_mode, st.st_uid, st.st_gid)
+                candidates[attrs].append((path, st))
+
+        # (dev, ino): [paths]
+        inode_paths = collections.defaultdict(list)
+        # (dev, ino): stat
+        to_hash = {}
+        for files in candidates.values():
+            if len(set(st.st_ino for _, st in files)) < 2:
+                continue
+            for path, st in files:
+                inode = (st.st_dev, st.st_ino)
+                inode_paths[inode].append(path)
+                to_hash.setdefault(inode, (path, st))
 
-                self._print("removing commit {}".format(comm))
-                shutil.rmtree(comm_path)
-                try:
-                    os.remove(log_path)
-                except FileNotFoundError:
-                    pass
-            self._print("removed older commits with logs")
+        hash_cache = _HashCache(self.HASHFILE)
+        inodes = sorted(to_hash)
+        try:
+            for path, err in hash_cache.update(
+                    [to_hash[inode] for inode in inodes], jobs=jobs
+                ):
+                _native_error("read", path, err, errors)
+        finally:
+            # keep hashes if interrupted
+            hash_cache.save()
+        digests = [hash_cache.lookup(to_hash[inode][1]) for inode in inodes]
+
+        same_files = collections.defaultdict(list)
+        for inode, digest in zip(inodes, digests):
+            if digest is not None:
+                st = to_hash[inode][1]
+                attrs = (st.st_dev, st.st_size, st.st_mtime_ns,
+                         st.st_mode, st.st_uid, st.st_gid)
+                same_files[(attrs, digest)].append(inode)
+
+        commit_prefix = os.path.join(self.COMMITDIR, "")
+
+        def link_group(same_inodes):
+            # return inodes to be linked to the first one.
+            # Distinct files in the working directory are never linked
+            # (changing one would change another),
+            # only with copies in commits.
+            working = []
+            copies = []
+            for inode in same_inodes:
+                if all(path.startswith(commit_prefix)
+                       for path in inode_paths[inode]):
+                    copies.append(inode)
+                else:
+                    working.append(inode)
+            # keep the inode with most links
+            def order(inode):
+                return (-to_hash[inode][1].st_nlink,
+                        sorted(inode_paths[inode]))
+            working.sort(key=order)
+            copies.sort(key=order)
+            return working[:1] + copies
+
+        def unchanged(path, st, ctime=True):
+            # the file at path is still the hashed one
+            try:
+                new_st = os.lstat(path)
+            except OSError:
+                return False
+            fields = ["st_ino", "st_size", "st_mtime_ns"]
+            if ctime:
+                fields.append("st_ctime_ns")
+            return all(getattr(new_st, field) == getattr(st, field)
+                       for field in fields)
+
+        nlinked = 0
+        freed = 0
+        # replacing files changes modification times of directories,
+        # they are restored (so that status shows no changes)
+        dir_stats = {}
+        for same_inodes in same_files.values():
+            group = link_group(same_inodes)
+            if len(group) < 2:
+                continue
+            keep_path = inode_paths[group[0]][0]
+            keep_st = to_hash[group[0]][1]
+            for inode in group[1:]:
+                st = to_hash[inode][1]
+                paths = inode_paths[inode]
+                # files could be changed after they were hashed
+                if not dry_run and not all(unchanged(path, st)
+                                           for path in paths):
+                    self._print("changed file skipped: {}"
+                                .format(paths[0]))
+                    continue
+                nreplaced = 0
+                for path in paths:
+                    self._print_command(
+                        "ln -f {} {}".format(keep_path, path), level=3
+                    )
+                    if dry_run:
+                        nreplaced += 1
+                        continue
+                    # replacing links changes ctime of both files,
+                    # it was checked above for this one
+                    if not (unchanged(keep_path, keep_st)
+                            and unchanged(path, st, ctime=False)):
+                        self._print("changed file skipped: {}"
+                                    .format(path))
+                        continue
+                    dir_path = os.path.dirname(path)
+                    tmp_path = path + ".ys_dedup"
+                    try:
+                        if dir_path not in dir_stats:
+                            dir_stats[dir_path] = os.stat(dir_path)
+                        os.link(keep_path, tmp_path)
+                        keep_st = os.lstat(tmp_path)
+                        # atomic replacement
+                        os.replace(tmp_path, path)
+                    except OSError as err:
+                        _native_error("link", path, err, errors)
+                        try:
+                            os.remove(tmp_path)
+                        except OSError:
+                            pass
+                    else:
+                        nreplaced += 1
+                nlinked += nreplaced
+                # the inode is freed only if all its links are replaced
+                if nreplaced == st.st_nlink:
+                    freed += st.st_size
 
-        # make commit limit persistent
-        if not cl_from_file:
-            with open(self.COMMITLIMITFILE, "w") as fil:
-                fil.write(str(limit))
+        for dir_path, dir_st in dir_stats.items():
+            try:
+                os.utime(dir_path, ns=(dir_st.st_atime_ns, dir_st.st_mtime_ns))
+            except OSError as err:
+                _native_error("set times of", dir_path, err, errors)
 
+        if dry_run:
+            self._print("{} files can be linked, {} bytes would be freed"
+                        .format(nlinked, freed))
+        else:
+            self._print("{} files linked, {} bytes freed"
+                        .format(nlinked, freed))
+        if errors:
+            return COMMAND_ERROR
         return 0
 
-    def _diff(self, commit1=None, commit2=None, verbose=True):
+    def _diff(self, commit1=None, commit2=None, verbose=True, engine=None):
         # arguments are positional only
         """Print the difference between *commit1* and *commit2*
-        (from the old to the new one).
+        (from the old to the new one) with *engine*
+        (see *_diff_lines*).
         """
+        if engine is None:
+            engine = getattr(self._args, "engine", "rsync")
 
         if commit1 is None:
             commit1 = int(self._args.commit)
@@ -1365,17 +2865,25 @@ def _diff(self, commit1=None, commit2=None, verbose=True):
             else:
                 commit2 = int(commit2)
 
+        if self._stat_depth is not None:
+            stat, returncode = self._diff_stat(commit1, commit2, engine=engine,
+                                               verbose=verbose)
+            self._print_diff_stat(stat)
+            return returncode
+
+        lines, finish = self._diff_lines(commit1, commit2, engine=engine,
+                                         verbose=verbose)
+        self._print_changes(lines)
+        return finish()
+
+    def _diff_command(self, commit1, commit2):
+        """Return the rsync command to compare two commits."""
         comm1 = min(commit1, commit2)
         comm2 = max(commit1, commit2)
 
         comm1_dir = os.path.join(self.COMMITDIR, str(comm1))
         comm2_dir = os.path.join(self.COMMITDIR, str(comm2))
 
-        if not os.path.exists(comm1_dir):
-            raise ValueError("commit {} does not exist".format(comm1))
-        if not os.path.exists(comm2_dir):
-            raise ValueError("commit {} does not exist".format(comm2))
-
         command = [
             "rsync", "-aun",
             # useless now, see comment in _status()
@@ -1390,20 +2898,147 @@ def _diff(self, commit1=None, commit2=None, verbose=True):
         # what changes should be applied for comm1 to become comm2
         # / is extremely important!
         command += [comm2_dir + '/', comm1_dir]
+        return command
 
+    def _diff_stat(self, commit1, commit2, engine="rsync", verbose=True):
+        """Return a pair *(stat, returncode)*, where *stat*
+        is a _DiffStat of *_diff_lines*.
+
+        Changes are counted as they are read,
+        without keeping them in memory.
+        """
+        comm1 = min(commit1, commit2)
+        comm2 = max(commit1, commit2)
+        stat = _DiffStat(os.path.join(self.COMMITDIR, str(comm1)),
+                         os.path.join(self.COMMITDIR, str(comm2)),
+                         depth=self._stat_depth or 1)
+        lines, finish = self._diff_lines(commit1, commit2, engine=engine,
+                                         verbose=verbose)
+        for change in filter(None, map(_parse_change, lines)):
+            stat.add(change)
+        return (stat, finish())
+
+    def _diff_lines(self, commit1, commit2, engine="rsync", verbose=True):
+        """Compare *commit1* and *commit2* (from the old to the new one).
+
+        Return a pair *(lines, finish)* as in *_status_lines*.
+        The "rsync" *engine* runs *rsync -aun --delete -i*.
+        The "native" engine walks both commits in Python
+        and skips files hard linked between them by their inodes.
+        """
+        comm1 = min(commit1, commit2)
+        comm2 = max(commit1, commit2)
+
+        comm1_dir = os.path.join(self.COMMITDIR, str(comm1))
+        comm2_dir = os.path.join(self.COMMITDIR, str(comm2))
+
+        if not os.path.exists(comm1_dir):
+            raise ValueError("commit {} does not exist".format(comm1))
+        if not os.path.exists(comm2_dir):
+            raise ValueError("commit {} does not exist".format(comm2))
+
+        if engine == "native":
+            errors = []
+            changes = _native_changes(comm2_dir, comm1_dir, errors=errors)
+
+            def finish_native():
+                # rsync returns 23 for a partial transfer due to error
+                return 23 if errors else 0
+
+            return ((change.itemize() for change in changes), finish_native)
+
+        command = self._diff_command(comm1, comm2)
         if verbose:
             self._print_command(command)
 
-        sp = subprocess.Popen(command, stdout=subprocess.PIPE)
-        for line in iter(sp.stdout.readline, b''):
-            print(line.decode("utf-8"), end='')
+        sp = self._popen(command, stdout=subprocess.PIPE)
 
-        return sp.returncode
+        def finish():
+            sp.wait()
+            return sp.returncode
+
+        return (iter(sp.stdout.readline, b''), finish)
+
+    def _gc(self, jobs=None, dedup=False, dry_run=False):
+        """Delete removed commits from the trash.
+
+        Files are deleted by *jobs* parallel threads.
+        If *dedup* is ``True``, identical files are hard linked
+        (see *_dedup*).
+        With *dry_run* nothing is changed.
+        Concurrent runs wait for each other.
+        """
+        os.makedirs(self.CACHEDIR, exist_ok=True)
+        with self._lock(self.GCLOCK, blocking=True):
+            trash = self._get_trash()
+            if not trash:
+                self._print("trash is empty", level=3)
+            elif dry_run:
+                self._print("would remove {} commits from trash"
+                            .format(len(trash)))
+            else:
+                returncode = self._remove_trash(trash, jobs)
+                if returncode:
+                    return returncode
+            if dedup:
+                return self._dedup(jobs=jobs, dry_run=dry_run)
+        return 0
+
+    def _remove_trash(self, trash, jobs=None):
+        """Delete files *trash* from the trash directory."""
+        # the counter is useful only for a terminal
+        show_progress = self.print_level >= 2 and sys.stdout.isatty()
+
+        def progress(nfiles):
+            print("\rremoving trash: {} files".format(nfiles), end='',
+                  flush=True)
+
+        errors = []
+        nfiles = _remove_trees(
+            [os.path.join(self.TRASHDIR, fil) for fil in trash],
+            jobs=jobs, errors=errors,
+            progress=progress if show_progress else None
+        )
+        if show_progress:
+            print("\r", end='')
+        self._print("removed {} files from trash".format(nfiles))
+        if errors:
+            _print_error("could not remove {} files or directories"
+                         .format(len(errors)))
+            return COMMAND_ERROR
+        return 0
+
+    def _gc_background(self):
+        """Run *gc* in a separate process (or now if that failed).
+
+        Its errors are written to *GCLOG*.
+        """
+        # the package may be not importable from the working directory
+        # (a script or a zip application), so its path is given
+        package_path = os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__))
+        )
+        code = ("import sys; sys.path.insert(0, sys.argv.pop(1)); "
+                "from yarsync.yarsync import _main; "
+                "sys.exit(_main(['yarsync'] + sys.argv[1:]))")
+        command = [sys.executable, "-c", code, package_path, "-qq",
+                   "--config-dir", self.config_dir,
+                   "--root-dir", self.root_dir, "gc"]
+        self._print_command(command, level=3)
+        try:
+            os.makedirs(self.CACHEDIR, exist_ok=True)
+            with open(self.GCLOG, "w") as log:
+                # the process is not stopped with this one
+                subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.DEVNULL, stderr=log,
+                                 start_new_session=True)
+        except OSError:
+            self._gc()
 
     def _get_commit_limit(self):
         try:
-            with open(self.COMMITLIMITFILE) as fil:
-                cl_content = fil.readline()
+            cl_content = io.StringIO(self._read_ys_file(self.COMMITLIMITFILE))\
+                         .readline()
         except FileNotFoundError:
             return None
 
@@ -1417,6 +3052,29 @@ def _get_commit_limit(self):
 
         return commit_limit
 
+    def _get_cache_ttl(self, remote):
+        """Return the time (in seconds) to cache the remote configuration.
+
+        It is set by *cache_ttl* in the configuration, 0 by default.
+        """
+        config = getattr(self, "_config", None)
+        if config is None:
+            return 0
+        try:
+            ttl = config.getfloat(remote, "cache_ttl", fallback=0)
+            if ttl < 0:
+                raise ValueError(ttl)
+        except ValueError as err:
+            err_descr = "cache_ttl must be a non-negative number "\
+                        "of seconds for the remote '{}'.".format(remote)
+            _print_error(
+                "{} configuration error in {}:\n  ".
+                format(self.NAME, self.CONFIGFILE) +
+                err_descr
+            )
+            raise YSConfigurationError(err, err_descr)
+        return ttl
+
     def _get_dest_path(self, dest=None):
         """Return a pair *(host, destpath)*, where
         *host* is a real host (its ip/name/etc.) at the destination
@@ -1505,9 +3163,9 @@ def _get_filter(self, path="", include_commits=True, include_configs=()):
 
     def _get_head_commit(self):
         try:
-            with open(self.HEADFILE, "r") as head:
-                # strip trailing newline
-                head_commit = head.readlines()[0].strip()
+            # strip trailing newline
+            head_commit = self._read_ys_file(self.HEADFILE)\
+                          .splitlines()[0].strip()
         except OSError:
             # no HEADFILE means HEAD is the most recent commit
             return None
@@ -1524,9 +3182,9 @@ def _get_last_commit(self, commits=None):
 
     def _get_local_commits(self):
         """Return local commits as an iterable of integers."""
-        # todo: cache results. But note that it is used in pull.
+        # results may be cached in the index
         try:
-            commit_candidates = os.listdir(self.COMMITDIR)
+            commit_candidates = self._listdir(self.COMMITDIR)
         except OSError:
             # no commits exist
             # todo: do we print about that here?
@@ -1537,7 +3195,7 @@ def _get_local_sync(self, syncdata=None, verbose=True):
         """Get local synchronization information."""
         if syncdata is None:
             try:
-                syncdata = os.listdir(self.SYNCDIR)
+                syncdata = self._listdir(self.SYNCDIR)
             except FileNotFoundError:  # sybtype of OSError
                 syncdata = []
                 # this is not an error
@@ -1553,26 +3211,95 @@ def _get_local_sync(self, syncdata=None, verbose=True):
 
         return sync
 
-    def _get_remote_config(self, config_path, print_level=3):
-        """Return remote configuration as _Config."""
-
-        # try cached value
-        if self._remote_config:
-            return self._remote_config
-
+    def _get_multiplexed_hosts(self):
+        """Return a set of hosts of remotes with *ssh_multiplex*."""
+        if hasattr(self, "_multiplexed_hosts"):
+            return self._multiplexed_hosts
+        hosts = set()
+        config = getattr(self, "_config", None)
+        for remote in (config.sections() if config is not None else []):
+            try:
+                multiplex = config.getboolean(remote, "ssh_multiplex",
+                                              fallback=False)
+            except ValueError as err:
+                err_descr = "ssh_multiplex must be a boolean "\
+                            "for the remote '{}'.".format(remote)
+                _print_error(
+                    "{} configuration error in {}:\n  ".
+                    format(self.NAME, self.CONFIGFILE) +
+                    err_descr
+                )
+                raise YSConfigurationError(err, err_descr)
+            destpath = self._configdict[remote]["destpath"]
+            if multiplex and _is_remote(destpath):
+                hosts.add(destpath[:destpath.find(':')])
+        self._multiplexed_hosts = hosts
+        return hosts
+
+    def _get_partial_commits(self):
+        """Return a sorted list of interrupted (temporary) commits."""
         try:
-            remote_files = self._get_remote_files(
-                config_path, with_commits=True, print_level=print_level
-            )
-        except OSError as err:
-            # we don't push into a non-existing repository
-            raise err
-            # # detailed error messages are already printed by rsync
-            # raise OSError(
-            #     "error while listing remote commits"
-            # )
-            # return {"commits": [], "sync": _Sync([])}
-
+            commit_files = os.listdir(self.COMMITDIR)
+        except FileNotFoundError:
+            return []
+        partial = [fil[:-len("_tmp")] for fil in commit_files
+                   if fil.endswith("_tmp")]
+        return sorted(map(int, filter(_is_commit, partial)))
+
+    def _get_ref_commit_dir(self):
+        """Return the directory of the HEAD commit
+        (the most recent one if HEAD is not detached)
+        or ``None`` if there are no commits.
+        """
+        try:
+            commit_subdirs = [fil for fil in self._listdir(self.COMMITDIR)
+                              if _is_commit(fil)]
+        except FileNotFoundError:
+            commit_subdirs = []
+        if not commit_subdirs:
+            return None
+
+        head_commit = self._get_head_commit()
+        if head_commit is None:
+            head_commit = max(map(int, commit_subdirs))
+        return os.path.join(self.COMMITDIR, str(head_commit))
+
+    def _get_remote_config(self, config_path, print_level=3,
+                           ttl=0, refresh=False):
+        """Return remote configuration as _Config.
+
+        If *ttl* is positive, the remote listing is cached
+        in the local cache directory and used for *ttl* seconds
+        (unless *refresh* is ``True``).
+        """
+
+        # try cached value
+        if self._remote_config:
+            return self._remote_config
+
+        cache_file = self._get_remote_cache_file(config_path)
+        remote_files = None
+        if ttl and not refresh:
+            remote_files = self._read_remote_cache(cache_file, config_path,
+                                                   ttl)
+
+        if remote_files is None:
+            try:
+                remote_files = self._get_remote_files(
+                    config_path, with_commits=True, print_level=print_level
+                )
+            except OSError as err:
+                # we don't push into a non-existing repository
+                raise err
+                # # detailed error messages are already printed by rsync
+                # raise OSError(
+                #     "error while listing remote commits"
+                # )
+                # return {"commits": [], "sync": _Sync([])}
+            if ttl:
+                self._write_remote_cache(cache_file, config_path,
+                                         remote_files)
+
         # can raise YSConfigurationError
         remote_config = _Config(remote_files)
 
@@ -1580,6 +3307,13 @@ def _get_remote_config(self, config_path, print_level=3):
         # elsewhere if needed.
         return remote_config
 
+    def _get_remote_cache_file(self, config_path):
+        """Return the cache file for the remote configuration directory."""
+        import hashlib
+        path_hash = hashlib.sha1(config_path.encode("utf-8")).hexdigest()
+        return os.path.join(self.CACHEDIR,
+                            "remote_{}.json".format(path_hash[:16]))
+
     def _get_remote_files(self, path, with_commits=False, print_level=3):
         """Return a list of files at the remote path.
         Path can be one file (why though).
@@ -1598,39 +3332,30 @@ def _get_remote_files(self, path, with_commits=False, print_level=3):
         # no idea what from_path was in that case.
         # command = "rsync -nr --info=NAME --include=/ --exclude=/*/*".split() \
         #           + [from_path, to_path]
+        self._add_ssh_options(command)
         self._print_command(" ".join(command), level=print_level)
         if print_level <= self.print_level + 1:
             # at print level 3 we print errors, but not the commands
             stderr = None  # all errors printed
         else:
             stderr = subprocess.DEVNULL
-        sp = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
-        # todo: can we iterate stdout before wait is finished?
-        # It is not critical, because we list not the complete hierarchy
-        sp.wait()
-
-        returncode = sp.returncode
-        if returncode:
-            raise OSError(
-                "error during listing remote files: rsync returned {}"\
-                .format(returncode)
-            )
+        sp = self._popen(command, stdout=subprocess.PIPE, stderr=stderr)
 
+        # output is read while rsync runs,
+        # otherwise it could block on a full pipe
         files = {}
         for line in iter(sp.stdout.readline, b''):
-            # print(line, line[0])
-            # probably files with a space won't work here.
-            fil = line.split()[-1]
-            if fil in [b'.', b'..']:
+            parsed = _parse_list_line(line)
+            if parsed is None:
+                continue
+            is_dir, path = parsed
+            if path in ['.', '..']:
                 continue
-            # make them strings for easier use
-            # and coherent with os.listdir
-            path = fil.decode("utf-8")
             # example: commits/1579013756
             parts = path.split('/')
             # or pathlib.PurePath(path).parts
             if len(parts) == 1:
-                if line[0] == 100:  # b'd'
+                if is_dir:
                     # a directory
                     dir_ = parts[0]
                     if dir_ not in files:
@@ -1645,16 +3370,42 @@ def _get_remote_files(self, path, with_commits=False, print_level=3):
                     files[dir_].append(subpath)
                 else:
                     files[dir_] = [subpath]
+        sp.wait()
+
+        returncode = sp.returncode
+        if returncode:
+            raise OSError(
+                "error during listing remote files: rsync returned {}"\
+                .format(returncode)
+            )
 
         return files
 
+    def _get_remotes(self, group=None):
+        """Return a sorted list of remotes in the *group*.
+
+        If *group* is ``None``, all remotes are returned.
+        Groups of a remote are set with a key *groups*
+        (names are separated by commas or spaces).
+        """
+        remotes = []
+        for remote, section in self._configdict.items():
+            if remote == self._config.default_section:
+                continue
+            groups = re.split(r"[\s,]+", section.get("groups") or "")
+            if group is None or group in groups:
+                remotes.append(remote)
+        return sorted(remotes)
+
     def _get_repo_name_local(self):
         # cache this value, because in clone we create a temporary one
         # and wouldn't be able to have two files simultaneously
         if hasattr(self, "_reponame"):
             return self._reponame
 
-        reponame = _get_repo_name_if_exists(config_dir=self.config_dir)
+        reponame = _get_repo_name_if_exists(
+            file_list=self._listdir(self.config_dir)
+        )
         # todo: reponame must exist.
         if reponame is None:
             err_msg = ("Could not find repository name. "
@@ -1663,11 +3414,289 @@ def _get_repo_name_local(self):
             raise YSConfigurationError(msg=err_msg)
             # platform.node() just calls socket.gethostname()
             # with an error check
+            import socket
             reponame = socket.gethostname()
 
         self._reponame = reponame
         return reponame
 
+    def _get_rsh(self):
+        """Return the remote shell command (a list) of rsync,
+        *$RSYNC_RSH* or "ssh".
+        """
+        import shlex
+        return shlex.split(os.environ.get("RSYNC_RSH", "")) or ["ssh"]
+
+    def _get_ssh_command(self, host):
+        """Return the SSH command (a list) to run commands on *host*.
+
+        A multiplexed connection is used if *ssh_multiplex*
+        is set for *host* in the configuration
+        and the remote shell (see *_get_rsh*) is ssh.
+        """
+        rsh = self._get_rsh()
+        if (host not in self._get_multiplexed_hosts()
+                or os.path.basename(rsh[0]) != "ssh"):
+            # other remote shells may not accept ssh options
+            return rsh
+
+        with self._ssh_lock:
+            if self._ssh_control_dir is None:
+                # a private directory for sockets
+                import tempfile
+                self._ssh_control_dir = tempfile.mkdtemp(prefix="yarsync-ssh-")
+            self._ssh_hosts.add(host)
+        # %C is a hash of the connection parameters
+        control_path = os.path.join(self._ssh_control_dir, "%C")
+        return rsh + ["-o", "ControlMaster=auto", "-o", "ControlPersist=yes",
+                      "-o", "ControlPath={}".format(control_path)]
+
+    def _get_trash(self):
+        """Return a sorted list of files in the trash.
+
+        Files being moved to the trash are not listed.
+        """
+        if not os.path.isdir(self.TRASHDIR):
+            return []
+        with self._lock(self.TRASHDIR, blocking=True):
+            return sorted(os.listdir(self.TRASHDIR))
+
+    def _init_repo(self, root_dir, config_dir, command_name,
+                   allow_missing_config=False):
+        """Set repository paths and read what *command_name* needs.
+
+        The configuration file is read for commands that use remotes
+        (it can be missing if *allow_missing_config* is ``True``).
+        """
+        self.root_dir = root_dir
+        self.config_dir = config_dir
+
+        # set technical attributes
+        self._remote_config = None
+        # multiplexed SSH connections are closed after the command
+        self._ssh_control_dir = None
+        self._ssh_hosts = set()
+        self._ssh_lock = threading.Lock()
+        # if a list, pull and push itemize changes and collect
+        # the output there (used by Repository)
+        self._transfers = None
+        # "text" or "json" (one object per line)
+        self._format = "text"
+        # print totals per directory up to this depth instead of changes
+        self._stat_depth = None
+
+        # directory creation mode could be set from:
+        # - command line argument
+        # - global configuration
+        # - mode of the sync-ed directory (may be best)
+        # - hardcoded
+        # - just skipped (and will be set correctly by the OS).
+        # self.DIRMODE = 0o755
+
+        # caches and indices, not synchronized
+        self.CACHEDIR = os.path.join(self.config_dir, "cache")
+        # errors of the background gc and its lock
+        self.GCLOG = os.path.join(self.CACHEDIR, "gc.log")
+        self.GCLOCK = os.path.join(self.CACHEDIR, "gc.lock")
+        self.CLONETOFILE = os.path.join(self.config_dir, "CLONE_TO_{}.txt")
+        self.COMMITDIRNAME = "commits"
+        self.COMMITDIR = os.path.join(self.config_dir, self.COMMITDIRNAME)
+        self.CONFIGFILE = os.path.join(self.config_dir, "config.ini")
+        self.DATEFMT = "%a, %d %b %Y %H:%M:%S %Z"
+        self.HEADFILE = os.path.join(self.config_dir, "HEAD.txt")
+        self.INDEXFILE = os.path.join(self.CACHEDIR, "index.json")
+        self.HASHFILE = os.path.join(self.CACHEDIR, "hashes.json")
+        # state and lock of yarsync watch
+        self.WATCHFILE = os.path.join(self.CACHEDIR, "watch.json")
+        self.WATCHLOCK = os.path.join(self.CACHEDIR, "watch.lock")
+        # removed commits, deleted later
+        self.TRASHDIR = os.path.join(self.config_dir, "trash")
+        # locked during commit (no file is created for that)
+        self.COMMITLOCK = self.config_dir
+        self.COMMITLIMITNAME = "COMMIT_LIMIT.txt"
+        self.COMMITLIMITFILE = os.path.join(self.config_dir,
+                                            self.COMMITLIMITNAME)
+        self.LOGDIRNAME = "logs"
+        self.LOGDIR = os.path.join(self.config_dir, self.LOGDIRNAME)
+        # template for statistics of a commit, written with its log
+        self.COMMITSTATSFILE = os.path.join(self.LOGDIR, "{}.stats.json")
+        self.MERGEFILE = os.path.join(self.config_dir, "MERGE.txt")
+        # template for the repository name
+        self.REPOFILE = os.path.join(self.config_dir, "repo_{}.txt")
+        self.RSYNCFILTERNAME = "rsync-filter"
+        self.RSYNCFILTER = os.path.join(self.config_dir, self.RSYNCFILTERNAME)
+        # yarsync repositories are owned by one user.
+        # However, different machines can have different user
+        # and group ids, so we don't push extraneous ids there.
+        # Used in pull and push (and indirectly in clone).
+        self.RSYNCOPTIONS = ["-avH", "--no-owner", "--no-group"]
+        self.SYNCDIRNAME = "sync"
+        self.SYNCDIR = os.path.join(self.config_dir, self.SYNCDIRNAME)
+        # SYNCSTR is defined in _Sync
+        # self.SYNCFILE = os.path.join(self.config_dir, "sync.txt")
+
+        # Short commands (and push that runs often) read the contents
+        # of the configuration directory from the index,
+        # which is faster on slow file systems.
+        # Other commands change it anyway.
+        if command_name in ["log", "status", "push"]:
+            if self._warm is not None:
+                self._index = self._warm.index(self.INDEXFILE,
+                                               self.config_dir)
+            else:
+                self._index = _Index(self.INDEXFILE, self.config_dir)
+        else:
+            self._index = None
+
+        ## Check for CONFIGFILE
+        # "checkout", "diff", "init", "log", "show", "status"
+        # work fine without config.
+        config_start = time.perf_counter()
+        if command_name in ["pull", "push", "remote", "verify"]:
+            import configparser
+            try:
+                with open(self.CONFIGFILE, "r") as conf_file:
+                    config_text = conf_file.read()
+            except OSError as err:
+                if (allow_missing_config
+                        and not os.path.exists(self.CONFIGFILE)):
+                    config_text = ""
+                else:
+                    # we are in an existing repository,
+                    # because .ys exists.
+                    _print_error(
+                        "fatal: could not read {} configuration at {}.".
+                        format(self.NAME, self.CONFIGFILE) +
+                        "\n  Check your permissions or restore missing files "
+                        "with '{} init'".
+                        format(self.NAME)
+                    )
+                    raise err
+            try:
+                # remote changes the configuration
+                if (self._warm is not None
+                        and command_name != "remote"):
+                    config, configdict = self._warm.config(
+                        self.CONFIGFILE, config_text, self._read_config
+                    )
+                else:
+                    config, configdict = self._read_config(config_text)
+            except configparser.Error as err:
+                err_descr = type(err).__name__ + ":\n    " + str(err)
+                _print_error(
+                    "{} configuration error in {}:\n  ".
+                    format(self.NAME, self.CONFIGFILE) +
+                    err_descr
+                )
+                raise YSConfigurationError(err, err_descr)
+            self._configdict = configdict
+            # Don't economize on memory here, but enhance our object
+            # (better to store than to re-read).
+            # if command_name == "remote":
+            #     # config is not needed for any other command
+            self._config = config
+            # check the configuration early
+            self._get_multiplexed_hosts()
+            for remote in config.sections():
+                self._get_cache_ttl(remote)
+            if self._timings is not None:
+                self._timings.add("read configuration", config_start)
+
+    def _get_watch_filter(self):
+        # changed filters invalidate the journal of yarsync watch
+        try:
+            with open(self.RSYNCFILTER) as fil:
+                filter_text = fil.read()
+        except FileNotFoundError:
+            filter_text = None
+        return json.dumps([self._get_filter(include_commits=False),
+                           filter_text])
+
+    def _get_watch_journal(self, commit):
+        """Return *(journal, paths)* from the journal of *yarsync watch*.
+
+        *journal* is the name of the journal file or ``None``
+        if it can't be used (see *_get_watch_state*).
+        *paths* is a tree of paths (see *_dirty_tree*)
+        that could have changed since *commit* or ``None``
+        if the journal doesn't cover that commit.
+        """
+        state = self._get_watch_state()
+        if state is None:
+            return (None, None)
+        journal = state["journal"]
+        journal_path = os.path.join(self.CACHEDIR, journal)
+
+        # When the watcher has recorded a new file,
+        # it has recorded all changes before that.
+        cookie = "watch-cookie-{}-{}".format(os.getpid(),
+                                             int(time.time() * 10**6))
+        cookie_path = os.path.join(self.CACHEDIR, cookie)
+        cookie_line = (json.dumps({"cookie": cookie}) + "\n").encode()
+        data = b""
+        try:
+            open(cookie_path, "x").close()
+            try:
+                with open(journal_path, "rb") as fil:
+                    deadline = time.monotonic() + 2
+                    while cookie_line not in data:
+                        if time.monotonic() > deadline:
+                            self._print("watch journal is not updated",
+                                        level=3)
+                            return (None, None)
+                        time.sleep(0.002)
+                        data += fil.read()
+            finally:
+                os.remove(cookie_path)
+        except OSError:
+            return (None, None)
+
+        commits = set()
+        paths = []
+        try:
+            for line in data.splitlines():
+                entry = json.loads(line.decode())
+                if "overflow" in entry:
+                    return (None, None)
+                if "path" in entry:
+                    paths.append(entry["path"])
+                elif "commit" in entry:
+                    commits.add(entry["commit"])
+                    paths.extend(entry["paths"])
+        except (ValueError, KeyError, TypeError):
+            return (None, None)
+        if commit not in commits:
+            return (journal, None)
+        self._print("use watch journal {}".format(journal), level=3)
+        return (journal, _dirty_tree(paths))
+
+    def _get_watch_state(self):
+        """Return the state of *yarsync watch*
+        or ``None`` if it is not running or its filters are changed.
+        """
+        try:
+            with open(self.WATCHFILE) as fil:
+                state = json.load(fil)
+        except (OSError, ValueError):
+            return None
+        import fcntl
+        try:
+            lock_fd = os.open(self.WATCHLOCK, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            # the lock is held by a running watcher
+            fcntl.flock(lock_fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except OSError:
+            pass
+        else:
+            return None
+        finally:
+            os.close(lock_fd)
+        if state.get("filter") != self._get_watch_filter():
+            return None
+        return state
+
     def _init(self, reponame="", merge=False):
         """Initialize default configuration.
 
@@ -1774,6 +3803,7 @@ def _init(self, reponame="", merge=False):
         cur_reponame = _get_repo_name_if_exists(config_dir=self.config_dir)
         if not cur_reponame:
             if not reponame:
+                import socket
                 hostname = socket.gethostname()
                 reponame = input("Enter repository name [{}]:"
                                  .format(hostname))
@@ -1905,7 +3935,7 @@ def get_sorted_logs_int(files, commits=None):
 
         if logs is None:
             try:
-                log_files = os.listdir(self.LOGDIR)
+                log_files = self._listdir(self.LOGDIR)
             except OSError:
                 # no log directory exists
                 log_files = []
@@ -1966,50 +3996,791 @@ def get_sorted_logs_int(files, commits=None):
                 log_ind += 1
         return results
 
-    def _log(self):
-        """Print commits and log information.
+    def _make_manifest(self, commits=None, jobs=None, rehash=False,
+                       errors=None):
+        """Return a dictionary *{path: (size, hash)}* of files
+        in the working directory and *commits* (all by default).
+
+        Paths in commits start with *.ys/commits/<commit>/*.
+        Hashes of unchanged files are taken from the cache
+        (unless *rehash* is ``True``), other files are hashed
+        by *jobs* processes.
+        Files that could not be read are appended to *errors*.
+        Raise ``ValueError`` if a commit does not exist
+        or filters are not supported.
+        """
+        if errors is None:
+            errors = []
+        local_commits = self._get_local_commits()
+        if commits is None:
+            commits = local_commits
+        else:
+            missing = sorted(set(commits) - set(local_commits))
+            if missing:
+                raise ValueError("commit {} not found".format(missing[0]))
+
+        # (root, path prefix, filter)
+        sources = [(
+            self.root_dir, "",
+            _RsyncFilter(["--exclude=/.ys"]
+                         + self._get_filter(include_commits=False))
+        )]
+        for commit in sorted(commits):
+            sources.append((
+                os.path.join(self.COMMITDIR, str(commit)),
+                "{}/{}/{}/".format(self.YSDIR, self.COMMITDIRNAME, commit),
+                None
+            ))
+        # (manifest path, path, stat)
+        files = []
+        for root, prefix, rsync_filter in sources:
+            for path, st in _scan_files(root, rsync_filter, errors):
+                files.append((prefix + os.path.relpath(path, root), path, st))
+
+        hash_cache = _HashCache(self.HASHFILE, rehash=rehash)
+        try:
+            for path, err in hash_cache.update(
+                    [(path, st) for _, path, st in files], jobs=jobs
+                ):
+                _native_error("read", path, err, errors)
+        finally:
+            hash_cache.save()
+
+        manifest = {}
+        for relpath, _, st in files:
+            digest = hash_cache.lookup(st)
+            if digest is not None:
+                manifest[relpath] = (st.st_size, digest)
+        return manifest
+
+    def _make_native_filter(self, filter_command):
+        """Return an :class:`_RsyncFilter` for *filter_command*
+        or ``None`` if the filter is not supported.
+        """
+        try:
+            return _RsyncFilter(filter_command)
+        except ValueError as err:
+            self._print("{}, using rsync".format(err),
+                        level=self._default_print_level)
+            return None
 
-        If only a commit or only a log are present, they are listed as well.
+    def _make_parser(self, command=None):
+        """Return the command line parser.
 
-        By default most recent commits are printed first.
-        Set *reverse* to ``False`` to print last commits last.
+        If *command* is given, only its subparser is built
+        (or ``None`` is returned if there is no such command).
         """
-        reverse = self._args.reverse
-        max_count = self._args.max_count
+        parser = argparse.ArgumentParser(
+            description="yarsync is a file synchronization and backup tool",
+            # exit_on_error appeared only in Python 3.9
+            # and doesn't seem to work. Skip and be more cross-platform.
+            # exit_on_error=False
+        )
+        # failed to implement that with ArgumentError
+        # parser = _ErrorCatchingArgumentParser(...)
+        subparsers = parser.add_subparsers(
+            title="Available commands",
+            dest="command_name",
+            # description="valid commands",
+            help="type 'yarsync <command> --help' for additional help",
+            # or it will print a list of commands in curly braces.
+            metavar="command",
+        )
+        added = []
 
-        cl_list = self._make_commit_list()
+        def add_parser(name, **kwargs):
+            # parsers of other commands are not needed
+            if command is not None and name != command:
+                return _NullParser()
+            added.append(name)
+            return subparsers.add_parser(name, **kwargs)
 
-        if not reverse:
-            commit_log_list = list(reversed(cl_list))
-        else:
-            commit_log_list = cl_list
-        if max_count != -1:
-            # otherwise the last element is excluded
-            commit_log_list = commit_log_list[:max_count]
+        ###################################
+        ## Initialize optional arguments ##
+        ###################################
+        # .ys directory
+        parser.add_argument("--config-dir", default="",
+                            help="path to the configuration directory")
+        parser.add_argument("--root-dir", default="",
+                            help="path to the root of the working directory")
 
-        sync = self._get_local_sync(verbose=True)
-        head_commit = self._get_head_commit()
+        # this option is applied not to all commands.
+        # Moreover, we can't write "yarsync -n 2 log" =>
+        # don't create an illusion
+        # that we can put an option at any place.
+        # However, the upside of leaving it here might be
+        # its better visibility during the general help
+        # (not for a subcommand).
+        # parser.add_argument(
+        #     "-n", "--dry-run", action="store_true",
+        #     default=False,
+        #     help="print what would be transferred during a real run, "
+        #          "but do not make any changes"
+        # )
 
-        try:
-            local_repo = self._get_repo_name_local()
-        except YSConfigurationError:
-            return CONFIG_ERROR
+        verbose_group = parser.add_mutually_exclusive_group()
+        verbose_group.add_argument("-q", "--quiet",
+                                   action="count",
+                                   # otherwise default will be None
+                                   default=0,
+                                   help="decrease verbosity")
+        verbose_group.add_argument("-v", "--verbose",
+                                   action="count",
+                                   default=0,
+                                   help="increase verbosity")
 
-        def print_logs(commit_log_list):
-            for ind, (commit, log) in enumerate(commit_log_list):
-                if ind:
-                    print()
-                self._print_log(
-                    commit, log,
-                    local_repo=local_repo, sync=sync, head_commit=head_commit
-                )
+        # this is not an option, but more like a separate command
+        parser.add_argument("--version", "-V", action="store_true",
+                            help="print version")
 
-        print_logs(commit_log_list)
+        # instrumentation
+        timings_group = parser.add_mutually_exclusive_group()
+        timings_group.add_argument(
+            "--timings", action="store_const", const="table",
+            help="print a table of times of command phases "
+                 "and subprocesses to stderr"
+        )
+        timings_group.add_argument(
+            "--timings-json", action="store_const", const="json",
+            dest="timings", help="print timings as JSON"
+        )
+        parser.add_argument(
+            "--profile", metavar="<file>",
+            help="write cProfile statistics to a file"
+        )
 
-        if not commit_log_list:
-            self._print("No commits found")
+        ############################
+        ## Initialize subcommands ##
+        ############################
+        # or sub-commands
 
-        return 0
+        # checkout #
+        parser_checkout = add_parser(
+            "checkout",
+            # help="check out a commit"
+            help="restore the working directory to a commit"
+        )
+        parser_checkout.add_argument(
+            "-n", "--dry-run", action="store_true",
+            default=False,
+            help="print what will be transferred during a real checkout, "
+                 "but don't make any changes"
+        )
+        # we write metavars <var> as in git,
+        # to distinguish them from rsync VAR.
+        parser_checkout.add_argument(
+            "commit", metavar="<commit>", help="commit name"
+        )
+        parser_checkout.set_defaults(func=self._checkout)
+
+        # clone #
+        parser_clone = add_parser(
+            "clone",
+            help="clone a local repository to remote or otherwise"
+        )
+        parser_clone.add_argument(
+            "name", metavar="<name>",
+            help="name of the clone",
+        )
+        parser_clone.add_argument(
+            "path", metavar="<path|parent path>",
+            help="path to the origin (from) "
+                 "or to the parent directory of the clone (to)"
+        )
+        parser_clone.add_argument(
+            "-f", "--force", action="store_true",
+            help="ignore remote rsync-filter (only for pull)"
+        )
+
+        # commit #
+        parser_commit = add_parser(
+            "commit", help="commit the working directory"
+        )
+        parser_commit.add_argument(
+            "-m", "--message", metavar="<message>", default="",
+            help="a string with the commit message"
+        )
+        parser_commit.add_argument(
+            "--limit", metavar="<number>", type=_check_positive,
+            help="maximum number of commits"
+        )
+        parser_commit.add_argument(
+            "--engine", choices=["rsync", "native"], default="rsync",
+            help="how to hard link the commit: with rsync "
+                 "or with parallel threads (default: rsync)"
+        )
+        parser_commit.add_argument(
+            "--discard-partial", action="store_true",
+            help="remove an interrupted commit instead of completing it"
+        )
+        parser_commit.add_argument(
+            "--gc", choices=["now", "background", "later"],
+            default="background",
+            help="when to delete removed commits from the trash: "
+                 "now, in a background process, or later with 'gc' "
+                 "(default: background)"
+        )
+
+        # diff #
+        parser_diff = add_parser(
+            "diff", help="print the difference between two commits"
+        )
+        parser_diff.add_argument(
+            "commit", metavar="<commit>", help="commit name"
+        )
+        parser_diff.add_argument(
+            "other_commit", metavar="<commit>", nargs="?", default=None,
+            help="other commit name"
+        )
+        parser_diff.set_defaults(func=self._diff)
+
+        # gc #
+        parser_gc = add_parser(
+            "gc", help="delete removed commits from the trash"
+        )
+        parser_gc.add_argument(
+            "-j", "--jobs", metavar="<number>", type=_check_positive,
+            help="number of threads"
+        )
+        parser_gc.add_argument(
+            "--dedup", action="store_true",
+            help="hard link identical files in commits "
+                 "and the working directory"
+        )
+        parser_gc.add_argument(
+            "-n", "--dry-run", action="store_true",
+            help="print how much space would be freed, but change nothing"
+        )
+
+        # init #
+        parser_init = add_parser("init", help="initialize a repository")
+        # add this option into the new release after improved testing.
+        # parser_init.add_argument(
+        #     "--merge", action="store_true", help="merge existing repositories"
+        # )
+        # reponame is used during commits
+        parser_init.add_argument(
+            "reponame", nargs="?", metavar="<reponame>",
+            help="name of the repository (for commits and logs)"
+        )
+
+        # log #
+        parser_log = add_parser(
+            "log", help="print commit logs"
+        )
+        parser_log.add_argument(
+            "-n", "--max-count", metavar="<number>",
+            type=int, default=-1,
+            help="maximum number of logs shown"
+        )
+        parser_log.add_argument("-r", "--reverse", action="store_true",
+                                help="reverse the order of the output")
+        parser_log.set_defaults(func=self._log)
+        # todo: log <commit_number>
+
+        # manifest #
+        parser_manifest = add_parser(
+            "manifest", help="print hashes and sizes of files"
+        )
+        parser_manifest.add_argument(
+            "commit", nargs="*", type=int, metavar="<commit>",
+            help="commits to include (default: all)"
+        )
+
+        # pull #
+        parser_pull = add_parser(
+            "pull", help="fetch data from source"
+        )
+
+        # mutually exclusive arguments
+        pull_group = parser_pull.add_mutually_exclusive_group()
+        force_help = "remove commits and logs missing on source"
+        pull_group.add_argument(
+            "-f", "--force", action="store_true",
+            help=force_help
+        )
+        pull_group.add_argument(
+            "--new", action="store_true",
+            help="do not remove local data that is missing on source"
+        )
+        pull_group.add_argument(
+            "-b", "--backup", action="store_true",
+            help="changed local files are renamed (not overwritten or ignored)"
+        )
+        pull_group.add_argument(
+            "--backup-dir", default="", metavar="DIR",
+            help="changed local files are put into DIR preserving their paths"
+        )
+
+        parser_pull.add_argument("source", metavar="<source>",
+                                 help="source name")
+
+        # push #
+        parser_push = add_parser(
+            "push", help="send data to a destination"
+        )
+        parser_push.add_argument(
+            "-f", "--force", action="store_true",
+            help=force_help
+        )
+        # we don't allow pushing new files to remote,
+        # because that could cause its inconsistent state
+        # (while locally we merge new files manually)
+        parser_push.add_argument(
+            "--all", action="store_true",
+            help="push to all remotes"
+        )
+        parser_push.add_argument(
+            "-j", "--jobs", metavar="<number>", type=_check_positive,
+            help="maximum number of simultaneous transfers "
+                 "to several remotes (default: all)"
+        )
+        parser_push.add_argument(
+            "--batch", action="store_true",
+            help="for several remotes in the same state, compute changes "
+                 "once and apply them with an rsync batch"
+        )
+        parser_push.add_argument(
+            "destination", metavar="<destination>", nargs="?",
+            help="destination or group name"
+        )
+
+        # common pull and push options
+        for pparser in (parser_pull, parser_push):
+            pparser.add_argument(
+                "-n", "--dry-run", action="store_true",
+                default=False,
+                help="print what would be transferred during a real run, "
+                     "but do not make any change"
+            )
+            pparser.add_argument(
+                "--refresh", action="store_true",
+                help="don't use cached remote configuration"
+            )
+            # pparser.add_argument(
+            #     # not sure whether -o would be a good shortening
+            #     # (-o might go for options)
+            #     "--overwrite", action="store_true",
+            #     default=False,
+            #     help="propagate file changes"
+            # )
+
+        # remote #
+        parser_remote = add_parser(
+            "remote", help="manage remote repositories"
+        )
+        # this is a different option from "yarsync -v" here.
+        parser_remote.add_argument(
+            "-v", "--verbose",
+            action="store_true",
+            # action="count",
+            help="print repository paths"
+        )
+        subparsers_remote = parser_remote.add_subparsers(
+            title="remote commands",
+            dest="remote_command",
+            help="type 'yarsync remote <command> --help' for additional help",
+            metavar="<command>",
+        )
+
+        # parse_intermixed_args is missing in Python 2,
+        # that's why we allow -v flag only after 'remote'.
+        #
+        # remote_parent_parser = argparse.ArgumentParser(add_help=False)
+        # remote_parent_parser.add_argument(
+        #     "-v", "--verbose", action="count",
+        #     help="show remote paths. Insert after a remote command"
+        # )
+        ## remote add
+        parser_remote_add = subparsers_remote.add_parser(
+            "add", help="add a remote"
+        )
+        parser_remote_add.add_argument(
+            "repository", metavar="<repository>",
+            help="repository name",
+        )
+        parser_remote_add.add_argument(
+            "path", metavar="<path>", help="repository path",
+        )
+        # not used yet.
+        # parser_remote_add.add_argument(
+        #     "options", nargs='*', help="repository options",
+        # )
+        ## remote rm
+        parser_remote_rm = subparsers_remote.add_parser(
+            "rm", help="remove a remote"
+        )
+        parser_remote_rm.add_argument(
+            "repository", metavar="<repository>",
+            help="repository name",
+        )
+
+        for remote_subparser in [parser_remote_add, parser_remote_rm]:
+            remote_subparser.set_defaults(func=self._remote)
+
+        ## remote show, default
+        parser_remote_show = subparsers_remote.add_parser(
+            "show", help="print remotes"
+        )
+        parser_remote_show.set_defaults(func=self._remote_show)
+
+        # serve #
+        parser_serve = add_parser(
+            "serve", help="run commands sent to a local socket"
+        )
+        parser_serve.add_argument(
+            "--socket", metavar="<path>",
+            help="path to the socket (default: $YARSYNC_SOCKET or "
+                 "$XDG_RUNTIME_DIR/yarsync-<uid>.sock)"
+        )
+        parser_serve.set_defaults(func=self._serve)
+
+        # show #
+        parser_show = add_parser(
+            "show", help="print log messages and actual changes for commit(s)"
+        )
+        parser_show.add_argument(
+            "-j", "--jobs", metavar="<number>", type=_check_positive,
+            help="number of commits compared in parallel"
+        )
+        parser_show.add_argument(
+            "commit", nargs="+", metavar="<commit>",
+            type=_check_commit_range,
+            help="commit name or an inclusive range <first>..<last> "
+                 "(either end can be omitted)"
+        )
+        parser_show.set_defaults(func=self._show)
+
+        # status #
+        parser_status = add_parser(
+            "status", help="print updates since last commit"
+        )
+        parser_status.add_argument(
+            "--check", action="store_true",
+            help="print nothing and return {} if there are uncommitted "
+                 "changes".format(COMMAND_ERROR)
+        )
+        parser_status.add_argument(
+            "-c", "--checksum", action="store_true",
+            help="compare files of the same size by their contents"
+        )
+        parser_status.set_defaults(func=self._status)
+
+        # verify #
+        parser_verify = add_parser(
+            "verify", help="compare files with a remote by their hashes"
+        )
+        parser_verify.add_argument(
+            "remote", metavar="<remote>", help="name of the remote"
+        )
+        parser_verify.add_argument(
+            "commit", nargs="*", type=int, metavar="<commit>",
+            help="commits to compare (default: all common commits)"
+        )
+
+        # watch #
+        parser_watch = add_parser(
+            "watch", help="record changed paths for faster status"
+        )
+        parser_watch.set_defaults(func=self._watch)
+
+        for hparser in [parser_manifest, parser_verify]:
+            hparser.add_argument(
+                "-j", "--jobs", metavar="<number>", type=_check_positive,
+                help="number of processes for hashing"
+            )
+            hparser.add_argument(
+                "--rehash", action="store_true",
+                help="read all files, don't use cached hashes"
+            )
+
+        # machine-readable output
+        for fparser in [parser_diff, parser_log, parser_pull, parser_push,
+                        parser_status]:
+            fparser.add_argument(
+                "--format", choices=["text", "json"], default="text",
+                help="output format. json prints one object per line "
+                     "and other messages to stderr (default: text)"
+            )
+
+        # summaries of differences between commits
+        for sparser in [parser_diff, parser_log, parser_show]:
+            sparser.add_argument(
+                "--stat", action="store_true",
+                help="print numbers of added, removed and modified files "
+                     "and the change of their sizes for each directory"
+            )
+            sparser.add_argument(
+                "--stat-depth", metavar="<number>", type=_check_positive,
+                default=1,
+                help="directory depth for --stat (default: 1)"
+            )
+
+        # status, pull and push compare the working directory
+        # with the last commit, diff and show compare two commits
+        engine_help = {
+            parser_diff: "how to compare commits",
+            parser_log: "how to compare commits for --stat",
+            parser_show: "how to compare commits",
+            parser_status: "how to find changes since the last commit",
+            parser_pull: "how to check for uncommitted changes",
+            parser_push: "how to check for uncommitted changes",
+        }
+        for eparser, ehelp in engine_help.items():
+            eparser.add_argument(
+                "--engine", choices=["rsync", "native"], default="rsync",
+                help=ehelp + " (default: rsync)"
+            )
+
+        if command is not None and not added:
+            return None
+        return parser
+
+    def _make_pull_push_command(
+            self, command_name, full_destpath, dry_run=False, new=False,
+            backup=False, backup_dir="", include_configs=()
+        ):
+        """Return rsync command for pull or push."""
+        # --link-dest is not needed, since if a file is new,
+        # it won't be in remote commits.
+        # -H preserves hard links in one set of files (but see the note in todo.txt).
+        command = ["rsync"]
+        command.extend(self.RSYNCOPTIONS)
+        # Don't print progress by default,
+        # because it clutters output for new commits.
+        # (it will create an additional line for each file
+        #  and will require extra work to get rid of it).
+        if self._transfers is not None or self._format == "json":
+            command.append("--itemize-changes")
+        elif self.print_level >= 3:
+            command.append("-P")
+
+        if dry_run:
+            command.append("-n")
+
+        command.append("--no-inc-recursive")
+        if not new:
+            command.append("--delete")
+
+        if backup:
+            if backup_dir:
+                # create a full hierarchy in the backup_dir
+                command.extend(["--backup-dir", backup_dir])
+            # --backup is implied during --backup-dir
+            # only since this pull request in 2020
+            # https://github.com/WayneD/rsync/pull/35
+            # write new files near originals
+            command.append("--backup")
+        # allow after a fix of https://github.com/WayneD/rsync/issues/357
+        # elif not overwrite:
+        #     command.append("--ignore-existing")
+        #     command_str += " --ignore-existing"
+
+        # we don't include commits (filter them in)
+        # only if we do backups
+        include_commits = not backup
+        filter_ = self._get_filter(
+            include_commits=include_commits,
+            include_configs=include_configs
+        )
+        command.extend(filter_)
+
+        root_path = self.root_dir + "/"
+        if command_name == "push":
+            command.extend([root_path, full_destpath])
+        else:
+            # pull
+            command.extend([full_destpath, root_path])
+        return command
+
+    def _manifest(self, commits=None, jobs=None, rehash=False):
+        """Print lines *"hash size path"* for files
+        in the working directory and *commits* (all by default).
+
+        See *_make_manifest* for details.
+        """
+        errors = []
+        try:
+            manifest = self._make_manifest(commits, jobs=jobs, rehash=rehash,
+                                           errors=errors)
+        except ValueError as err:
+            _print_error(err)
+            return COMMAND_ERROR
+        for path in sorted(manifest):
+            print(_manifest_line(path, *manifest[path]))
+        # rsync returns 23 for a partial transfer due to error
+        return 23 if errors else 0
+
+    def _is_remote_group(self, name):
+        """A *name* is a group if it is not a remote,
+        but it is present in the *groups* of some remotes.
+        """
+        return name not in self._configdict and bool(self._get_remotes(name))
+
+    def _listdir(self, path):
+        """List a directory inside the configuration directory.
+
+        The result can be taken from the index.
+        """
+        if self._index is None:
+            return os.listdir(path)
+        return self._index.listdir(path)
+
+    @contextlib.contextmanager
+    def _lock(self, path, blocking=False):
+        """Hold an exclusive lock on the file or directory *path*
+        in the context. A missing file is created.
+
+        The context value is ``False`` if *blocking* is ``False``
+        and the lock is held by another process.
+        """
+        import fcntl
+        if os.path.isdir(path):
+            lock_fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        else:
+            lock_fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC,
+                              0o600)
+        try:
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_fd, flags)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+        finally:
+            # closing releases the lock
+            os.close(lock_fd)
+
+    def _log(self):
+        """Print commits and log information.
+
+        If only a commit or only a log are present, they are listed as well.
+
+        By default most recent commits are printed first.
+        Set *reverse* to ``False`` to print last commits last.
+        """
+        reverse = self._args.reverse
+        max_count = self._args.max_count
+
+        cl_list = self._make_commit_list()
+
+        if not reverse:
+            commit_log_list = list(reversed(cl_list))
+        else:
+            commit_log_list = cl_list
+        if max_count != -1:
+            # otherwise the last element is excluded
+            commit_log_list = commit_log_list[:max_count]
+
+        sync = self._get_local_sync(verbose=True)
+        head_commit = self._get_head_commit()
+
+        try:
+            local_repo = self._get_repo_name_local()
+        except YSConfigurationError:
+            return CONFIG_ERROR
+
+        # with --stat, differences with previous commits
+        # (nothing is computed until they are requested)
+        all_commits = []
+        stat_commits = []
+        if self._stat_depth is not None:
+            all_commits = sorted(self._get_local_commits())
+            stat_commits = [commit for commit, _ in commit_log_list
+                            if commit is not None]
+        diffs = self._previous_diffs(
+            stat_commits, all_commits,
+            engine=getattr(self._args, "engine", "rsync")
+        )
+        returncode = 0
+
+        def print_stat(commit):
+            nonlocal returncode
+            if self._stat_depth is None or commit is None:
+                return
+            if self._format == "text":
+                stats = self._read_commit_stats(commit)
+                if stats is not None:
+                    print(_format_commit_stats(stats))
+            if _previous_commit(all_commits, commit) is None:
+                return
+            stat, diff_returncode = next(diffs)
+            self._print_diff_stat(stat)
+            returncode = diff_returncode or returncode
+
+        def print_logs(commit_log_list):
+            if self._format == "json":
+                for commit, log in commit_log_list:
+                    entry = self._log_entry(commit, log, local_repo, sync,
+                                            head_commit)
+                    data = {"type": "commit"}
+                    data.update(entry._asdict())
+                    self._print_json(data)
+                    print_stat(commit)
+                return
+            for ind, (commit, log) in enumerate(commit_log_list):
+                if ind:
+                    print()
+                self._print_log(
+                    commit, log,
+                    local_repo=local_repo, sync=sync, head_commit=head_commit
+                )
+                print_stat(commit)
+
+        with contextlib.closing(diffs):
+            print_logs(commit_log_list)
+
+        if not commit_log_list:
+            self._print("No commits found")
+
+        return returncode
+
+    def _log_entry(self, commit, log, local_repo, sync, head_commit=None):
+        """Return a LogEntry for a *commit* and its *log*
+        (one of them can be ``None``, as in _make_commit_list).
+        """
+        message = None
+        if log is not None:
+            with open(os.path.join(self.LOGDIR, str(log) + ".txt")) as fil:
+                message = fil.read()
+        exists = commit is not None
+        if not exists:
+            commit = log
+        synced = []
+        if commit in sync.by_repos.values():
+            synced = sync.get_synced_repos_for(commit,
+                                               exclude_repo=local_repo)
+        return LogEntry(commit, message, exists, commit == head_commit,
+                        synced, self._read_commit_stats(commit))
+
+    def _previous_diffs(self, commits, all_commits, engine="rsync",
+                        jobs=None):
+        """Yield differences of *commits* with their previous commits
+        in the sorted list *all_commits*.
+
+        Commits without a previous one are skipped.
+        Differences are computed by *jobs* threads (see *_ordered_map*)
+        and yielded in the order of *commits* as pairs
+        *(stat, returncode)* of *_diff_stat* with *--stat*
+        or *(lines, returncode)* of *_diff_lines* otherwise.
+        """
+        def diff(commit):
+            previous = _previous_commit(all_commits, commit)
+            if self._stat_depth is not None:
+                return self._diff_stat(previous, commit, engine=engine,
+                                       verbose=False)
+            # output is buffered to be printed in order
+            lines, finish = self._diff_lines(previous, commit,
+                                             engine=engine, verbose=False)
+            lines = list(lines)
+            return (lines, finish())
+
+        commits = [commit for commit in commits
+                   if _previous_commit(all_commits, commit) is not None]
+        return _ordered_map(diff, commits, jobs)
 
     def _print(self, *args, level=None, **kwargs):
         """Print output messages."""
@@ -2021,8 +4792,11 @@ def _print(self, *args, level=None, **kwargs):
 
         if level > self.print_level:
             return
+        if self._format == "json":
+            # stdout is reserved for data
+            kwargs.setdefault("file", sys.stderr)
         if level > self._default_print_level:
-            print("# ", end='')
+            print("# ", end='', file=kwargs.get("file"))
         print(*args, **kwargs)
 
     def _print_command(self, command, level=None):
@@ -2047,6 +4821,37 @@ def command_str(command):
             # list
             self._print(" ".join(command_str(command)), level=level)
 
+    def _print_changes(self, lines):
+        """Print rsync itemized *lines* (bytes) in the output format."""
+        if self._format == "json":
+            for change in filter(None, map(_parse_change, lines)):
+                self._print_json(_change_dict(change))
+        else:
+            for line in lines:
+                print(line.decode("utf-8"), end='')
+
+    def _print_diff_stat(self, stat):
+        """Print totals of a _DiffStat *stat* for each directory."""
+        fields = ["added", "removed", "modified", "bytes"]
+        rows = sorted(stat.dirs.items())
+        if self._format == "json":
+            for directory, totals in rows:
+                data = {"type": "stat", "directory": directory}
+                data.update(zip(fields, totals))
+                self._print_json(data)
+            data = {"type": "stat_total"}
+            data.update(zip(fields, stat.total()))
+            self._print_json(data)
+            return
+        width = max([len(directory) for directory, _ in rows] + [6])
+        for directory, totals in rows + [("total:", stat.total())]:
+            print("{:<{}} {} added, {} removed, {} modified, {:+,} bytes"
+                  .format(directory, width, *totals))
+
+    def _print_json(self, data):
+        """Print *data* as one line of JSON."""
+        print(json.dumps(data))
+
     def _print_log(self, commit, log, local_repo, sync, head_commit=None):
         if commit is None:
             commit_str = "commit {} is missing".format(log)
@@ -2080,10 +4885,40 @@ def _print_log(self, commit, log, local_repo, sync, head_commit=None):
         self._print(commit_str, log_str, sep='\n', end='')
         # print(commit_str, log_str, sep='\n', end='')
 
+    def _print_timings(self):
+        """Print timings to stderr in the format from the command line."""
+        if self._args.timings == "json":
+            json.dump(self._timings.to_dict(), sys.stderr, indent=1)
+            print(file=sys.stderr)
+        else:
+            print(self._timings.format_table(), file=sys.stderr)
+
     def _print_version(self):
         print(self.NAME, "version", __version__)
         # todo: print rsync version and whether it supports hard links
 
+    def _move_to_trash(self, path):
+        """Move *path* to the trash (to be deleted by *gc*)."""
+        if not os.path.exists(self.TRASHDIR):
+            self._print_command("mkdir {}".format(self.TRASHDIR), level=3)
+            os.mkdir(self.TRASHDIR)
+        # a unique directory, names of removed commits can repeat.
+        # gc doesn't list the trash until the move is complete
+        import tempfile
+        with self._lock(self.TRASHDIR, blocking=True):
+            trash_dir = tempfile.mkdtemp(prefix=os.path.basename(path) + "_",
+                                         dir=self.TRASHDIR)
+            trash_path = os.path.join(trash_dir, os.path.basename(path))
+            self._print_command("mv {} {}".format(path, trash_path),
+                                level=3)
+            os.rename(path, trash_path)
+
+    def _popen(self, command, **kwargs):
+        """Start a subprocess (timed with *--timings*)."""
+        if self._timings is None:
+            return subprocess.Popen(command, **kwargs)
+        return _TimedPopen(self._timings, command, **kwargs)
+
     def _pull_push(
             self, command_name, remote,
             dry_run=False,
@@ -2106,96 +4941,22 @@ def _pull_push(
 
         *overwrite* is temporarily disabled until rsync fixes.
         """
-
-        if self._get_head_commit() is not None:
-            # it could be safe to push a repo with a detached HEAD,
-            # but that would be messy.
-            # OSError is for exceptions
-            # that can occur outside the Python system
-            raise OSError("local repository has detached HEAD.\n"
-                          "*checkout* the most recent commit first.")
-        if os.path.exists(self.MERGEFILE):
-            raise OSError(
-                "local repository has unmerged changes.\n"
-                "Manually update the working directory and *commit*."
-            )
-
-        # otherwise will be called in _status below
-        try:
-            local_repo = self._get_repo_name_local()
-        except YSConfigurationError:
-            # the error is printed
-            return CONFIG_ERROR
-
-        if not (new or force):
-            returncode, changed = self._status(check_changed=True)
-            if changed:
-                _print_error(
-                    "local repository has uncommitted changes. Exit.\n  "
-                    "Run '{} status' for more details.".format(self.NAME)
-                )
-                return COMMAND_ERROR
-            if returncode:
-                _print_error(
-                    "could not check for uncommitted changes, "
-                    "rsync returned {}. Exit\n  ".format(returncode) +
-                    "Run '{} status' for more details.".format(self.NAME)
-                )
-                return returncode  # COMMAND_ERROR
+        with self._span("check local repository"):
+            returncode, local_repo = self._check_local_repo(new=new,
+                                                            force=force)
+        if returncode:
+            return returncode
 
         try:
             full_destpath = self._get_dest_path(remote)
         except KeyError as err:
             raise err from None
 
-        # --link-dest is not needed, since if a file is new,
-        # it won't be in remote commits.
-        # -H preserves hard links in one set of files (but see the note in todo.txt).
-        command = ["rsync"]
-        command.extend(self.RSYNCOPTIONS)
-        # Don't print progress by default,
-        # because it clutters output for new commits.
-        # (it will create an additional line for each file
-        #  and will require extra work to get rid of it).
-        if self.print_level >= 3:
-            command.append("-P")
-
-        if dry_run:
-            command.append("-n")
-
-        command.append("--no-inc-recursive")
-        if not new:
-            command.append("--delete")
-
-        if backup:
-            if backup_dir:
-                # create a full hierarchy in the backup_dir
-                command.extend(["--backup-dir", backup_dir])
-            # --backup is implied during --backup-dir
-            # only since this pull request in 2020
-            # https://github.com/WayneD/rsync/pull/35
-            # write new files near originals
-            command.append("--backup")
-        # allow after a fix of https://github.com/WayneD/rsync/issues/357
-        # elif not overwrite:
-        #     command.append("--ignore-existing")
-        #     command_str += " --ignore-existing"
-
-        # we don't include commits (filter them in)
-        # only if we do backups
-        include_commits = not backup
-        filter_ = self._get_filter(
-            include_commits=include_commits,
+        command = self._make_pull_push_command(
+            command_name, full_destpath, dry_run=dry_run, new=new,
+            backup=backup, backup_dir=backup_dir,
             include_configs=include_configs
         )
-        command.extend(filter_)
-
-        root_path = self.root_dir + "/"
-        if command_name == "push":
-            command.extend([root_path, full_destpath])
-        else:
-            # pull
-            command.extend([full_destpath, root_path])
 
         # old local commits (before possible pull)
         local_commits = list(self._get_local_commits())
@@ -2207,11 +4968,16 @@ def _pull_push(
             remote_config = _Config({}, allow_empty=True)
         else:
             try:
-                remote_config = self._get_remote_config(
-                    remote_config_dir,
-                    # don't complain about errors
-                    print_level=self._default_print_level+2
-                )
+                with self._span("read remote configuration"):
+                    remote_config = self._get_remote_config(
+                        remote_config_dir,
+                        # don't complain about errors
+                        print_level=self._default_print_level+2,
+                        # missing commits are checked before a real
+                        # transfer with --delete, a stale cache is unsafe
+                        ttl=self._get_cache_ttl(remote) if dry_run else 0,
+                        refresh=getattr(self._args, "refresh", False)
+                    )
             except OSError:
                 _print_error("remote contains no yarsync repository")
                 return CONFIG_ERROR
@@ -2229,38 +4995,14 @@ def _pull_push(
             # pull
             source_commits = remote_commits
             dest_commits = local_commits
-            rmcomm = set(remote_commits)
-            missing_commits = [comm for comm in local_commits
-                               if comm not in rmcomm]
-
-        # use a set to economize testing membership in a list,
-        # https://stackoverflow.com/a/3462202/952234
-        # Can move into the comprehension. Not used anywhere else.
-        # https://docs.python.org/3/reference/simple_stmts.html#grammar-token-python-grammar-target_list
-        _source_commits = set(source_commits)
-        missing_commits = [comm for comm in dest_commits
-                           if comm not in _source_commits]
-
-        commit_limit = self._get_commit_limit()
-        if not (force or new or commit_limit is not None) and missing_commits:
-            missing_commits_str = ", ".join(map(str, missing_commits))
-            raise OSError(
-                "\ndestination has commits missing on source: {}, "\
-                .format(missing_commits_str) +
-                "synchronize these commits first:\n"
-                "1) pull missing commits with 'pull --new',\n"
-                "2) push if these commits were successfully merged, or\n"
-                "2') optionally checkout,\n"
-                "3') manually update the working directory "
-                "to the desired state, commit and push, or\n"
-                "1') pull/push --force the desired state "
-                "(removing all commits and logs missing on the destination)."
-            )
+        self._check_missing_commits(source_commits, dest_commits,
+                                    force=force, new=new)
 
-        if self.print_level >= 3:
-            stdout = None
-        elif self.print_level == 2:
+        if (self._transfers is not None or self._format == "json"
+                or self.print_level == 2):
             stdout = subprocess.PIPE
+        elif self.print_level >= 3:
+            stdout = None
         else:
             stdout = subprocess.DEVNULL
 
@@ -2278,7 +5020,8 @@ def _pull_push(
                 (remote, last_commit)
             ])
             try:
-                self._write_sync(local_sync)
+                with self._span("write synchronization"):
+                    self._write_sync(local_sync)
             except OSError as err:
                 _print_error("could not log synchronization to {}. Abort."
                              .format(self.SYNCDIR))
@@ -2286,54 +5029,35 @@ def _pull_push(
             # object attribute to reverse sync easier 
             self._sync = local_sync
 
+        self._add_ssh_options(command)
         # ----------------------------------------------------------
         #         Run
         self._print_command(command, level=3)
-        completed_process = subprocess.Popen(command, stdout=stdout)
+        completed_process = self._popen(command, stdout=stdout)
         # ----------------------------------------------------------
 
-        _ysdir = self.YSDIR
-        if self.print_level == 2:
+        if self._transfers is not None:
+            self._transfers.extend(
+                iter(completed_process.stdout.readline, b'')
+            )
+        elif self._format == "json":
+            lines = iter(completed_process.stdout.readline, b'')
+            for item in _transfer_items(lines):
+                self._print_json(_transfer_dict(item, remote))
+        elif self.print_level == 2:
             # if we transfer a whole commit, merge all its output into one line.
             # Print transfers only for the working directory and existing commits.
             commits_to_transfer = set(source_commits) - set(dest_commits)
-            transferred_commits = set()
-            for line in iter(completed_process.stdout.readline, b''):
-                # iteration copied from https://stackoverflow.com/a/1606870/952234
-                # Not self.COMMITDIR, because it involves the complete path.
-                COMMITDIR = os.path.join(_ysdir, "commits")
-                if line.startswith(bytes(COMMITDIR, "utf-8")):
-                    # commits
-                    com_start = len(COMMITDIR) + 1
-                    # or os.sep
-                    com_end = line.find(b'/', com_start)
-                    com_str = line[com_start:com_end]
-                    if not com_str:
-                        # ".ys/commits/"
-                        print(line.decode("utf-8"), end='')
-                        continue
-                    cur_commit = int(com_str)
-                    if cur_commit in commits_to_transfer:
-                        # don't print transfers for complete new commits.
-                        transferred_commits.add(cur_commit)
-                    else:
-                        # print changes for existing commits
-                        print(line.decode("utf-8"), end='')
-                else:
-                    # working directory
-                    print(line.decode("utf-8"), end='')
-            # there can be also lines like
-            # file => .ys/commits/.../file
-            # leave them as they are.
-            #
-            # actually, this may be only part of the data
-            # (if there is no space left)
-            print()  # "data transferred for commits:")
-            for comm in sorted(transferred_commits):
-                print("commit", comm)
+            lines = iter(completed_process.stdout.readline, b'')
+            # iteration copied from https://stackoverflow.com/a/1606870/952234
+            for line in self._transfer_lines(lines, commits_to_transfer):
+                print(line, end='')
 
         # need to wait even if stdout was exhausted
         completed_process.wait()
+        if not dry_run:
+            # the remote has changed
+            self._remove_remote_cache(remote_config_dir)
 
         returncode = completed_process.returncode
         if returncode:
@@ -2410,7 +5134,8 @@ def _pull_push(
                 (remote, last_commit)
             ])
             try:
-                self._write_sync(remote_sync)
+                with self._span("write remote synchronization"):
+                    self._write_sync(remote_sync)
             except OSError as err:
                 _print_error(err.strerror)
                 _print_error("data transferred, but could not "
@@ -2424,6 +5149,236 @@ def _pull_push(
 
         return 0
 
+    def _push_many(self, group=None, dry_run=False, force=False, jobs=None,
+                   batch=False):
+        """Push to all remotes in the *group* (or to all remotes).
+
+        Local checks are made once. Remote configurations are read
+        and transfers are run in parallel (at most *jobs* at a time),
+        their output is prefixed with remote names.
+        Synchronization information of all remotes is merged
+        and written once before the transfers
+        (so that it is sent to every remote).
+
+        If *batch* is ``True``, remotes with the same commits
+        and the same last synchronized commit get the changes
+        from an rsync batch file, written during the transfer
+        to the first of them. If the batch could not be applied,
+        the remote is synchronized normally.
+
+        Return the first non-zero return code of remotes or 0.
+        """
+        import concurrent.futures
+        import shutil
+        import tempfile
+
+        with self._span("check local repository"):
+            returncode, local_repo = self._check_local_repo(force=force)
+        if returncode:
+            return returncode
+
+        remotes = self._get_remotes(group)
+        if not remotes:
+            _print_error("no remotes found in {}".format(self.CONFIGFILE))
+            return CONFIG_ERROR
+        if jobs is None:
+            jobs = len(remotes)
+
+        local_commits = list(self._get_local_commits())
+        local_sync = self._get_local_sync(verbose=True)
+        synced_commits = dict(local_sync.by_repos)
+        # lines of different remotes are not mixed
+        print_lock = threading.Lock()
+
+        def print_remote(remote, line, file=sys.stdout):
+            if self._format == "json" and file is sys.stdout:
+                file = sys.stderr
+            with print_lock:
+                print("{}: {}".format(remote, line), end='', file=file)
+
+        def prepare(remote):
+            # return the remote configuration or an error code
+            full_destpath = self._get_dest_path(remote)
+            try:
+                with self._span("read remote configuration of " + remote):
+                    remote_config = self._get_remote_config(
+                        os.path.join(full_destpath, ".ys/"),
+                        print_level=self._default_print_level+2,
+                        # missing commits are checked before a real
+                        # transfer with --delete, a stale cache is unsafe
+                        ttl=self._get_cache_ttl(remote) if dry_run else 0,
+                        refresh=getattr(self._args, "refresh", False)
+                    )
+            except OSError:
+                print_remote(remote, "remote contains no yarsync repository\n",
+                             file=sys.stderr)
+                return CONFIG_ERROR
+            except YSConfigurationError as err:
+                print_remote(remote, "could not read remote configuration. "
+                             + err.msg + "\n", file=sys.stderr)
+                return CONFIG_ERROR
+            try:
+                self._check_missing_commits(local_commits,
+                                            remote_config.commits, force=force)
+            except OSError as err:
+                print_remote(remote, str(err).lstrip() + "\n", file=sys.stderr)
+                return COMMAND_ERROR
+            return remote_config
+
+        def transfer(remote, write_batch=None, read_batch=None):
+            remote_config = remote_configs[remote]
+            full_destpath = self._get_dest_path(remote)
+            command = self._make_pull_push_command(
+                "push", full_destpath, dry_run=dry_run
+            )
+            if write_batch:
+                command.insert(-2, "--write-batch=" + write_batch)
+            elif read_batch:
+                # the source is read from the batch
+                command[-2:] = ["--read-batch=" + read_batch, full_destpath]
+            self._add_ssh_options(command)
+            self._print_command(command, level=3)
+            if self._format == "json":
+                sp = self._popen(command, stdout=subprocess.PIPE)
+            elif self.print_level >= 2:
+                # errors are printed with the remote name as well
+                sp = self._popen(command, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+            else:
+                sp = self._popen(command, stdout=subprocess.DEVNULL)
+
+            if self._format == "json":
+                lines = iter(sp.stdout.readline, b'')
+                for item in _transfer_items(lines):
+                    data = json.dumps(_transfer_dict(item, remote))
+                    with print_lock:
+                        print(data)
+            elif self.print_level >= 2:
+                lines = iter(sp.stdout.readline, b'')
+                if self.print_level == 2:
+                    commits_to_transfer = set(local_commits)\
+                                          - set(remote_config.commits)
+                    lines = self._transfer_lines(lines, commits_to_transfer)
+                else:
+                    lines = (line.decode("utf-8") for line in lines)
+                for line in lines:
+                    # empty lines separate nothing in the mixed output
+                    if line != "\n":
+                        print_remote(remote, line)
+            sp.wait()
+            if not dry_run:
+                # the remote has changed
+                self._remove_remote_cache(os.path.join(full_destpath, ".ys/"))
+
+            if sp.returncode:
+                print_remote(remote, "an error occurred, rsync returned {}\n"
+                             .format(sp.returncode), file=sys.stderr)
+            elif not remote_config.commits:
+                print_remote(remote, "remote commits missing\n")
+            return sp.returncode
+
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            prepared = list(executor.map(prepare, remotes))
+
+        returncodes = []
+        remote_configs = {}
+        for remote, result in zip(remotes, prepared):
+            if isinstance(result, _Config):
+                remote_configs[remote] = result
+            else:
+                returncodes.append(result)
+        if not remote_configs:
+            return returncodes[0]
+        if not local_commits:
+            self._print("local commits missing")
+
+        # push synchronization information to all remotes
+        if not dry_run and not force:
+            last_commit = self._get_last_commit()
+            local_sync.update([(local_repo, last_commit)])
+            for remote, remote_config in remote_configs.items():
+                local_sync.update(remote_config.sync.by_repos.items())
+                local_sync.update([(remote, last_commit)])
+            try:
+                with self._span("write synchronization"):
+                    self._write_sync(local_sync)
+            except OSError as err:
+                _print_error("could not log synchronization to {}. Abort."
+                             .format(self.SYNCDIR))
+                raise err
+
+        # {first remote: other remotes in the same state}
+        batches = {}
+        if batch and not dry_run:
+            states = collections.defaultdict(list)
+            for remote in sorted(remote_configs):
+                synced_commit = synced_commits.get(remote)
+                if synced_commit is None:
+                    continue
+                commits = tuple(sorted(remote_configs[remote].commits))
+                states[(synced_commit, commits)].append(remote)
+            for same_remotes in states.values():
+                if len(same_remotes) > 1:
+                    batches[same_remotes[0]] = same_remotes[1:]
+
+        def replay(remote, batch_file):
+            if batch_file is not None:
+                returncode = transfer(remote, read_batch=batch_file)
+                if not returncode:
+                    return 0
+            print_remote(remote, "batch could not be applied, "
+                         "synchronizing normally\n", file=sys.stderr)
+            return transfer(remote)
+
+        batch_dir = None
+        if batches:
+            os.makedirs(self.CACHEDIR, exist_ok=True)
+            batch_dir = tempfile.mkdtemp(prefix="batch_", dir=self.CACHEDIR)
+        batch_files = {remote: os.path.join(batch_dir, remote)
+                       for remote in batches}
+        replayed = [remote for others in batches.values() for remote in others]
+        try:
+            with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+                first_remotes = [remote for remote in sorted(remote_configs)
+                                 if remote not in replayed]
+                first_codes = list(executor.map(
+                    lambda remote: transfer(
+                        remote, write_batch=batch_files.get(remote)
+                    ),
+                    first_remotes
+                ))
+                returncodes.extend(first_codes)
+                replays = []
+                for remote, returncode in zip(first_remotes, first_codes):
+                    # a failed transfer could write an incomplete batch
+                    batch_file = None if returncode else batch_files.get(remote)
+                    for other in batches.get(remote, []):
+                        replays.append((other, batch_file))
+                returncodes.extend(executor.map(lambda args: replay(*args),
+                                                replays))
+        finally:
+            if batch_dir is not None:
+                shutil.rmtree(batch_dir, ignore_errors=True)
+
+        if not dry_run:
+            self._update_head()
+
+        # the first error or 0
+        return next(filter(None, returncodes), 0)
+
+    def _read_commit_stats(self, commit):
+        """Return statistics of a *commit* (see *_commit_stats*)
+        or ``None`` if they were not recorded.
+        """
+        try:
+            with open(self.COMMITSTATSFILE.format(commit)) as fil:
+                stats = json.load(fil)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(stats, dict):
+            return None
+        return stats
+
     def _read_config(self, config_text):
 
         # substitute environmental variables (those that are available)
@@ -2432,6 +5387,7 @@ def _read_config(self, config_text):
 
         # no value is allowed
         # for a configuration key "host_from_section_name"
+        import configparser
         config = configparser.ConfigParser(allow_no_value=True)
         config.read_string(subst_lines)
 
@@ -2478,6 +5434,45 @@ def _read_config(self, config_text):
         # config.items() includes the DEFAULT section, which can't be removed.
         return (config, configdict)
 
+    def _read_remote_cache(self, cache_file, config_path, ttl):
+        """Return cached remote files if they are younger than *ttl*
+        or ``None``.
+        """
+        def load(path):
+            with open(path) as fil:
+                return json.load(fil)
+
+        try:
+            if self._warm is not None:
+                cache = self._warm.load(cache_file, load)
+            else:
+                cache = load(cache_file)
+            age = time.time() - cache["time"]
+            if cache["path"] != config_path or not 0 <= age < ttl:
+                return None
+            remote_files = cache["files"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        self._print("# use remote configuration cached {:.0f} s ago"
+                    .format(age), level=3)
+        return remote_files
+
+    def _read_ys_file(self, path):
+        """Return the contents of a file in the configuration directory.
+
+        The result can be taken from the index.
+        """
+        if self._index is None:
+            with open(path) as fil:
+                return fil.read()
+        return self._index.read(path)
+
+    def _remove_remote_cache(self, config_path):
+        try:
+            os.remove(self._get_remote_cache_file(config_path))
+        except FileNotFoundError:
+            pass
+
     def _remote(self):
         """Manage remotes."""
         # Since self._func() is called without arguments,
@@ -2493,6 +5488,7 @@ def _remote(self):
 
     def _remote_add(self, remote, path, options=""):
         """Add a remote and its path to the config file."""
+        import configparser
         # from https://docs.python.org/2.7/library/configparser.html#examples
         if not hasattr(self, "_config"):
             # config might be missing if we first call 'init'
@@ -2549,151 +5545,218 @@ def _remote_show(self):
         if not self._config.sections():
             self._print("No remotes found.")
 
-    def _show(self, commits=None):
+    def _run(self, command, **kwargs):
+        """Run a subprocess and wait for it (timed with *--timings*)."""
+        with self._span(" ".join(command), kind="process"):
+            return subprocess.run(command, **kwargs)
+
+    def _serve(self):
+        """Run commands sent to a Unix socket until interrupted.
+
+        Requests are run one at a time, and the state of repositories
+        is kept between them (see _Warm).
+        """
+        import socket
+        path = self._args.socket or _get_socket_path()
+        if not path:
+            _print_error("socket path is empty")
+            return COMMAND_ERROR
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if os.path.exists(path):
+                try:
+                    sock.connect(path)
+                except OSError:
+                    # left after a killed service
+                    os.remove(path)
+                else:
+                    _print_error("{} serve is already running at {}"
+                                 .format(self.NAME, path))
+                    return COMMAND_ERROR
+                sock.close()
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            # commands are run with our permissions,
+            # therefore other users may not connect
+            umask = os.umask(0o177)
+            try:
+                sock.bind(path)
+            finally:
+                os.umask(umask)
+            sock.listen()
+            self._print("# listening on {}".format(path), level=2)
+            # our subprocesses (like manifest for verify)
+            # must not wait for us
+            os.environ["YARSYNC_SOCKET"] = ""
+            # commands cancelled by clients are interrupted
+            # together with their subprocesses (see _serve_request)
+            if os.getpgid(0) != os.getpid():
+                os.setpgid(0, 0)
+            YARsync._warm = _Warm()
+            try:
+                while True:
+                    conn, _ = sock.accept()
+                    with conn:
+                        _serve_request(conn)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                YARsync._warm = None
+                os.remove(path)
+        finally:
+            sock.close()
+        return 0
+
+    def _show(self, commits=None, jobs=None):
         """Show commit(s).
 
         Print log and difference with the previous commit
         for each commit.
+        *commits* are commits or ranges *(first, last)*
+        of existing commits (see *_check_commit_range*).
+        Differences are computed by *jobs* threads
+        and printed in the order of commits.
         """
         # commits argument is for testing
         if commits is None:
-            commits = [int(commit) for commit in self._args.commit]
+            commits = self._args.commit
+            jobs = self._args.jobs
+        engine = getattr(self._args, "engine", "rsync")
 
         all_commits = sorted(self._get_local_commits())
+        selected = set()
         for commit in commits:
-            if commit not in all_commits:
+            if isinstance(commit, tuple):
+                first, last = commit
+                start = 0
+                if first is not None:
+                    start = bisect.bisect_left(all_commits, first)
+                end = len(all_commits)
+                if last is not None:
+                    end = bisect.bisect_right(all_commits, last)
+                selected.update(all_commits[start:end])
+                continue
+            ind = bisect.bisect_left(all_commits, commit)
+            if ind == len(all_commits) or all_commits[ind] != commit:
                 raise ValueError(
                     "no commit {} found".format(commit)
                 )
+            selected.add(commit)
+        if not selected:
+            _print_error("no commits in the given range")
+            return COMMAND_ERROR
 
         # commit logs can be None
-        commits_with_logs = self._make_commit_list(commits=commits)
+        commits_with_logs = self._make_commit_list(commits=sorted(selected))
         sync = self._get_local_sync(verbose=True)
         try:
             local_repo = self._get_repo_name_local()
         except YSConfigurationError:
             return CONFIG_ERROR
 
-        for ind, cl in enumerate(commits_with_logs):
-            commit, log = cl
-            # print log
-            if ind:
-                print()
-            self._print_log(commit=commit, log=log,
-                            local_repo=local_repo, sync=sync)
-            # print commit
-            commit_ind = all_commits.index(commit)
-            if not commit_ind:
-                print("commit {} is initial commit".format(commit))
-                continue
-            previous_commit = all_commits[commit_ind - 1]
-            self._diff(commit, previous_commit)
+        returncode = 0
+        diffs = self._previous_diffs(
+            [commit for commit, _ in commits_with_logs], all_commits,
+            engine=engine, jobs=jobs
+        )
+        with contextlib.closing(diffs):
+            for ind, cl in enumerate(commits_with_logs):
+                commit, log = cl
+                # print log
+                if ind:
+                    print()
+                self._print_log(commit=commit, log=log,
+                                local_repo=local_repo, sync=sync)
+                # print commit
+                previous_commit = _previous_commit(all_commits, commit)
+                if previous_commit is None:
+                    print("commit {} is initial commit".format(commit))
+                    continue
+                if engine != "native":
+                    self._print_command(
+                        self._diff_command(previous_commit, commit)
+                    )
+                result, diff_returncode = next(diffs)
+                if self._stat_depth is None:
+                    self._print_changes(result)
+                else:
+                    self._print_diff_stat(result)
+                returncode = diff_returncode or returncode
+        return returncode
+
+    def _span(self, name, kind="phase"):
+        """Return a context manager to time a phase *name*
+        (which does nothing without *--timings*).
+        """
+        if self._timings is None:
+            return contextlib.ExitStack()
+        return self._timings.span(name, kind)
 
-    def _status(self, check_changed=False):
+    def _status(self, check_changed=False, engine=None):
         """Print files and directories that were updated more recently
         than the last commit.
 
         Return exit code of `rsync`.
-        If *check_changed* is `True`,
-        return a tuple *(returncode, changed)*,
-        where *changed* is `True` if and only if
-        the working directory has changes since last commit.
+        If *check_changed* is `True`, nothing is printed
+        and a tuple *(returncode, changed)* is returned
+        (see *_check_changed*).
+
+        *engine* is "rsync" or "native" (see *_status_lines*).
+        By default it is taken from the command line.
         """
+        if engine is None:
+            engine = getattr(self._args, "engine", "rsync")
+
+        if check_changed:
+            return self._check_changed(engine=engine)
+        if getattr(self._args, "check", False):
+            # status --check
+            returncode, changed = self._check_changed(engine=engine)
+            if returncode:
+                return returncode
+            return COMMAND_ERROR if changed else 0
+
         # We don't return an error if the directory has changed,
         # because it is a normal situation (not an error).
         # This is the same as in git.
         try:
             local_repo_name = self._get_repo_name_local()
-        except YSConfigurationError as err:
-            if not check_changed:
-                return CONFIG_ERROR
-            # should return a tuple, but see no use for it in this case
-            raise err
-        else:
-            self._print("In repository " + local_repo_name)
-
-        if os.path.exists(self.COMMITDIR):
-            commit_subdirs = [fil for fil in os.listdir(self.COMMITDIR)
-                              if _is_commit(fil)]
-        else:
-            commit_subdirs = []
-
-        # decided to leave the condition explicit in code.
-        # def cond_print(*args, **kwargs):
-        #     """A wrapper to ignore check in every place."""
-        #     if check_changed:
-        #         return
-        #     self._print(*args, **kwargs)
-
-        ## no commits is fine for an initial commit
-        if not commit_subdirs:
-            configpath = os.path.normpath(self.config_dir)
-            if check_changed:
-                for subdir in os.scandir(self.root_dir):
-                    subdir_path = os.path.normpath(subdir.path)
-                    if subdir_path != configpath or subdir.is_file():
-                        return (0, True)
-                # if there is only '.ys' in the working directory,
-                # then the repository is unchanged.
-                return (0, False)
-            self._print("No commits found")
-            return 0
-
-        head_commit = self._get_head_commit()
-        if head_commit is None:
-            newest_commit = max(map(int, commit_subdirs))
-            ref_commit_dir = os.path.join(self.COMMITDIR, str(newest_commit))
-        else:
-            ref_commit_dir = os.path.join(self.COMMITDIR, str(head_commit))
-
-        command = [
-            "rsync", "-aun",
-            # allow incremental recursion until the implementation of
-            # https://github.com/WayneD/rsync/issues/380
-            # "--no-inc-recursive",
-            "--delete", "-i",
-            "--no-group", "--no-owner",
-            "--exclude=/.ys"
-        ]
-
-        filter_command = self._get_filter(include_commits=False)
-        command += filter_command
-
-        # outbuf option added in Rsync 3.1.0 (28 Sep 2013)
-        # https://download.samba.org/pub/rsync/NEWS#ENHANCEMENTS-3.1.0
-        # from https://stackoverflow.com/a/35775429
-        command.append('--outbuf=L')
-
-        root_path = self.root_dir + "/"
-        command += ["--link-dest="+ref_commit_dir, root_path, ref_commit_dir]
+        except YSConfigurationError:
+            return CONFIG_ERROR
+        else:
+            self._print("In repository " + local_repo_name)
 
-        if not check_changed:
-            self._print_command(command, level=3)
+        ## no commits is fine for an initial commit
+        ref_commit_dir = self._get_ref_commit_dir()
+        if ref_commit_dir is None:
+            self._print("No commits found")
+            return 0
+        head_commit = self._get_head_commit()
 
-        # default stderr (None) outputs to parent's stderr
-        sp = subprocess.Popen(command, stdout=subprocess.PIPE)
-        # this works correctly, but strangely for pytest:
-        # https://github.com/pytest-dev/pytest-mock/issues/295#issuecomment-1155091491
-        # sp = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=sys.stderr)
+        lines, finish = self._status_lines(
+            ref_commit_dir, engine=engine,
+            checksum=getattr(self._args, "checksum", False)
+        )
         # changed means there were actual changes in the working dir
         changed = False
         # note that directories may appear to be changed
         # just because of timestamps (add and remove a file), e.g.
         # b'.d..t...... ./\n'
         # b'' means EOF in the iteration.
-        lines = iter(sp.stdout.readline, b'')
+        if self._format == "json":
+            for change in filter(None, map(_parse_change, lines)):
+                if not change.flags.startswith('.'):
+                    changed = True
+                self._print_json(_change_dict(change))
+            lines = []
         for line in lines:
             if line:
                 # todo efficiency: check print levels beforehand,
                 # not for each line (as done with _print)
-                # if not check_changed:
                 self._print("Changed since head commit:\n")
                 # skip permission changes
                 if not line.startswith(b'.'):
                     changed = True
-                    # if check_changed:
-                    #     # return code is unimportant in this case
-                    #    return (0, changed)
 
                 # print the line and all following lines.
                 # todo: use terminal encoding
@@ -2702,15 +5765,9 @@ def _status(self, check_changed=False):
                 for line in lines:
                     if not line.startswith(b'.'):
                         changed = True
-                        # if check_changed:
-                        #     return (0, changed)
                     print(line.decode("utf-8"), end='')
 
-        sp.wait()  # otherwise returncode might be None
-        # None is fine for sys.exit() though,
-        # because it will be converted to 0.
-        # For testing, it is better to have it 0 here.
-        returncode = sp.returncode
+        returncode = finish()
 
         commit_limit = self._get_commit_limit()
         if commit_limit is not None:
@@ -2721,24 +5778,31 @@ def _status(self, check_changed=False):
             self._print("\nDetached HEAD (see '{} log' for more recent commits)"
                         .format(self.NAME))
 
-        if os.path.exists(self.MERGEFILE):
-            with open(self.MERGEFILE, "r") as fil:
-                merge_str = fil.readlines()[0].strip()
-            merges = merge_str.split(',')
+        try:
+            merge_str = self._read_ys_file(self.MERGEFILE).splitlines()[0]
+        except FileNotFoundError:
+            pass
+        else:
+            merges = merge_str.strip().split(',')
             self._print("Merging {} and {} (most recent common commit {})."\
                         .format(*merges))
 
-        if not changed and not check_changed:
+        if not changed:
             self._print("Nothing to commit, working directory clean.")
-        if changed:  # and not check_changed:
+        else:
             # better formatting
             self._print()
 
-        sync = self._get_local_sync(verbose=not check_changed)
+        ref_stats = self._read_commit_stats(os.path.basename(ref_commit_dir))
+        if ref_stats is not None:
+            self._print("commit {} has {}".format(
+                os.path.basename(ref_commit_dir),
+                _format_commit_stats(ref_stats)
+            ), level=3)
+
+        sync = self._get_local_sync(verbose=True)
 
-        if sync and not check_changed:
-            # if we only check for changes (to push or pull),
-            # we are not interested in the commit synchronization status
+        if sync:
             commits = list(self._get_local_commits())
             last_commit = self._get_last_commit(commits)
             if last_commit in sync.by_repos.values():
@@ -2759,13 +5823,173 @@ def _status(self, check_changed=False):
                     self._print("Local repository is {} commits ahead of {}"\
                                 .format(n_newer_commits, ", ".join(last_repos)))
 
-        # called from an internal method
-        if check_changed:
-            # changed is always False here
-            return (returncode, changed)
-        # called as the main command
         return returncode
 
+    def _status_lines(self, ref_commit_dir, engine="rsync", verbose=True,
+                      checksum=False):
+        """Compare the working directory with *ref_commit_dir*.
+
+        Return a pair *(lines, finish)*, where *lines* is an iterator
+        of rsync itemized output (bytes) and *finish()* returns
+        the exit code after *lines* were consumed.
+
+        The "rsync" *engine* runs *rsync -aun --delete -i*.
+        The "native" engine walks the directories in Python
+        and skips hard linked (unchanged) files by their inodes.
+        If filters are not supported by the native engine,
+        rsync is used.
+
+        If *checksum* is ``True``, files of the same size
+        are compared by their contents.
+        The native engine caches content hashes
+        and computes only those of new or modified files.
+        Otherwise it compares only paths from the journal
+        of *yarsync watch*, if that is valid.
+        """
+        filter_command = self._get_filter(include_commits=False)
+
+        if engine == "native":
+            rsync_filter = self._make_native_filter(
+                ["--exclude=/.ys"] + filter_command
+            )
+            if rsync_filter is not None:
+                errors = []
+                hash_cache = None
+                journal = None
+                dirty = None
+                if not checksum:
+                    commit = int(os.path.basename(ref_commit_dir))
+                    journal, dirty = self._get_watch_journal(commit)
+                if checksum:
+                    hash_cache = _HashCache(self.HASHFILE)
+                    try:
+                        # hash all files in parallel beforehand
+                        for path, err in hash_cache.update(
+                                _checksum_candidates(
+                                    self.root_dir, ref_commit_dir,
+                                    rsync_filter, errors
+                                )
+                            ):
+                            _native_error("read", path, err, errors)
+                    finally:
+                        hash_cache.save()
+                changes = _native_changes(
+                    self.root_dir, ref_commit_dir,
+                    rsync_filter=rsync_filter, errors=errors,
+                    hash_cache=hash_cache, dirty=dirty
+                )
+                # a complete scan makes the journal valid for the commit
+                changed = None
+                if journal is not None and dirty is None:
+                    changed = []
+
+                    def record(changes):
+                        for change in changes:
+                            if change.path != "./":
+                                changed.append(change.path.rstrip('/'))
+                            yield change
+
+                    changes = record(changes)
+                lines = (change.itemize() for change in changes)
+
+                def finish_native(terminate=False):
+                    if hash_cache is not None:
+                        hash_cache.save()
+                    if changed is not None and not terminate and not errors:
+                        self._write_watch_journal(
+                            journal, {"commit": commit, "paths": changed}
+                        )
+                    # rsync returns 23 for a partial transfer due to error
+                    return 23 if errors else 0
+
+                return (lines, finish_native)
+
+        command = [
+            "rsync", "-aun",
+            # allow incremental recursion until the implementation of
+            # https://github.com/WayneD/rsync/issues/380
+            # "--no-inc-recursive",
+            "--delete", "-i",
+            "--no-group", "--no-owner",
+            "--exclude=/.ys"
+        ]
+        if checksum:
+            command.append("--checksum")
+        command += filter_command
+
+        # outbuf option added in Rsync 3.1.0 (28 Sep 2013)
+        # https://download.samba.org/pub/rsync/NEWS#ENHANCEMENTS-3.1.0
+        # from https://stackoverflow.com/a/35775429
+        command.append('--outbuf=L')
+
+        root_path = self.root_dir + "/"
+        command += ["--link-dest="+ref_commit_dir, root_path, ref_commit_dir]
+
+        if verbose:
+            self._print_command(command, level=3)
+
+        # default stderr (None) outputs to parent's stderr
+        sp = self._popen(command, stdout=subprocess.PIPE)
+        # this works correctly, but strangely for pytest:
+        # https://github.com/pytest-dev/pytest-mock/issues/295#issuecomment-1155091491
+        # sp = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=sys.stderr)
+
+        def finish(terminate=False):
+            if terminate and sp.poll() is None:
+                # we don't need the rest of the output
+                sp.terminate()
+                sp.stdout.close()
+                sp.wait()
+                return 0
+            sp.wait()  # otherwise returncode might be None
+            # None is fine for sys.exit() though,
+            # because it will be converted to 0.
+            # For testing, it is better to have it 0 here.
+            return sp.returncode
+
+        return (iter(sp.stdout.readline, b''), finish)
+
+    def _transfer_lines(self, lines, commits_to_transfer):
+        """Yield rsync output *lines* (bytes) as strings to print.
+
+        Transfers of whole new commits (*commits_to_transfer*)
+        are merged into one line for each commit at the end.
+        """
+        _ysdir = self.YSDIR
+        # Not self.COMMITDIR, because it involves the complete path.
+        COMMITDIR = bytes(os.path.join(_ysdir, "commits"), "utf-8")
+        transferred_commits = set()
+        for line in lines:
+            if line.startswith(COMMITDIR):
+                # commits
+                com_start = len(COMMITDIR) + 1
+                # or os.sep
+                com_end = line.find(b'/', com_start)
+                com_str = line[com_start:com_end]
+                if not com_str:
+                    # ".ys/commits/"
+                    yield line.decode("utf-8")
+                    continue
+                cur_commit = int(com_str)
+                if cur_commit in commits_to_transfer:
+                    # don't print transfers for complete new commits.
+                    transferred_commits.add(cur_commit)
+                else:
+                    # print changes for existing commits
+                    yield line.decode("utf-8")
+            else:
+                # working directory
+                yield line.decode("utf-8")
+        # there can be also lines like
+        # file => .ys/commits/.../file
+        # leave them as they are.
+        #
+        # actually, this may be only part of the data
+        # (if there is no space left)
+        yield "\n"  # "data transferred for commits:")
+        for comm in sorted(transferred_commits):
+            yield "commit {}\n".format(comm)
+
     def _update_head(self):
         try:
             # no HEADFILE means HEAD is the most recent commit
@@ -2773,6 +5997,292 @@ def _update_head(self):
         except FileNotFoundError:
             pass
 
+    def _verify(self, remote, commits=None, jobs=None, rehash=False):
+        """Compare files in the working directory and *commits*
+        with those at *remote* by their sizes and hashes.
+
+        The remote manifest is made by *yarsync manifest*,
+        which is run over SSH or locally for a mounted path.
+        If *commits* are not given, all commits
+        present on both sides are compared.
+        Return ``COMMAND_ERROR`` if the replicas differ.
+        """
+        try:
+            full_destpath = self._get_dest_path(remote)
+        except KeyError as err:
+            raise err from None
+
+        errors = []
+        try:
+            local_manifest = self._make_manifest(
+                commits, jobs=jobs, rehash=rehash, errors=errors
+            )
+        except ValueError as err:
+            _print_error(err)
+            return COMMAND_ERROR
+        if errors:
+            _print_error("could not read {} local files".format(len(errors)))
+            return COMMAND_ERROR
+
+        manifest_args = ["manifest"]
+        if jobs is not None:
+            manifest_args += ["--jobs", str(jobs)]
+        if rehash:
+            manifest_args.append("--rehash")
+        manifest_args += [str(commit) for commit in commits or []]
+        if _is_remote(full_destpath):
+            host, path = full_destpath.split(':', 1)
+            remote_command = [
+                "yarsync", "-qq",
+                "--config-dir", os.path.join(path, self.YSDIR),
+                "--root-dir", path
+            ] + manifest_args
+            command = self._get_ssh_command(host) + [
+                host, " ".join(map(_quote_remote, remote_command))
+            ]
+        else:
+            # a mounted drive
+            command = [
+                sys.executable, "-m", "yarsync.yarsync", "-qq",
+                "--config-dir", os.path.join(full_destpath, self.YSDIR),
+                "--root-dir", full_destpath
+            ] + manifest_args
+        self._print_command(command, level=3)
+
+        remote_manifest = {}
+        sp = self._popen(command, stdout=subprocess.PIPE)
+        # the remote manifest is parsed while it is being made
+        for line in sp.stdout:
+            entry = _parse_manifest_line(
+                line.decode("utf-8", errors="surrogateescape")
+            )
+            if entry is not None:
+                path, size, digest = entry
+                remote_manifest[path] = (size, digest)
+        sp.wait()
+        if sp.returncode:
+            _print_error("could not get the manifest of {}".format(remote))
+            return sp.returncode
+
+        def commit_of(path):
+            if path.startswith(self.YSDIR + "/" + self.COMMITDIRNAME + "/"):
+                return int(path.split('/')[2])
+            return None
+
+        if commits is None:
+            local_commits = set(map(commit_of, local_manifest))
+            remote_commits = set(map(commit_of, remote_manifest))
+            for commits_, where in [(local_commits - remote_commits, remote),
+                                    (remote_commits - local_commits, "local")]:
+                if commits_:
+                    self._print("commits missing on {}: {}".format(
+                        where, ", ".join(map(str, sorted(commits_)))
+                    ))
+            skipped = local_commits ^ remote_commits
+        else:
+            skipped = set()
+
+        ndiffer = 0
+        nverified = 0
+        for path in sorted(set(local_manifest) | set(remote_manifest)):
+            if commit_of(path) in skipped:
+                continue
+            local_entry = local_manifest.get(path)
+            remote_entry = remote_manifest.get(path)
+            if local_entry == remote_entry:
+                nverified += 1
+                continue
+            ndiffer += 1
+            if remote_entry is None:
+                print("local only  " + path)
+            elif local_entry is None:
+                print("remote only " + path)
+            else:
+                print("differs     " + path)
+
+        if ndiffer:
+            self._print("{} files differ on {}".format(ndiffer, remote))
+            return COMMAND_ERROR
+        self._print("{} files verified on {}".format(nverified, remote))
+        return 0
+
+    def _watch(self):
+        """Record paths changed in the working directory
+        into a journal until interrupted.
+
+        *status*, *pull* and *push* with the native engine
+        compare only these paths when the journal is valid.
+        """
+        import fcntl
+        import signal
+
+        rsync_filter = self._make_native_filter(
+            ["--exclude=/.ys"] + self._get_filter(include_commits=False)
+        )
+        if rsync_filter is None:
+            _print_error("only include, exclude and merge filter rules "
+                         "are supported by watch")
+            return COMMAND_ERROR
+
+        os.makedirs(self.CACHEDIR, exist_ok=True)
+        lock_fd = os.open(self.WATCHLOCK, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            for attempt in range(2):
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    # it could be checked by another command
+                    time.sleep(0.1)
+            else:
+                _print_error("watch is already running for {}"
+                             .format(self.root_dir))
+                return COMMAND_ERROR
+
+            # finally is run on termination
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            inotify = _Inotify()
+            try:
+                # a new journal is started after an overflow
+                while True:
+                    self._watch_session(inotify, rsync_filter)
+            except KeyboardInterrupt:
+                return 0
+            except OSError as err:
+                if err.errno != errno.ENOSPC:
+                    raise err
+                _print_error(
+                    "inotify watch limit reached, increase "
+                    "fs.inotify.max_user_watches with sysctl"
+                )
+                return COMMAND_ERROR
+            finally:
+                inotify.close()
+                try:
+                    os.remove(self.WATCHFILE)
+                except FileNotFoundError:
+                    pass
+        finally:
+            os.close(lock_fd)
+
+    def _watch_session(self, inotify, rsync_filter):
+        """Start a new journal and record changes
+        until the inotify queue overflows.
+        """
+        ino = _Inotify
+        mask = (ino.IN_MODIFY | ino.IN_ATTRIB | ino.IN_CLOSE_WRITE
+                | ino.IN_MOVED_FROM | ino.IN_MOVED_TO | ino.IN_CREATE
+                | ino.IN_DELETE | ino.IN_ONLYDIR | ino.IN_DONT_FOLLOW
+                | ino.IN_EXCL_UNLINK)
+        # {watch descriptor: relative path of the directory}
+        dirs = {}
+        errors = []
+
+        def add_dir(dir_path, relpath, paths=None):
+            # watch a directory with subdirectories.
+            # Their contents are added to paths, if that is given,
+            # because they could be created before the watch.
+            stack = [(dir_path, relpath)]
+            while stack:
+                dir_path, relpath = stack.pop()
+                try:
+                    wd = inotify.add_watch(dir_path, mask)
+                except OSError as err:
+                    if err.errno == errno.ENOSPC:
+                        raise err
+                    # removed meanwhile
+                    continue
+                dirs[wd] = relpath
+                entries = _native_scandir(dir_path, relpath, rsync_filter,
+                                          errors)
+                for name, entry in (entries or {}).items():
+                    if paths is not None:
+                        paths.append(relpath + name)
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, relpath + name + '/'))
+
+        add_dir(self.root_dir, "")
+        # readers create cookie files there
+        cookie_wd = inotify.add_watch(self.CACHEDIR, ino.IN_CREATE)
+
+        lines = []
+        ref_commit_dir = self._get_ref_commit_dir()
+        if ref_commit_dir is not None:
+            changes = _native_changes(self.root_dir, ref_commit_dir,
+                                      rsync_filter=rsync_filter,
+                                      errors=errors)
+            changed = [change.path.rstrip('/') for change in changes
+                       if change.path != "./"]
+            lines.append({"commit": int(os.path.basename(ref_commit_dir)),
+                          "paths": changed})
+
+        journal = "watch-{}.jsonl".format(int(time.time() * 1000))
+        for name in os.listdir(self.CACHEDIR):
+            if name.startswith("watch-") and name != journal:
+                try:
+                    os.remove(os.path.join(self.CACHEDIR, name))
+                except OSError:
+                    pass
+        journal_fd = os.open(os.path.join(self.CACHEDIR, journal),
+                             os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            state_tmp = self.WATCHFILE + ".tmp"
+            with open(state_tmp, "w") as fil:
+                json.dump({"pid": os.getpid(), "journal": journal,
+                           "filter": self._get_watch_filter()}, fil)
+            os.replace(state_tmp, self.WATCHFILE)
+            self._print("watching {} directories in {}"
+                        .format(len(dirs), self.root_dir))
+
+            recorded = set()
+            while True:
+                paths = []
+                for wd, event, _, name in inotify.read():
+                    if event & ino.IN_Q_OVERFLOW:
+                        self._print("event queue overflow, "
+                                    "start a new journal", level=3)
+                        os.write(journal_fd, b'{"overflow": true}\n')
+                        return
+                    if wd == cookie_wd:
+                        if name.startswith("watch-cookie-"):
+                            lines.append({"cookie": name})
+                        continue
+                    if event & ino.IN_IGNORED:
+                        dirs.pop(wd, None)
+                        continue
+                    relpath = dirs.get(wd)
+                    if relpath is None:
+                        continue
+                    path = relpath + name
+                    is_dir = bool(event & ino.IN_ISDIR)
+                    if not name or rsync_filter.excluded(path, is_dir):
+                        # changes of a directory itself
+                        # change its entry in the parent
+                        paths.append(path.rstrip('/'))
+                        continue
+                    paths.append(path)
+                    if not is_dir:
+                        continue
+                    if event & ino.IN_MOVED_FROM:
+                        for sub_wd, sub_path in list(dirs.items()):
+                            if sub_path.startswith(path + '/'):
+                                inotify.rm_watch(sub_wd)
+                                del dirs[sub_wd]
+                    elif event & (ino.IN_CREATE | ino.IN_MOVED_TO):
+                        add_dir(os.path.join(self.root_dir, path),
+                                path + '/', paths)
+                for path in paths:
+                    if path and path not in recorded:
+                        recorded.add(path)
+                        lines.append({"path": path})
+                if lines:
+                    os.write(journal_fd, "".join(
+                        json.dumps(line) + "\n" for line in lines
+                    ).encode())
+                    lines = []
+        finally:
+            os.close(journal_fd)
+
     def _write_repo_name(self, reponame, verbose=True):
         # todo: if the path contains {}, it can lead to an error
         repofile = self.REPOFILE.format(reponame)
@@ -2783,6 +6293,44 @@ def _write_repo_name(self, reponame, verbose=True):
         # return full path to the repository file
         return repofile
 
+    def _write_commit_stats(self, commit):
+        """Write statistics of a new *commit* next to its log.
+
+        Only the difference with the previous commit is read,
+        if statistics of that were recorded.
+        """
+        commits = sorted(self._get_local_commits())
+        previous = _previous_commit(commits, commit)
+        previous_dir = None
+        previous_stats = None
+        if previous is not None:
+            previous_dir = os.path.join(self.COMMITDIR, str(previous))
+            previous_stats = self._read_commit_stats(previous)
+        errors = []
+        stats = _commit_stats(os.path.join(self.COMMITDIR, str(commit)),
+                              previous_dir, previous_stats, errors)
+        if errors:
+            # incomplete statistics are worse than none
+            self._print("statistics of commit {} not written".format(commit),
+                        level=3)
+            return
+        stats_tmp = self.COMMITSTATSFILE.format(commit) + ".tmp"
+        with open(stats_tmp, "w") as fil:
+            json.dump(stats, fil)
+        os.replace(stats_tmp, self.COMMITSTATSFILE.format(commit))
+
+    def _write_remote_cache(self, cache_file, config_path, remote_files):
+        """Write remote files to the cache. Errors are ignored."""
+        cache_tmp = cache_file + ".tmp"
+        try:
+            os.makedirs(self.CACHEDIR, exist_ok=True)
+            with open(cache_tmp, "w") as fil:
+                json.dump({"path": config_path, "time": time.time(),
+                           "files": remote_files}, fil)
+            os.replace(cache_tmp, cache_file)
+        except OSError:
+            pass
+
     def _write_sync(self, sync, print_level=3):
         if sync.new or sync.removed:
             self._print("updating synchronization ... ", end='',
@@ -2809,12 +6357,34 @@ def _write_sync(self, sync, print_level=3):
         sync.removed = set()
         self._print("done", level=print_level-1)
 
+    def _write_watch_journal(self, journal, entry):
+        """Append *entry* to the *journal* of *yarsync watch*
+        if it is still used.
+        """
+        state = self._get_watch_state()
+        if state is None or state["journal"] != journal:
+            return
+        line = (json.dumps(entry) + "\n").encode()
+        try:
+            fd = os.open(os.path.join(self.CACHEDIR, journal),
+                         os.O_WRONLY | os.O_APPEND)
+        except OSError:
+            return
+        try:
+            # appended at once, not mixed with the watcher output
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
     def __call__(self):
         """Call the command set during the initialisation."""
         try:
             # all errors are usually transferred as returncode
             # and functions throw no exceptions
-            returncode = self._func()
+            with self._span("command " + self._args.command_name):
+                returncode = self._func()
+            if self._index is not None:
+                self._index.save()
         # in Python 3 EnvironmentError is an alias to OSError
         except OSError as err:
             # In Python 3 there are more errors, e.g. PermissionError, etc.
@@ -2822,15 +6392,490 @@ def __call__(self):
             # but to IOError in Python 2.
             _print_error(err)
             returncode = 8
+        finally:
+            # also on KeyboardInterrupt
+            self._close_ssh_connections()
+            if self._profile is not None:
+                self._profile.disable()
+                self._profile.dump_stats(self._args.profile)
+            if self._timings is not None:
+                self._print_timings()
         # in case of other errors, None will be returned!
         # todo: what code to return for RuntimeError?
         return returncode
 
 
-def main():
+######################
+## Python interface ##
+######################
+
+class Change(collections.namedtuple("Change", ["flags", "path", "link"])):
+    """A changed path.
+
+    *flags* are those of rsync itemized output
+    (for example, ">f.st......" or "*deleting").
+    *path* is relative to the root of the repository
+    and has a trailing slash for directories.
+    *link* is a symbolic link target or ``None``.
+    """
+
+    __slots__ = ()
+
+
+class LogEntry(collections.namedtuple(
+        "LogEntry",
+        ["commit", "message", "exists", "head", "synced", "stats"])):
+    """A commit and its log.
+
+    *message* is the text of the log or ``None`` if the log is missing.
+    *exists* is ``False`` if only the log of the *commit* is present.
+    *head* is ``True`` for a detached HEAD commit.
+    *synced* is the list of other repositories synchronized
+    at this commit.
+    *stats* is a dictionary with the numbers of "files", "bytes",
+    "new_files" and "new_bytes" recorded by *commit*, or ``None``.
+    """
+
+    __slots__ = ()
+
+
+class Transfer(collections.namedtuple("Transfer", ["changes", "commits"])):
+    """Result of pull or push.
+
+    *changes* are the changes (see Change) in the working directory
+    and in commits existing on both sides.
+    *commits* are the new commits transferred as a whole.
+    """
+
+    __slots__ = ()
+
+
+_ITEMIZE_RE = re.compile(rb"([<>ch.][fdLDS][^ ]*|\*deleting) +(.+)")
+_COMMIT_PATH_RE = re.compile(r"\.ys/commits/(\d+)/")
+
+
+def _parse_change(line):
+    """Return a Change for a line of rsync itemized output (bytes)
+    or ``None`` for other lines.
+    """
+    match = _ITEMIZE_RE.fullmatch(line.rstrip(b'\n'))
+    if match is None:
+        return None
+    flags, path = map(os.fsdecode, match.groups())
+    link = None
+    if flags[1:2] == 'L' and " -> " in path:
+        path, link = path.split(" -> ", 1)
+    return Change(flags, path, link)
+
+
+def _transfer_items(lines):
+    """Yield changes from rsync itemized output *lines*.
+
+    New commits transferred as a whole are yielded once
+    as their numbers (int) instead of all their files.
+    """
+    new_commits = set()
+    for change in map(_parse_change, lines):
+        if change is None:
+            continue
+        match = _COMMIT_PATH_RE.match(change.path)
+        if match is not None:
+            commit = int(match.group(1))
+            if commit in new_commits:
+                continue
+            if (change.path == match.group(0)
+                    and change.flags.startswith("cd+")):
+                # a commit is created
+                new_commits.add(commit)
+                yield commit
+                continue
+        yield change
+
+
+# rsync itemized output is YXcstpoguax
+_ITEMIZE_UPDATES = {
+    "<": "sent", ">": "received", "c": "local", "h": "hard link",
+    ".": "none", "*": "message",
+}
+_ITEMIZE_FILE_TYPES = {
+    "f": "file", "d": "directory", "L": "symlink", "D": "device",
+    "S": "special",
+}
+_ITEMIZE_ATTRIBUTES = [
+    "checksum", "size", "time", "permissions", "owner", "group",
+    "atime", "acl", "xattr",
+]
+
+
+def _change_dict(change):
+    """Return a dictionary with the fields of a *change* for JSON."""
+    flags = change.flags
+    data = {"type": "change", "path": change.path, "flags": flags}
+    if flags.startswith('*'):
+        # *deleting
+        data.update(
+            update=flags[1:],
+            file_type="directory" if change.path.endswith('/') else None,
+            new=False, attributes=[],
+        )
+    else:
+        attr_flags = flags[2:]
+        data.update(
+            update=_ITEMIZE_UPDATES.get(flags[0]),
+            file_type=_ITEMIZE_FILE_TYPES.get(flags[1]),
+            new=bool(attr_flags) and set(attr_flags) == {'+'},
+            attributes=[
+                attr for attr, flag in zip(_ITEMIZE_ATTRIBUTES, attr_flags)
+                if flag not in ". +?"
+            ],
+        )
+    data["link"] = change.link
+    return data
+
+
+def _transfer_dict(item, remote):
+    """Return a dictionary for JSON from an item of _transfer_items."""
+    if isinstance(item, Change):
+        data = _change_dict(item)
+    else:
+        data = {"type": "transferred_commit", "commit": item}
+    data["remote"] = remote
+    return data
+
+
+class Repository():
+    """A yarsync repository for use from Python.
+
+    Methods return results instead of printing them,
+    and command line arguments are not parsed.
+    Errors are printed to stderr as usual;
+    if a command fails, YSCommandError with its return code is raised.
+
+    By default, the repository is searched in the current directory
+    and its parents.
+    """
+
+    def __init__(self, root_dir=None, config_dir=None):
+        if root_dir is None and config_dir is None:
+            # raises OSError if not found
+            root_dir = _get_root_directory(".ys")
+        elif root_dir is None:
+            root_dir = "."
+        if config_dir is None:
+            config_dir = os.path.join(root_dir, ".ys")
+        self.root_dir = os.path.abspath(root_dir)
+        self.config_dir = os.path.abspath(config_dir)
+        if not os.path.isdir(self.config_dir):
+            raise FileNotFoundError(
+                errno.ENOENT, "configuration directory not found",
+                self.config_dir
+            )
+
+    @contextlib.contextmanager
+    def _yarsync(self, command_name, **args):
+        # YARsync for one command, without parsing the command line
+        ys = YARsync.__new__(YARsync)
+        ys.NAME = "yarsync"
+        ys.YSDIR = ".ys"
+        ys._timings = None
+        ys._profile = None
+        ys._args = argparse.Namespace(command_name=command_name, **args)
+        # only errors are printed
+        ys._default_print_level = 2
+        ys.print_level = 0
+        ys._init_repo(self.root_dir, self.config_dir, command_name)
+        try:
+            yield ys
+            if ys._index is not None:
+                ys._index.save()
+        finally:
+            ys._close_ssh_connections()
+
+    def commits(self):
+        """Return the sorted list of commits."""
+        with self._yarsync("log") as ys:
+            return sorted(ys._get_local_commits())
+
+    def diff(self, commit1, commit2):
+        """Return the list of changes from the older
+        to the newer of two commits (see Change).
+        """
+        comm1, comm2 = sorted([commit1, commit2])
+        with self._yarsync("diff") as ys:
+            comm1_dir = os.path.join(ys.COMMITDIR, str(comm1))
+            comm2_dir = os.path.join(ys.COMMITDIR, str(comm2))
+            for comm, comm_dir in [(comm1, comm1_dir), (comm2, comm2_dir)]:
+                if not os.path.isdir(comm_dir):
+                    raise ValueError("commit {} does not exist".format(comm))
+            errors = []
+            changes = [
+                Change(change.flags, change.path, change.link)
+                for change in _native_changes(comm2_dir, comm1_dir,
+                                              errors=errors)
+            ]
+        if errors:
+            # as for a partial transfer in rsync
+            raise YSCommandError(23)
+        return changes
+
+    def log(self):
+        """Return the list of commits and their logs
+        (see LogEntry), most recent first.
+        """
+        with self._yarsync("log") as ys:
+            sync = ys._get_local_sync(verbose=False)
+            head_commit = ys._get_head_commit()
+            local_repo = ys._get_repo_name_local()
+            return [
+                ys._log_entry(commit, log, local_repo, sync, head_commit)
+                for commit, log in reversed(ys._make_commit_list())
+            ]
+
+    def pull(self, source, dry_run=False, force=False, new=False,
+             backup=False, backup_dir="", engine="rsync", refresh=False):
+        """Pull from *source* and return a Transfer.
+
+        Arguments have the same meaning as
+        the command line options of *yarsync pull*.
+        """
+        return self._transfer(
+            "pull", source, engine=engine, refresh=refresh,
+            dry_run=dry_run, force=force, new=new,
+            backup=backup or bool(backup_dir), backup_dir=backup_dir
+        )
+
+    def push(self, destination, dry_run=False, force=False,
+             engine="rsync", refresh=False):
+        """Push to *destination* and return a Transfer.
+
+        Arguments have the same meaning as
+        the command line options of *yarsync push*.
+        """
+        return self._transfer(
+            "push", destination, engine=engine, refresh=refresh,
+            dry_run=dry_run, force=force
+        )
+
+    def status(self, engine="native", checksum=False):
+        """Return the list of changes in the working directory
+        since the last commit (see Change).
+
+        *engine* and *checksum* are the same as in *yarsync status*.
+        """
+        with self._yarsync("status", engine=engine,
+                           checksum=checksum) as ys:
+            ref_commit_dir = ys._get_ref_commit_dir()
+            if ref_commit_dir is None:
+                return []
+            lines, finish = ys._status_lines(
+                ref_commit_dir, engine=engine, verbose=False,
+                checksum=checksum
+            )
+            changes = [change for change in map(_parse_change, lines)
+                       if change is not None]
+            returncode = finish()
+        if returncode:
+            raise YSCommandError(returncode)
+        return changes
+
+    def _transfer(self, command_name, remote, engine, refresh, **kwargs):
+        with self._yarsync(command_name, engine=engine,
+                           refresh=refresh) as ys:
+            ys._transfers = []
+            returncode = ys._pull_push(command_name, remote, **kwargs)
+        if returncode:
+            raise YSCommandError(returncode)
+
+        changes = []
+        new_commits = []
+        for item in _transfer_items(ys._transfers):
+            if isinstance(item, Change):
+                changes.append(item)
+            else:
+                new_commits.append(item)
+        return Transfer(changes, new_commits)
+
+
+def _forward(argv):
+    """Run the command in *yarsync serve* if it is running.
+
+    Our standard streams and environment are passed to the service,
+    so that the output is written there directly.
+    Closing the connection (for example, on KeyboardInterrupt)
+    interrupts the command.
+    Return the return code of the command
+    or ``None`` if the service is not running
+    or the command is not forwarded.
+    """
+    path = _get_socket_path()
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    # not a service started by somebody else
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        return None
+    # long-running commands would block the service
+    if _get_command_name(argv[1:], ["--config-dir", "--root-dir",
+                                    "--profile"]) in ("serve", "watch"):
+        return None
+
+    import array
+    import socket
+    request = json.dumps({"argv": argv, "cwd": os.getcwd(),
+                          "env": dict(os.environ)}) + "\n"
+    request = request.encode()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return None
+        sys.stdout.flush()
+        sys.stderr.flush()
+        fds = array.array("i", [0, 1, 2])
+        sent = sock.sendmsg(
+            [request], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)]
+        )
+        sock.sendall(request[sent:])
+        response = b""
+        while not response.endswith(b"\n"):
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+    try:
+        return json.loads(response.decode())["returncode"]
+    except (ValueError, KeyError, TypeError):
+        _print_error("the connection to {} serve was closed".format(
+            os.path.basename(argv[0])
+        ))
+        return COMMAND_ERROR
+
+
+def _serve_request(conn):
+    """Run a command received on the connection *conn*
+    and send back its return code.
+
+    The command is interrupted if the client closes the connection.
+    """
+    import array
+    import select
+    import signal
+    import socket
+    import threading
+    fds = array.array("i")
+    data, ancdata, _, _ = conn.recvmsg(
+        4096, socket.CMSG_LEN(3 * fds.itemsize)
+    )
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data)
+                                    - len(cmsg_data) % fds.itemsize])
+    while data and not data.endswith(b"\n"):
+        chunk = conn.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    try:
+        request = json.loads(data.decode())
+        argv = request["argv"]
+        cwd = request["cwd"]
+        env = dict(request["env"])
+    except (ValueError, KeyError, TypeError):
+        request = None
+    if request is None or len(fds) != 3:
+        for fd in fds:
+            os.close(fd)
+        return
+
+    lock = threading.Lock()
+    state = {"done": False, "cancelled": False}
+    stop_read, stop_write = os.pipe()
+
+    def watch_client():
+        # the interruption is handled by the main thread
+        signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGINT])
+        select.select([conn, stop_read], [], [])
+        # under the lock, so that a finished command is not interrupted
+        with lock:
+            if state["done"]:
+                return
+            state["cancelled"] = True
+            if os.getpgid(0) == os.getpid():
+                # subprocesses (like rsync) are interrupted too
+                os.killpg(0, signal.SIGINT)
+            else:
+                signal.pthread_kill(threading.main_thread().ident,
+                                    signal.SIGINT)
+
+    # standard streams are replaced with those of the client
+    # (also for subprocesses)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(fd) for fd in range(3)]
+    saved_streams = (sys.stdin, sys.stdout, sys.stderr)
+    saved_env = dict(os.environ)
+    old_cwd = os.getcwd()
+    for fd, client_fd in enumerate(fds):
+        os.dup2(client_fd, fd)
+        os.close(client_fd)
+    sys.stdin = open(0, closefd=False)
+    sys.stdout = open(1, "w", buffering=1, closefd=False)
+    sys.stderr = open(2, "w", buffering=1, closefd=False)
+    returncode = None
+    try:
+        os.environ.clear()
+        os.environ.update(env)
+        # our subprocesses must not wait for us
+        os.environ["YARSYNC_SOCKET"] = ""
+        os.chdir(cwd)
+        watcher = threading.Thread(target=watch_client, daemon=True)
+        watcher.start()
+        try:
+            returncode = _main(argv)
+        finally:
+            with lock:
+                state["done"] = True
+            os.write(stop_write, b"\0")
+            watcher.join()
+    except KeyboardInterrupt:
+        if not state["cancelled"]:
+            raise
+    except Exception as err:
+        _print_error(err)
+        returncode = COMMAND_ERROR
+    finally:
+        os.close(stop_read)
+        os.close(stop_write)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.stdin, sys.stdout, sys.stderr = saved_streams
+        for fd, saved_fd in enumerate(saved_fds):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+        os.chdir(old_cwd)
+    if state["cancelled"]:
+        # nobody waits for the result
+        return
+    if returncode is None:
+        returncode = 0
+    try:
+        conn.sendall((json.dumps({"returncode": returncode}) + "\n")
+                     .encode())
+    except OSError:
+        # the client was interrupted
+        pass
+
+
+def _main(argv):
+    """Run the command *argv* and return its return code."""
     # parse arguments
     try:
-        ys = YARsync(sys.argv)
+        ys = YARsync(argv)
     except (argparse.ArgumentError, argparse.ArgumentTypeError,
             YSArgumentError, YSUnrecognizedArgumentsError):
         ## Argparse error ##
@@ -2838,12 +6883,12 @@ def main():
         # therefore we use the same code
         # (rsync is never called during __init__).
         # the error message is printed by argparse.
-        sys.exit(SYNTAX_ERROR)
+        return SYNTAX_ERROR
     except (OSError, YSConfigurationError):
         ## ys configuration error ##
         # (not in a repository, configuration file missing, etc.)
         # the error is printed by YARsync
-        sys.exit(CONFIG_ERROR)
+        return CONFIG_ERROR
     except SystemExit as err:
         ## Some runtime error ##
         # SystemExit can be 130 for python
@@ -2854,11 +6899,11 @@ def main():
         # with real rsync error codes (during the __init__).
         if err.code == 0:
             # normal argparse exit. For example, --help.
-            sys.exit(0)
+            return 0
         else:
-            sys.exit(SYS_EXIT_ERROR)
+            return SYS_EXIT_ERROR
     except YSCommandError:
-        sys.exit(COMMAND_ERROR)
+        return COMMAND_ERROR
 
     # make actual call
     try:
@@ -2866,7 +6911,14 @@ def main():
         # or return a non-zero code (_pull_push)?
         returncode = ys()
     except YSCommandError:
-        sys.exit(COMMAND_ERROR)
+        return COMMAND_ERROR
+    return returncode
+
+
+def main():
+    returncode = _forward(sys.argv)
+    if returncode is None:
+        returncode = _main(sys.argv)
     sys.exit(returncode)
 
 